@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 
 """
-Add or remove a DHCP option from the system IPConfiguration.bundle/Info.plist
+Add DHCP options to the system IPConfiguration.bundle/Info.plist
+
+Every option code given on the command line is added to the
+DHCPRequestedParameterList array in one pass, for example:
+    add_dhcp_request_option.py 121 249
 
 The modified plist setting requires rebooting to take effect.
 """
 
 import os
+import plistlib
+import re
 import sys
+import tempfile
 
 
 PATH = '/System/Library/SystemConfiguration/IPConfiguration.bundle/Contents'
@@ -16,6 +23,14 @@ FILE = PATH + '/' + FILE_NAME
 
 DEFAULT_OPTION_CODE = '121'
 
+# The DHCPRequestedParameterList array of the plist's text: the indentation
+# of its key, the entries of the array and the closing tag's line, or
+# None for the entries of an empty <array/>
+PARAMETER_LIST = re.compile(
+    r'(?P<indent>[ \t]*)<key>DHCPRequestedParameterList</key>\s*'
+    r'(?P<array><array>(?P<entries>.*?\n)(?P<closing>[ \t]*</array>)|'
+    r'<array/>)', re.DOTALL)
+
 
 def check_root():
     """
@@ -25,16 +40,42 @@ def check_root():
         sys.exit("Exiting: root permissions required")
 
 
-def get_argv():
+def find_parameter_list(plist):
     """
-    Returns any sys.argv data.  The only option this takes is the
-    single DHCP option to write into the plist.
+    Returns the DHCPRequestedParameterList array of the parsed plist,
+    wherever it is nested, or None when the plist has none
     """
-    if len(sys.argv) > 1:
-        option_code = sys.argv[1]
+    if isinstance(plist, dict):
+        if isinstance(plist.get('DHCPRequestedParameterList'), list):
+            return plist['DHCPRequestedParameterList']
+        children = plist.values()
+    elif isinstance(plist, list):
+        children = plist
     else:
-        option_code = DEFAULT_OPTION_CODE
-    return option_code
+        return None
+    for child in children:
+        parameter_list = find_parameter_list(child)
+        if parameter_list is not None:
+            return parameter_list
+    return None
+
+
+def get_argv():
+    """
+    Returns the DHCP option codes given in sys.argv as a list of integers,
+    DEFAULT_OPTION_CODE when none were given
+    """
+    option_codes = []
+    for argument in sys.argv[1:] or [DEFAULT_OPTION_CODE]:
+        try:
+            option_code = int(argument)
+        except ValueError:
+            option_code = -1
+        if not 0 < option_code < 255:
+            sys.exit('Not a DHCP option code: %s' % argument)
+        if option_code not in option_codes:
+            option_codes.append(option_code)
+    return option_codes
 
 
 def get_file_handle(filename, mode=''):
@@ -53,11 +94,11 @@ def get_file_handle(filename, mode=''):
 
 def open_plist_file(filename):
     """
-    Returns a readlines() list of file data
+    Returns the contents of the file
     """
     plist_file = get_file_handle(filename)
     try:
-        file_data = plist_file.readlines()
+        file_data = plist_file.read()
     except IOError:
         sys.exit('Cannot read file: %s' % filename)
 
@@ -67,94 +108,128 @@ def open_plist_file(filename):
     return file_data
 
 
-def process_plist_file(filename, option_code):
+def process_plist_file(filename, option_codes):
     """
-    Read the plist file and parse
-    for the option code
+    Adds every option code missing from the DHCPRequestedParameterList
+    array of the plist file
+
+    The plist is parsed to find the missing codes, but the new plist is
+    the original text with an <integer> line per missing code inserted
+    before the array's closing tag, indented like its other entries, so
+    the rest of the file is left byte for byte as it was.  Binary plists
+    are refused, convert them with "plutil -convert xml1" first.
 
-    Returns a writelines() compatible list with the new plist
-    and a variable that indicates if the file needs to
-    be written to disk as there was a change
+    Returns the new plist as a string and the option codes that were
+    added, none when the file doesnt need to be written
     """
     file_data = open_plist_file(filename)
+    if file_data.startswith('bplist'):
+        sys.exit('Binary plist, not changed: %s (convert it with '
+                 '"plutil -convert xml1 %s" and run again)'
+                 % (filename, filename))
+    try:
+        plist = plistlib.readPlistFromString(file_data)
+    except Exception as error:
+        sys.exit('Cannot parse plist %s: %s' % (filename, error))
+
+    parameter_list = find_parameter_list(plist)
+    if parameter_list is None:
+        sys.exit('No DHCPRequestedParameterList in: %s' % filename)
+
+    # prevent an existing option_code entry from duplicates
+    added_codes = [option_code for option_code in option_codes
+                   if option_code not in parameter_list]
+    if not added_codes:
+        return file_data, added_codes
+
+    match = PARAMETER_LIST.search(file_data)
+    if match is None:
+        sys.exit('Cannot find the DHCPRequestedParameterList array in: %s'
+                 % filename)
+    entries, closing = match.group('entries'), match.group('closing')
+    indent = re.search(r'\n([ \t]*)<integer>', entries or '')
+    if indent:
+        indent = indent.group(1)
+    else:
+        indent = match.group('indent') + '\t'
+    insert = ''.join('%s<integer>%d</integer>\n' % (indent, option_code)
+                     for option_code in added_codes)
+    if entries is None:
+        # an empty <array/> becomes an array of the new entries
+        array = '<array>\n%s%s</array>' % (insert, match.group('indent'))
+    else:
+        array = '<array>%s%s%s' % (entries.rstrip(' \t'), insert, closing)
+    new_file_data = file_data[:match.start('array')] + array + \
+        file_data[match.end('array'):]
 
-    option_code = option_code or '121'
-
-    insert_key = '<integer>%s</integer>\n' % option_code
-
-    dhcp_key_in_file = False
-    option_in_plist = False
-    end_of_array = False
-    file_needs_change = False
-    tab_offset = 0
-    new_file_data = []
-    for line in file_data:
-        if dhcp_key_in_file and not option_in_plist and not end_of_array:
-            # calculated the tab offset by splitting the line on the first <
-            # and running len on the leftmost chunk of whitespace
-            if '<integer>' in line and '</integer>' in line and not tab_offset:
-                tab_offset = len(line.split('<')[0])
-            # prevent an existing option_code entry from duplicates:
-            if '<integer>%s</integer>' % option_code in line:
-                option_in_plist = True
-            # the end of the array must be reached to determine
-            # if option_code is in the array
-            if '</array>' in line:
-                end_of_array = True
-            # add a new option_code entry to the file only
-            # if the option doesnt exist, the end of the array
-            # has been seen and a tab offset has been calculated
-            if not option_in_plist and end_of_array and tab_offset:
-                new_key = tab_offset * '\t' + insert_key
-                new_file_data.append(new_key)
-                file_needs_change = True
-        if '<key>DHCPRequestedParameterList</key>' in line:
-            dhcp_key_in_file = True
-
-        # always put the line "back" into the new file:
-        new_file_data.append(line)
-
-    return new_file_data, file_needs_change
+    # the edit must parse to the same plist with the codes appended
+    expected = list(parameter_list) + added_codes
+    new_list = find_parameter_list(plistlib.readPlistFromString(new_file_data))
+    if new_list != expected:
+        sys.exit('Cannot add the options to: %s' % filename)
+    return new_file_data, added_codes
 
 
 def write_plist_file(filename, file_data):
     """
-    Writes the specified file, overwriting a file with the same name
+    Replaces the specified file without readers ever seeing a partial
+    plist: the data is written and synced to a temporary file in the same
+    directory, given the original's permissions and renamed over it
     """
-    plist_file = get_file_handle(filename, mode='w')
+    directory = os.path.dirname(filename) or '.'
     try:
-        plist_file.writelines(file_data)
+        status = os.stat(filename)
+        handle, temp_name = tempfile.mkstemp(
+            dir=directory, prefix='.%s.' % os.path.basename(filename))
+    except OSError:
+        sys.exit('Cannot Create File: %s' % filename)
 
-    except IOError:
+    try:
+        try:
+            os.write(handle, file_data)
+            os.fsync(handle)
+        finally:
+            os.close(handle)
+        os.chmod(temp_name, status.st_mode & 0o7777)
+        os.chown(temp_name, status.st_uid, status.st_gid)
+        os.rename(temp_name, filename)
+    except OSError:
+        os.remove(temp_name)
         sys.exit('Cannot Create File: %s' % filename)
 
+    # the rename itself is only durable once the directory is synced
+    directory_handle = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_handle)
     finally:
-        plist_file.close()
-        print 'file written to disk: %s' % filename
+        os.close(directory_handle)
+    print 'file written to disk: %s' % filename
 
 
 def main():
     """
-    Attempts to safely add an integer to an array within a plist
+    Attempts to safely add integers to an array within a plist
     and then restarts the plist
     """
     # Exit if not executed wtih root permissions
     check_root()
 
-    # was an option specified?
-    option_code = get_argv() or DEFAULT_OPTION_CODE
+    # were options specified?
+    option_codes = get_argv()
 
     # filename is default
     filename = FILE
 
-    # parse the existing plist file and get the control keys
-    new_file_data, file_needs_change = process_plist_file(filename, get_argv())
+    # parse the existing plist file once for every option
+    new_file_data, added_codes = process_plist_file(filename, option_codes)
 
-    # only write out a new file if the option wasnt already present
-    if file_needs_change:
-        if new_file_data:
-            write_plist_file(filename, new_file_data)
-            print 'Reboot to have DHCP requests with option %s' % option_code
+    # only write out a new file if an option wasnt already present
+    if added_codes:
+        write_plist_file(filename, new_file_data)
+        print 'Reboot to have DHCP requests with options %s' % ', '.join(
+            str(option_code) for option_code in added_codes)
+    else:
+        print 'options already requested, %s not changed' % filename
 
 
 if __name__ == "__main__":
@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for dhcp_121.py
+
+    startup:
+        Launches fresh interpreters that import dhcp_121 and make its first
+        decision (the check_version release comparison), reporting the time
+        from the start of the import to the decision.  It fails when the
+        median exceeds the budget or regresses against a saved baseline,
+        or when a deferred module was loaded on the way.
+
+    hotpaths:
+        Times the parsing and decision functions of dhcp_121 against
+        synthetic fixtures: getpacket dumps with 1 to 10,000 option 121
+        routes and netstat tables with 10 to 1,000,000 entries.  Each case
+        runs in a forked child and reports its throughput, per call latency
+        percentiles and peak memory growth, and fails when it regresses
+        against a saved baseline.
+
+Run from the directory holding dhcp_121.py, for example:
+    python benchmark_dhcp_121.py startup --runs 30 --save startup.json
+    python benchmark_dhcp_121.py startup --baseline startup.json
+    python benchmark_dhcp_121.py hotpaths --save hotpaths.json
+    python benchmark_dhcp_121.py hotpaths --table-sizes 1000000 \\
+        --function get_route_table_with_masks --baseline hotpaths.json
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that dhcp_121 imports only in the code paths that use them, none
+# of them may be loaded by the time the first decision is made
+DEFERRED_MODULES = ['collections', 'hashlib', 'json', 'pkg_resources',
+                    'platform', 'select', 'socket', 'struct', 'subprocess',
+                    'tempfile']
+
+# Ran in a fresh interpreter: prints the seconds from the start of the
+# import to the first decision and the deferred modules that got loaded
+STARTUP_PROBE = '''
+import os, sys, time
+start = time.time()
+import dhcp_121
+supported = dhcp_121.parse_release(os.uname()[2]) < \\
+    dhcp_121.parse_release(dhcp_121.UNSUPPORTED_RELEASE)
+elapsed = time.time() - start
+print('%%r %%s' %% (elapsed, ','.join(
+    name for name in %r if name in sys.modules)))
+''' % DEFERRED_MODULES
+
+# The default budget for the median import to first decision time
+STARTUP_BUDGET_MS = 50.0
+
+# A run regresses when its median exceeds the baseline median by this ratio
+REGRESSION_TOLERANCE = 0.25
+
+# The hot path functions and the fixture each is measured against, see
+# get_hotpath_cases
+HOTPATH_FUNCTIONS = ['DhcpPacket', 'decode_option_121', 'get_option',
+                     'get_reachable_gateways', 'get_route_table_with_masks',
+                     'get_ipv4_routes', 'ip_address_to_32bit',
+                     'subnet_check']
+PACKET_SIZES = [1, 10, 100, 1000, 10000]
+TABLE_SIZES = [10, 1000, 100000, 1000000]
+ADDRESS_COUNT = 10000
+INTERFACE_ADDRESS_COUNT = 64
+
+# Each case is called up to HOTPATH_REPEAT times, stopping early once
+# HOTPATH_SECONDS have been spent on it
+HOTPATH_REPEAT = 50
+HOTPATH_SECONDS = 2.0
+
+# The fixtures are reproducible between runs
+FIXTURE_SEED = 121
+
+
+def add_baseline_arguments(parser):
+    """
+    Adds the options shared by every benchmark for JSON baselines
+    """
+    parser.add_argument('--baseline',
+                        help='a saved JSON result to check for regressions')
+    parser.add_argument('--tolerance', type=float,
+                        default=REGRESSION_TOLERANCE,
+                        help='allowed slowdown against the baseline')
+    parser.add_argument('--save', help='write the results as JSON here')
+
+
+def check_regression(name, value, baseline, tolerance):
+    """
+    Compares a measurement with its baseline value
+
+    Returns an error string when the value regressed, otherwise ''
+    """
+    if baseline and value > baseline * (1 + tolerance):
+        return '%s regressed: %.3f against a baseline of %.3f' % (
+            name, value, baseline)
+    return ''
+
+
+def get_argv(argv=None):
+    """
+    Returns the parsed command line options
+    """
+    parser = argparse.ArgumentParser(description='Benchmark dhcp_121.py')
+    commands = parser.add_subparsers(dest='command')
+
+    startup = commands.add_parser(
+        'startup', help='time the import to first decision path')
+    startup.add_argument('--runs', type=int, default=20,
+                         help='fresh interpreters to launch')
+    startup.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS,
+                         help='fail when the median exceeds this')
+    add_baseline_arguments(startup)
+
+    hotpaths = commands.add_parser(
+        'hotpaths', help='time the parsing and decision functions')
+    hotpaths.add_argument('--function', action='append',
+                          choices=HOTPATH_FUNCTIONS,
+                          help='only benchmark this function (repeatable)')
+    hotpaths.add_argument('--packet-sizes', type=parse_sizes,
+                          default=PACKET_SIZES,
+                          help='option 121 route counts, comma separated')
+    hotpaths.add_argument('--table-sizes', type=parse_sizes,
+                          default=TABLE_SIZES,
+                          help='netstat entry counts, comma separated')
+    hotpaths.add_argument('--repeat', type=int, default=HOTPATH_REPEAT,
+                          help='calls per case')
+    add_baseline_arguments(hotpaths)
+    return parser.parse_args(argv)
+
+
+def get_hotpath_cases(options):
+    """
+    Builds the benchmark cases for the requested functions and sizes
+
+    Returns a list of (case name, items per call, function) tuples, the
+    function taking no arguments.  The fixtures are built here, before
+    any case is measured.
+    """
+    sys.path.insert(0, HERE)
+    import dhcp_121
+
+    functions = options.function or HOTPATH_FUNCTIONS
+    cases = []
+    # a host with many addresses, the routes' gateways are in 192.168/16
+    interface_addresses = [(address, 24, None) for address in
+                           make_addresses(INTERFACE_ADDRESS_COUNT)]
+    interface_addresses.append(('192.168.0.50', 16, None))
+    for size in options.packet_sizes:
+        packet = make_getpacket(dhcp_121, size)
+        option_data = dhcp_121.get_option(packet, 'option_121')
+        if 'get_option' in functions:
+            cases.append(('get_option/%d_routes' % size, size,
+                          lambda packet=packet:
+                          dhcp_121.get_option(packet, 'option_121')))
+        if 'decode_option_121' in functions:
+            cases.append(('decode_option_121/%d_routes' % size, size,
+                          lambda option_data=option_data:
+                          dhcp_121.decode_option_121(option_data)))
+        if 'get_reachable_gateways' in functions:
+            gateways = [route.gateway for route in
+                        dhcp_121.decode_option_121(option_data)]
+            cases.append(('get_reachable_gateways/%d_routes' % size, size,
+                          lambda gateways=gateways:
+                          dhcp_121.get_reachable_gateways(
+                              gateways, interface_addresses)))
+        if 'DhcpPacket' in functions:
+            # one packet per call, the throughput is in packets
+            wire = dhcp_121.getpacket_to_bytes(packet)
+            cases.append(('DhcpPacket/%d_routes' % size, 1,
+                          lambda wire=wire: dhcp_121.DhcpPacket(wire).get(
+                              dhcp_121.DHCP_CLASSLESS_ROUTES)))
+
+    for size in options.table_sizes:
+        if 'get_route_table_with_masks' not in functions and \
+                'get_ipv4_routes' not in functions:
+            break
+        table = make_netstat(size)
+        if 'get_route_table_with_masks' in functions:
+            cases.append(('get_route_table_with_masks/%d_entries' % size,
+                          size, lambda table=table:
+                          dhcp_121.get_route_table_with_masks(table)))
+        if 'get_ipv4_routes' in functions:
+            split_table = [line.split() for line in table.splitlines()]
+            cases.append(('get_ipv4_routes/%d_entries' % size, size,
+                          lambda split_table=split_table:
+                          dhcp_121.get_ipv4_routes(split_table)))
+
+    addresses = make_addresses(ADDRESS_COUNT)
+    if 'ip_address_to_32bit' in functions:
+        def to_32bit():
+            for address in addresses:
+                dhcp_121.ip_address_to_32bit(address)
+        cases.append(('ip_address_to_32bit/%d_addresses' % len(addresses),
+                      len(addresses), to_32bit))
+    if 'subnet_check' in functions:
+        def check_subnets():
+            for address in addresses:
+                dhcp_121.subnet_check(16, '10.1.0.1', address)
+        cases.append(('subnet_check/%d_addresses' % len(addresses),
+                      len(addresses), check_subnets))
+    return cases
+
+
+def load_json(filename):
+    """
+    Returns the decoded contents of a JSON file
+    """
+    file_handle = open(filename)
+    try:
+        return json.load(file_handle)
+    finally:
+        file_handle.close()
+
+
+def make_addresses(count):
+    """
+    Returns count random dotted quad addresses
+    """
+    generator = random.Random(FIXTURE_SEED)
+    return ['%d.%d.%d.%d' % tuple(generator.randint(0, 255) for _ in '1234')
+            for _ in range(count)]
+
+
+def make_getpacket(dhcp_121, route_count):
+    """
+    Returns 'ipconfig getpacket' output carrying route_count random option
+    121 routes, the option split over as many instances as RFC 3396 needs
+    """
+    generator = random.Random(FIXTURE_SEED)
+    routes = []
+    for _ in range(route_count):
+        prefixlen = generator.randint(8, 32)
+        network = generator.getrandbits(32) & \
+            dhcp_121.PREFIX_MASKS[prefixlen]
+        routes.append((network, prefixlen,
+                       0xc0a80000 | generator.getrandbits(16)))
+    payload = dhcp_121.encode_option_121(routes)
+
+    lines = ['op = BOOTREPLY', 'htype = 1', 'hlen = 6', 'hops = 0',
+             'xid = 0x5e1f0a2b', 'secs = 0', 'flags = 0',
+             'ciaddr = 0.0.0.0', 'yiaddr = 192.168.0.50',
+             'siaddr = 192.168.0.1', 'giaddr = 0.0.0.0',
+             'chaddr = 0:11:22:33:44:55', 'sname = ', 'file = ',
+             'options:', 'Options count is %d' % ((len(payload) + 254) // 255
+                                                  + 5),
+             'dhcp_message_type (uint8): ACK 0x5',
+             'server_identifier (ip): 192.168.0.1',
+             'lease_time (uint32): 0x15180',
+             'subnet_mask (ip): 255.255.255.0',
+             'router (ip_mult): {192.168.0.1}']
+    for offset in range(0, len(payload), 255):
+        lines.append('option_121 (opaque):')
+        lines.extend(dhcp_121.bytes_to_hexdump(payload[offset:offset + 255]))
+        lines.append('')
+    lines.append('end (none):')
+    return '\n'.join(lines) + '\n'
+
+
+def make_netstat(entry_count):
+    """
+    Returns 'netstat -f inet -rn' output with entry_count routes in the
+    shapes macOS prints: classful and slash notation networks, host
+    routes, link routes and a default route
+    """
+    generator = random.Random(FIXTURE_SEED)
+    lines = ['Routing tables', '', 'Internet:',
+             'Destination        Gateway            Flags        Refs'
+             '      Use   Netif Expire',
+             'default            192.168.0.1        UGSc           25'
+             '        0     en1']
+    for index in range(entry_count - 1):
+        octets = [generator.randint(1, 223), generator.randint(0, 255),
+                  generator.randint(0, 255), generator.randint(1, 254)]
+        gateway = '192.168.%d.%d' % (generator.randint(0, 3),
+                                     generator.randint(1, 254))
+        shape = index % 4
+        if shape == 0:
+            destination = '%d.%d.%d/24' % tuple(octets[:3])
+            flags = 'UGSc'
+        elif shape == 1:
+            destination = '%d.%d.%d.%d' % tuple(octets)
+            flags = 'UGHS'
+        elif shape == 2:
+            destination = '%d.%d' % tuple(octets[:2])
+            flags = 'UGSc'
+        else:
+            destination = '%d.%d.%d' % tuple(octets[:3])
+            gateway = 'link#%d' % generator.randint(4, 12)
+            flags = 'UCS'
+        lines.append('%-18s %-18s %-10s %6d %8d %7s' % (
+            destination, gateway, flags, 0, 0, 'en%d' % (index % 3)))
+    return '\n'.join(lines) + '\n'
+
+
+def measure_case(function, items, repeat):
+    """
+    Calls the function up to repeat times (or for HOTPATH_SECONDS)
+
+    Returns a dictionary of the latency percentiles in milliseconds,
+    the throughput in items per second and the peak memory growth in
+    kilobytes
+    """
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies = []
+    deadline = time.time() + HOTPATH_SECONDS
+    while len(latencies) < repeat:
+        start = time.time()
+        function()
+        latencies.append(time.time() - start)
+        if time.time() > deadline and len(latencies) >= 3:
+            break
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        peak = peak // 1024
+    median = percentile(latencies, 0.5)
+    return {'calls': len(latencies),
+            'p50_ms': median * 1000,
+            'p90_ms': percentile(latencies, 0.9) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'items_per_second': items / median if median else 0.0,
+            'peak_kb': peak}
+
+
+def parse_sizes(value):
+    """
+    Returns the list of integers in a comma separated string
+    """
+    return [int(size) for size in value.split(',') if size.strip()]
+
+
+def percentile(values, fraction):
+    """
+    Returns the value at the fraction (0 to 1) of the sorted values
+    """
+    values = sorted(values)
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def run_case(function, items, repeat):
+    """
+    Measures a case in a forked child, so that its peak memory is its own
+    and the garbage of earlier cases doesnt affect it
+
+    Returns the measurement dictionary from measure_case
+    """
+    if not hasattr(os, 'fork'):
+        return measure_case(function, items, repeat)
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_end)
+        try:
+            try:
+                result = measure_case(function, items, repeat)
+            except Exception as error:
+                result = {'error': '%s: %s' % (type(error).__name__, error)}
+            os.write(write_end, json.dumps(result).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    chunks = []
+    while True:
+        chunk = os.read(read_end, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return json.loads(b''.join(chunks).decode('ascii'))
+
+
+def run_hotpaths(options):
+    """
+    Measures every hot path case
+
+    Returns a list of failure messages, empty when the benchmark passed
+    """
+    baseline = {}
+    if options.baseline:
+        baseline = load_json(options.baseline).get('hotpaths', {})
+
+    results = {}
+    failures = []
+    print '%-44s %7s %10s %10s %10s %14s %10s' % (
+        'case', 'calls', 'p50 ms', 'p90 ms', 'p99 ms', 'items/s', 'peak KB')
+    for name, items, function in get_hotpath_cases(options):
+        result = run_case(function, items, options.repeat)
+        if 'error' in result:
+            failures.append('%s failed: %s' % (name, result['error']))
+            continue
+        results[name] = result
+        print '%-44s %7d %10.3f %10.3f %10.3f %14.0f %10d' % (
+            name, result['calls'], result['p50_ms'], result['p90_ms'],
+            result['p99_ms'], result['items_per_second'], result['peak_kb'])
+        failure = check_regression('%s p50 (ms)' % name, result['p50_ms'],
+                                   baseline.get(name, {}).get('p50_ms'),
+                                   options.tolerance)
+        if failure:
+            failures.append(failure)
+
+    if options.save:
+        save_json(options.save, {'hotpaths': results})
+    return failures
+
+
+def run_startup(options):
+    """
+    Times the import to first decision path in fresh interpreters
+
+    Returns a list of failure messages, empty when the benchmark passed
+    """
+    timings = []
+    failures = []
+    for _ in range(options.runs):
+        p = subprocess.Popen([sys.executable, '-c', STARTUP_PROBE], cwd=HERE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode:
+            return ['probe failed: %s' % stderr.strip()]
+        elapsed, loaded = (stdout.strip().split(' ', 1) + [''])[:2]
+        timings.append(float(elapsed) * 1000)
+        if loaded and not failures:
+            failures.append('deferred modules loaded at startup: %s' % loaded)
+
+    results = {'startup_ms': {'p50': percentile(timings, 0.5),
+                              'p90': percentile(timings, 0.9),
+                              'min': min(timings),
+                              'max': max(timings)}}
+    print 'import to first decision over %d runs:' % options.runs
+    for name in ('min', 'p50', 'p90', 'max'):
+        print '  %-4s %8.2f ms' % (name, results['startup_ms'][name])
+
+    median = results['startup_ms']['p50']
+    if median > options.budget_ms:
+        failures.append('median %.2f ms is over the %.2f ms budget'
+                        % (median, options.budget_ms))
+    if options.baseline:
+        baseline = load_json(options.baseline).get('startup_ms', {})
+        failure = check_regression('startup p50 (ms)', median,
+                                   baseline.get('p50'), options.tolerance)
+        if failure:
+            failures.append(failure)
+    if options.save:
+        save_json(options.save, results)
+    return failures
+
+
+def save_json(filename, data):
+    """
+    Writes data to a JSON file
+    """
+    file_handle = open(filename, 'w')
+    try:
+        json.dump(data, file_handle, indent=2, sort_keys=True)
+    finally:
+        file_handle.close()
+    print 'results written to: %s' % filename
+
+
+def main():
+    """
+    Runs the requested benchmark and exits non-zero on a failure
+    """
+    options = get_argv()
+    if options.command == 'hotpaths':
+        failures = run_hotpaths(options)
+    else:
+        failures = run_startup(options)
+    for failure in failures:
+        print 'FAIL: %s' % failure
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,17 +13,16 @@
     DHCP request, see the add_dhcp_request_option.py section of the readme
 
 """
+import binascii
+import errno
 import os
-import platform
 import re
-import socket
-import struct
-import subprocess
 import sys
+import time
 
-# pkg_resources depends on at least one of the above imports
-# so import it afterwards
-import pkg_resources
+# Imports that take a noticeable share of the startup time (subprocess,
+# socket, struct, json, ...) are made in the functions that use them, so
+# a run only pays for the code paths it takes.
 
 # OVERRIDE_FILE:
 # The override file can contain comments if the line starts with a #, but
@@ -38,8 +37,10 @@ import pkg_resources
 # The override works with these variables:
 #
 # nic:
-#     The DHCP nic is autodiscovered by way of default route.  The nic
-#     detected can be ignored in favor of the nic set via the override.
+#     Every interface with a DHCP lease has its option 121 routes set.
+#     When two of them route the same prefix, the nic set via the
+#     override wins, then the nic with the default route, then the
+#     first by name.
 #     nic = en1
 #
 # gatewaycheck:
@@ -66,8 +67,1907 @@ import pkg_resources
 #     isn't reachable, disable the gatewaycheck (see gatewaycheck above)
 #     The final route doesnt require the semicolon, other routes do.
 #     forceroutes = "10.0.1.0/24 192.168.1.254; 10.0.2.0/25 192.168.1.253"
+#
+# backend:
+#     Routes are programmed through the kernel routing socket when it can
+#     be opened, otherwise with the route command.  The route command can
+#     be forced by setting the backend to subprocess:
+#     backend = subprocess
+#
+# aggregate:
+#     Sibling routes with the same gateway are merged into their parent and
+#     routes within a less specific route with the same gateway are left
+#     out, as long as every address is still routed the same way.  This
+#     is disabled by default, enable it by setting aggregate to 1:
+#     aggregate = 1
+#
+# metrics_file:
+#     Write the counts of every run (durations, commands spawned, routes
+#     decoded, added, changed, deleted and skipped per interface) to this
+#     file in the Prometheus text format, for node_exporter's textfile
+#     collector:
+#     metrics_file = /usr/local/var/node_exporter/dhcp_121.prom
 OVERRIDE_FILE = '/usr/local/etc/dhcp_121_override'
 
+# The Darwin kernel release of El Capitan 10.11.6, which decodes DHCP option
+# 121 natively, see check_version
+UNSUPPORTED_RELEASE = '15.6.0'
+
+# A line of "ipconfig getpacket" option hexdump: an offset, then up to 16
+# bytes in two groups of eight, then the byte count dots.  The capture group
+# starts at the first data byte.
+HEXDUMP_LINE = re.compile(r'^\s*[0-9a-fA-F]{4,}  (.*)$')
+HEX_BYTE = re.compile(r'[0-9a-fA-F]{2}')
+
+# The "ipconfig getpacket" lines that start an option, such as
+# "router (ip_mult): {192.168.0.1}" or "option_121 (opaque):", and the
+# header lines before them, such as "yiaddr = 192.168.0.50"
+GETPACKET_OPTION = re.compile(r'^(\w+) \((\w+)\):\s*(.*)$')
+GETPACKET_FIELD = re.compile(r'^(\w+) = ?(.*)$')
+
+# The reason a route operation failed, at the end of its route command
+# style report, such as "add net 10.0.0.0: gateway 192.168.0.1: File exists"
+ROUTE_REPORT_ERROR = re.compile(r'gateway [^:\s]+: (.*\S)')
+
+# A netstat gateway column holding an IPv4 address, rather than a link or
+# hardware address
+NETSTAT_GATEWAY = re.compile(r'\d+\.\d+\.\d+\.\d+')
+
+# The BOOTP header (RFC 951) of a DHCP packet: op, htype, hlen, hops, xid,
+# secs, flags, ciaddr, yiaddr, siaddr, giaddr, chaddr, sname and file,
+# followed by the DHCP magic cookie and the options (RFC 2131)
+BOOTP_HEADER = '!BBBBIHH4s4s4s4s16s64s128s'
+BOOTP_HEADER_SIZE = 236
+DHCP_MAGIC_COOKIE = '\x63\x82\x53\x63'
+
+# DHCP option codes (RFC 2132, RFC 3442).  249 is the classless static
+# route option of Microsoft clients, the same format as 121.
+DHCP_PAD = 0
+DHCP_ROUTER = 3
+DHCP_STATIC_ROUTES = 33
+DHCP_LEASE_TIME = 51
+DHCP_OVERLOAD = 52
+DHCP_MESSAGE_TYPE = 53
+DHCP_CLASSLESS_ROUTES = 121
+DHCP_MS_CLASSLESS_ROUTES = 249
+DHCP_END = 255
+
+# The option codes of the names getpacket gives options, any other option
+# is shown as option_<code>
+GETPACKET_OPTION_CODES = {
+    'subnet_mask': 1,
+    'router': DHCP_ROUTER,
+    'domain_name_server': 6,
+    'host_name': 12,
+    'domain_name': 15,
+    'static_routes': DHCP_STATIC_ROUTES,
+    'vendor_specific': 43,
+    'lease_time': DHCP_LEASE_TIME,
+    'dhcp_message_type': DHCP_MESSAGE_TYPE,
+    'server_identifier': 54,
+    'renewal_t1_time_value': 58,
+    'rebinding_t2_time_value': 59,
+}
+
+# Netmask for every prefix length, indexed by the length in bits
+PREFIX_MASKS = [(0xFFFFFFFF << (32 - bits)) & 0xFFFFFFFF
+                for bits in range(33)]
+
+
+# STATE_FILE records the last applied routes and a hash of everything they
+# were derived from.  A run whose inputs hash the same, and whose recorded
+# routes are all still in the routing table, has nothing to do and exits
+# early.  Records older than STATE_MAX_AGE seconds are discarded.
+STATE_FILE = '/var/run/dhcp_121.state'
+STATE_MAX_AGE = 86400
+
+# Only one run changes routes at a time: it holds an flock on LOCK_FILE.
+# A run started meanwhile (the plist watches three resolv.conf paths, so a
+# DHCP renewal starts several) creates DIRTY_FILE and exits, and the
+# running one makes one more pass for all of them once it is done, see
+# run_single_flight.
+LOCK_FILE = '/var/run/dhcp_121.lock'
+DIRTY_FILE = '/var/run/dhcp_121.dirty'
+
+# The daemon (--daemon) waits for routing socket events and checks the
+# files the launchd plist watches every DAEMON_WATCH_INTERVAL seconds.
+# Events arriving within DAEMON_DEBOUNCE seconds of each other are handled
+# by one reconcile pass.
+WATCH_PATHS = ['/etc/resolv.conf', '/var/run/resolv.conf',
+               '/private/var/run/resolv.conf']
+DAEMON_DEBOUNCE = 1.0
+DAEMON_WATCH_INTERVAL = 5.0
+
+# Route programming backends by name, see get_route_backend.  A backend can
+# be chosen in the override file, for example:
+#     backend = subprocess
+ROUTE_BACKENDS = {}
+
+# Every interface that may hold a DHCP lease is read and reconciled, with
+# up to LEASE_WORKERS of them handled at the same time, see run_parallel
+LEASE_WORKERS = 4
+
+# Route operations of different prefixes are applied with up to
+# ROUTE_WORKERS at the same time when the backend is concurrent (one route
+# process each), see apply_operations
+ROUTE_WORKERS = 8
+
+# Every system command (ipconfig, netstat, ifconfig, networksetup and route)
+# goes through the command runner in COMMAND_RUNNER, see run_command.  The
+# --record and --replay options swap in runners that capture the command
+# outputs to, or serve them from, a fixture directory.
+COMMAND_RUNNER = None
+
+# A command still running after COMMAND_TIMEOUT seconds is killed, and at
+# most COMMAND_CONCURRENCY commands run at the same time, however many
+# threads ask for them (see CommandRunner)
+COMMAND_TIMEOUT = 15.0
+COMMAND_CONCURRENCY = 8
+
+# Gateway reachability is checked with NumPy, when it is installed, for
+# route sets of REACHABILITY_NUMPY_MIN routes or more, see
+# get_reachable_gateways.  Importing NumPy takes longer than checking a
+# few routes without it.
+REACHABILITY_NUMPY_MIN = 512
+
+# Routes refer to their interface by an index into INTERFACE_NAMES, see
+# get_ifindex.  Index 0 is no interface.
+INTERFACE_NAMES = ['']
+INTERFACE_INDEXES = {'': 0}
+
+# The routing table is read once per run and shared by every reader as
+# ROUTE_SNAPSHOT, see get_route_snapshot.  Writing a route discards it.
+ROUTE_SNAPSHOT = None
+
+# The daemon reads the routing table from ROUTE_MIRROR instead, a
+# RouteMirror loaded once and then kept up to date from the kernel's route
+# messages.  Every ROUTE_MIRROR_RESYNC seconds it is checked against a
+# fresh dump of the routing table.
+ROUTE_MIRROR = None
+ROUTE_MIRROR_RESYNC = 300.0
+
+# Tracing (--trace) times each phase of a run as a span, with the commands
+# ran in a phase as its child spans.  Every finished span is written as a
+# JSON line to a file, or to a unix socket given as unix:/path/to/socket.
+# TRACER is None when tracing is off, trace_span then hands out NULL_SPAN.
+TRACER = None
+
+# Run metrics are written for node_exporter's textfile collector when the
+# override file sets metrics_file, for example:
+#     metrics_file = /usr/local/var/node_exporter/dhcp_121.prom
+# The file is rewritten after every pass, its counters carried over from
+# the previous file.  METRICS is None when metrics are off, count_metric
+# then does nothing.
+METRICS = None
+METRIC_FAMILIES = [
+    ('dhcp_121_runs_total', 'counter',
+     'Reconcile passes by result'),
+    ('dhcp_121_run_duration_seconds', 'histogram',
+     'Duration of the reconcile passes'),
+    ('dhcp_121_last_success_timestamp_seconds', 'gauge',
+     'Unix time of the last successful pass, per leased interface'),
+    ('dhcp_121_command_spawns_total', 'counter',
+     'System commands ran, by command'),
+    ('dhcp_121_command_seconds_total', 'counter',
+     'Seconds spent in system commands, by command'),
+    ('dhcp_121_routes_decoded_total', 'counter',
+     'Option 121 routes decoded from DHCP packets'),
+    ('dhcp_121_route_operations_total', 'counter',
+     'Route adds, changes and deletes attempted'),
+    ('dhcp_121_route_failures_total', 'counter',
+     'Route adds, changes and deletes that failed'),
+    ('dhcp_121_routes_skipped_total', 'counter',
+     'Desired routes left alone, by reason'),
+]
+# Every pass of a run that changes routes is appended to JOURNAL_FILE as a
+# binary record (see Journal): its start time, duration, the duration of
+# each of the JOURNAL_PHASES, and per interface a hash of its decoded
+# routes and the route operations made.  Once the journal would grow past
+# JOURNAL_MAX_BYTES it is moved to JOURNAL_FILE.1, replacing the previous
+# one.  dhcp_121.py --journal-report summarizes both.
+JOURNAL = None
+JOURNAL_FILE = '/var/log/dhcp_121.journal'
+JOURNAL_MAX_BYTES = 1024 * 1024
+JOURNAL_VERSION = 1
+JOURNAL_PHASES = ['override', 'discover_nic', 'get_packet', 'state_cache',
+                  'clear_routes', 'reconcile_interfaces']
+JOURNAL_VERBS = ['add', 'change', 'delete']
+JOURNAL_FAILED = 0x80
+
+RUN_DURATION_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+METRIC_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+
+# PF_ROUTE (BSD routing socket) message constants from <net/route.h>.
+# RT_MSGHDR is the macOS struct rt_msghdr, ending in the 14 fields of
+# struct rt_metrics.
+PF_ROUTE = 17
+RTM_VERSION = 5
+RTM_ADD = 0x1
+RTM_DELETE = 0x2
+RTM_CHANGE = 0x3
+RTM_GET = 0x4
+RTM_NEWADDR = 0xc
+RTM_DELADDR = 0xd
+RTM_IFINFO = 0xe
+RTF_UP = 0x1
+RTF_GATEWAY = 0x2
+RTF_HOST = 0x4
+RTF_LLINFO = 0x400
+RTF_STATIC = 0x800
+RTF_WASCLONED = 0x20000
+RTF_IFSCOPE = 0x1000000
+RTA_DST = 0x1
+RTA_GATEWAY = 0x2
+RTA_NETMASK = 0x4
+RT_MSGHDR = '=HBBHxxiiiiiiI14I'
+RT_MSGHDR_SIZE = 92
+# sysctl(3) name of the routing table dump, CTL_NET PF_ROUTE 0 AF_INET
+# NET_RT_DUMP 0
+CTL_NET = 4
+NET_RT_DUMP = 1
+
+# rtnetlink (Linux) message constants from <linux/netlink.h> and
+# <linux/rtnetlink.h>
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR_NETLINK = 20
+RTM_DELADDR_NETLINK = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RT_TABLE_MAIN = 254
+RTPROT_STATIC = 4
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST = 1
+RTM_F_CLONED = 0x200
+NETLINK_RTA_DST = 1
+NETLINK_RTA_OIF = 4
+NETLINK_RTA_GATEWAY = 5
+NETLINK_RTA_TABLE = 15
+
+# Interface flags from <net/if.h>, the same values on macOS and Linux
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+IFF_LOOPBACK = 0x8
+IFF_RUNNING = 0x40
+
+# SIOCGIFMEDIA reads the macOS struct ifmediareq, whose ifm_status holds the
+# IFM_AVALID (link state known) and IFM_ACTIVE (link up) bits
+SIOCGIFMEDIA = 0xc0306938
+IFMEDIAREQ = '=16siiiii4xQ'
+IFM_AVALID = 0x1
+IFM_ACTIVE = 0x2
+
+
+class CommandRunner(object):
+    """
+    Runs system commands, keeping the command and duration of every spawn
+
+    The spawns are kept in the calls attribute as (command, seconds)
+    tuples.  native is False for runners that record or replay, where the
+    getifaddrs inventory, routing sockets and state cache are bypassed so
+    that every input and route operation is a command of the runner.
+
+    Commands can be ran from several threads, up to COMMAND_CONCURRENCY
+    of them at a time, the others wait for a slot.  A command is killed
+    once it has ran for COMMAND_TIMEOUT seconds and raises OSError
+    ETIMEDOUT, its partial output is never returned.
+    """
+    native = True
+
+    def __init__(self):
+        import threading
+        self.calls = []
+        self.slots = threading.BoundedSemaphore(COMMAND_CONCURRENCY)
+
+    def __call__(self, cmd):
+        start = time.time()
+        try:
+            with self.slots:
+                with trace_span('command', cmd=cmd):
+                    return self.execute(cmd)
+        finally:
+            self.calls.append((cmd, time.time() - start))
+
+    def execute(self, cmd):
+        """
+        Returns the standard output of cmd
+        """
+        import subprocess
+        p = subprocess.Popen(cmd.split(), stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        timer = self.start_timeout(p, cmd)
+        try:
+            stdout, stderr = p.communicate()
+        finally:
+            timer.cancel()
+        if timer.expired.is_set():
+            raise OSError(errno.ETIMEDOUT, '%s timed out after %gs'
+                          % (cmd, COMMAND_TIMEOUT))
+        return stdout
+
+    def execute_lines(self, cmd):
+        """
+        Yields the standard output lines of cmd as the command writes them
+        """
+        import subprocess
+        devnull = open(os.devnull, 'r+')
+        try:
+            p = subprocess.Popen(cmd.split(), stdin=devnull,
+                                 stdout=subprocess.PIPE, stderr=devnull)
+            timer = self.start_timeout(p, cmd)
+            try:
+                for line in p.stdout:
+                    yield line
+            finally:
+                timer.cancel()
+                p.stdout.close()
+                p.wait()
+        finally:
+            devnull.close()
+        if timer.expired.is_set():
+            raise OSError(errno.ETIMEDOUT, '%s timed out after %gs'
+                          % (cmd, COMMAND_TIMEOUT))
+
+    def start_timeout(self, process, cmd):
+        """
+        Returns a started timer that kills the process once it has ran for
+        COMMAND_TIMEOUT seconds, cancel it when the process is done.  The
+        timer's expired Event is set when it killed the process.
+        """
+        import threading
+
+        def kill():
+            try:
+                process.kill()
+            except OSError:
+                # it exited in the meantime
+                return
+            timer.expired.set()
+            print '[COMMAND] killed after %gs: %s' % (COMMAND_TIMEOUT, cmd)
+
+        timer = threading.Timer(COMMAND_TIMEOUT, kill)
+        timer.expired = threading.Event()
+        timer.start()
+        return timer
+
+    def stream(self, cmd):
+        """
+        Yields the standard output of cmd line by line, without holding
+        the whole output, counted and timed like a call of the runner
+        """
+        start = time.time()
+        try:
+            with self.slots:
+                with trace_span('command', cmd=cmd):
+                    for line in self.execute_lines(cmd):
+                        yield line
+        finally:
+            self.calls.append((cmd, time.time() - start))
+
+    def summary(self):
+        """
+        Returns a one line account of the spawns, by command name
+        """
+        counts = {}
+        for cmd, seconds in self.calls:
+            name = os.path.basename(cmd.split()[0])
+            counts[name] = counts.get(name, 0) + 1
+        return '%d spawned in %.3fs: %s' % (
+            len(self.calls), sum(seconds for cmd, seconds in self.calls),
+            ', '.join('%s %d' % item for item in sorted(counts.items())))
+
+
+class RecordingRunner(CommandRunner):
+    """
+    Runs commands and saves each output in fixture_dir for a ReplayRunner
+
+    A command's first output is saved as <command>.out and later outputs of
+    the same command as <command>.2.out, <command>.3.out and so on, see
+    get_fixture_name.
+    """
+    native = False
+
+    def __init__(self, fixture_dir):
+        import threading
+        CommandRunner.__init__(self)
+        self.fixture_dir = fixture_dir
+        self.sequence = {}
+        self.lock = threading.Lock()
+        if not os.path.isdir(fixture_dir):
+            os.makedirs(fixture_dir)
+
+    def execute(self, cmd):
+        stdout = CommandRunner.execute(self, cmd)
+        with self.lock:
+            count = self.sequence[cmd] = self.sequence.get(cmd, 0) + 1
+        write_file_atomically(
+            os.path.join(self.fixture_dir, get_fixture_name(cmd, count)),
+            stdout)
+        return stdout
+
+    def execute_lines(self, cmd):
+        return iter(self.execute(cmd).splitlines(True))
+
+
+class ReplayRunner(CommandRunner):
+    """
+    Serves command outputs from a fixture_dir written by a RecordingRunner,
+    nothing is ran
+
+    latency:
+        seconds to sleep per command, to reproduce slow systems
+
+    Outputs are served in the order they were recorded, once a command's
+    recordings are used up its last one is repeated.  Commands without a
+    fixture return no output.
+    """
+    native = False
+
+    def __init__(self, fixture_dir, latency=0.0):
+        import threading
+        CommandRunner.__init__(self)
+        self.fixture_dir = fixture_dir
+        self.latency = latency
+        self.sequence = {}
+        self.lock = threading.Lock()
+
+    def execute(self, cmd):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            count = self.sequence[cmd] = self.sequence.get(cmd, 0) + 1
+        for number in range(count, 0, -1):
+            filename = os.path.join(self.fixture_dir,
+                                    get_fixture_name(cmd, number))
+            if os.path.exists(filename):
+                with open(filename, 'rb') as fixture:
+                    return fixture.read()
+        print '[REPLAY] no fixture for %s' % cmd
+        return ''
+
+    def execute_lines(self, cmd):
+        return iter(self.execute(cmd).splitlines(True))
+
+
+class TraceSpan(object):
+    """
+    A timed phase of a run, used as a context manager, see trace_span
+
+    The span is written by its tracer when the with block ends.  While a
+    Journal is kept, the span is timed for it even without a tracer.  A
+    span without either (NULL_SPAN) does nothing.
+    """
+    __slots__ = ('tracer', 'name', 'attributes', 'span_id', 'parent_id',
+                 'start')
+
+    def __init__(self, tracer, name, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span_id = None
+        self.parent_id = None
+        self.start = None
+
+    def __enter__(self):
+        if self.tracer:
+            self.tracer.enter(self)
+        elif self.name:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if self.tracer:
+            self.tracer.exit(self, value)
+        if JOURNAL is not None and self.start is not None:
+            JOURNAL.phase(self.name, time.time() - self.start)
+        return False
+
+    def set(self, name, value):
+        """
+        Records an attribute of the span, such as a count of routes
+        """
+        if self.tracer:
+            self.attributes[name] = value
+
+
+# the span trace_span hands out while tracing is off
+NULL_SPAN = TraceSpan(None, '')
+
+
+class Tracer(object):
+    """
+    Writes the spans of a run as JSON lines to destination, a file name or
+    unix:/path for a unix (stream) socket
+
+    Each line holds the trace id shared by every span of the process, the
+    span and parent span ids, the span name, its start as a unix time,
+    its duration in milliseconds, its attributes and the error that ended
+    it, if any.  Tracing stops after the first failed write.
+    """
+
+    def __init__(self, destination):
+        import itertools
+        import threading
+        self.destination = destination
+        self.trace_id = binascii.hexlify(os.urandom(8))
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        # spans are nested per thread, the spans of a worker thread are
+        # children of the span the main thread is in
+        self.local = threading.local()
+        self.stack = self.local.stack = []
+        if destination.startswith('unix:'):
+            import socket
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(destination[len('unix:'):])
+            self.write = self.socket.sendall
+        else:
+            self.socket = None
+            self.file = open(destination, 'a')
+            self.write = self.file.write
+
+    def close(self):
+        """
+        Closes the trace destination
+        """
+        if self.socket:
+            self.socket.close()
+        else:
+            self.file.close()
+
+    def enter(self, span):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        parents = stack or self.stack
+        span.span_id = next(self.ids)
+        span.parent_id = parents[-1].span_id if parents else None
+        span.start = time.time()
+        stack.append(span)
+
+    def exit(self, span, error=None):
+        duration = time.time() - span.start
+        import json
+        self.local.stack.pop()
+        record = {'trace': self.trace_id, 'span': span.span_id,
+                  'parent': span.parent_id, 'name': span.name,
+                  'start': round(span.start, 6),
+                  'duration_ms': round(duration * 1000, 3),
+                  'attributes': span.attributes}
+        if error is not None:
+            record['error'] = '%s: %s' % (type(error).__name__, error)
+        try:
+            with self.lock:
+                self.write(json.dumps(record, sort_keys=True) + '\n')
+        except (IOError, OSError) as write_error:
+            print '[TRACE] tracing stopped: %s' % write_error
+            set_tracer(None)
+
+
+class Metrics(object):
+    """
+    The counters of the passes of a process, written to filename in the
+    Prometheus text format (see METRICS)
+
+    Counters and histograms are kept as the increments of the current
+    pass and added to the values of the previous file when it is written,
+    so they keep counting across launchd invocations.  Gauges replace
+    their previous value.  Samples are recorded from any thread.
+    """
+
+    def __init__(self, filename):
+        import threading
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.gauges = {}
+        self.commands_seen = 0
+
+    def add(self, name, value=1, **labels):
+        """
+        Adds value to the counter name with the labels
+        """
+        key = (name, format_labels(labels))
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def finish_pass(self, seconds, success, nics=()):
+        """
+        Records a pass that took seconds, with the commands it spawned,
+        and writes the metrics file.  The nics whose routes the pass
+        reconciled get a new last success time when the pass succeeded,
+        the other interfaces keep theirs.
+        """
+        runner = get_command_runner()
+        for cmd, duration in runner.calls[self.commands_seen:]:
+            command = os.path.basename(cmd.split()[0])
+            self.add('dhcp_121_command_spawns_total', command=command)
+            self.add('dhcp_121_command_seconds_total', duration,
+                     command=command)
+        self.commands_seen = len(runner.calls)
+
+        self.add('dhcp_121_runs_total',
+                 result='success' if success else 'failure')
+        self.observe('dhcp_121_run_duration_seconds', seconds,
+                     RUN_DURATION_BUCKETS)
+        if success:
+            now = time.time()
+            self.gauges[('dhcp_121_last_success_timestamp_seconds', '')] = \
+                now
+            for nic in nics:
+                self.gauges[('dhcp_121_last_success_timestamp_seconds',
+                             format_labels({'interface': nic}))] = now
+        try:
+            self.write()
+        except (IOError, OSError) as error:
+            print '[METRICS] unable to write %s: %s' % (self.filename, error)
+
+    def observe(self, name, value, buckets):
+        """
+        Adds value to the histogram name with the bucket upper bounds,
+        every bucket is written even while it counts nothing
+        """
+        for bound in buckets:
+            self.add(name + '_bucket', 1 if value <= bound else 0,
+                     le='%g' % bound)
+        self.add(name + '_bucket', le='+Inf')
+        self.add(name + '_sum', value)
+        self.add(name + '_count')
+
+    def read(self):
+        """
+        Returns the samples of the metrics file as a dictionary of (name,
+        labels) to value, empty when there is no readable file
+        """
+        samples = {}
+        try:
+            file_handle = open(self.filename)
+        except IOError:
+            return samples
+        try:
+            for line in file_handle:
+                sample = METRIC_SAMPLE.match(line.strip())
+                if sample:
+                    name, labels, value = sample.groups()
+                    try:
+                        samples[(name, labels or '')] = float(value)
+                    except ValueError:
+                        continue
+        finally:
+            file_handle.close()
+        return samples
+
+    def write(self):
+        """
+        Adds the counts to the previous file's and atomically replaces it,
+        the counts start over from zero afterwards
+        """
+        with self.lock:
+            samples = self.read()
+            for key, value in self.counts.items():
+                samples[key] = samples.get(key, 0) + value
+            samples.update(self.gauges)
+            self.counts = {}
+            self.gauges = {}
+
+        def get_order(sample, names):
+            # buckets are ordered by their bound, +Inf last
+            (name, labels), _ = sample
+            bound = re.findall(r'le="([^"]*)"', labels) or ['0']
+            return (names.index(name), re.sub(r'le="[^"]*"', '', labels),
+                    float(bound[0]))
+
+        lines = []
+        for family, kind, description in METRIC_FAMILIES:
+            names = [family]
+            if kind == 'histogram':
+                names = [family + suffix
+                         for suffix in ('_bucket', '_sum', '_count')]
+            family_samples = sorted(
+                ((key, value) for key, value in samples.items()
+                 if key[0] in names),
+                key=lambda sample, names=names: get_order(sample, names))
+            if not family_samples:
+                continue
+            lines.append('# HELP %s %s' % (family, description))
+            lines.append('# TYPE %s %s' % (family, kind))
+            for (name, labels), value in family_samples:
+                lines.append('%s%s %s' % (name, labels, repr(float(value))))
+        write_file_atomically(self.filename, '\n'.join(lines) + '\n')
+
+
+class Journal(object):
+    """
+    Appends a binary record of every pass to filename, see JOURNAL_FILE
+
+    A record is its length (4 bytes) followed by the JOURNAL_VERSION, the
+    start of the pass as a unix time, its duration in milliseconds, a
+    success flag, the phases as (JOURNAL_PHASES index, milliseconds) and
+    the interfaces.  An interface is its name, the first 8 bytes of the
+    SHA-1 of its decoded routes (zeros when it had no lease) and its route
+    operations as (JOURNAL_VERBS index, with JOURNAL_FAILED set when the
+    operation failed, network, prefix length, gateway).  Every number is
+    in network byte order.
+    """
+    record = '!BdfBB'
+    phase_record = '!Bf'
+    interface_record = '!8sH'
+    operation_record = '!BIBI'
+
+    def __init__(self, filename, max_bytes=JOURNAL_MAX_BYTES):
+        import threading
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.phases = []
+        self.interfaces = {}
+
+    def finish_pass(self, start, seconds, success):
+        """
+        Appends the record of a pass that started at the unix time start
+        and took seconds, rotating the journal when it is full
+        """
+        import struct
+        with self.lock:
+            phases, self.phases = self.phases, []
+            interfaces, self.interfaces = self.interfaces, {}
+        parts = [struct.pack(self.record, JOURNAL_VERSION, start,
+                             seconds * 1000, bool(success), len(phases))]
+        parts.extend(struct.pack(self.phase_record, index, seconds * 1000)
+                     for index, seconds in phases)
+        parts.append(struct.pack('!B', len(interfaces)))
+        for nic in sorted(interfaces):
+            digest, operations = interfaces[nic]
+            parts.append(struct.pack('!B', len(nic)) + nic)
+            parts.append(struct.pack(self.interface_record, digest,
+                                     len(operations)))
+            parts.extend(struct.pack(self.operation_record, *operation)
+                         for operation in operations)
+        body = ''.join(parts)
+        data = struct.pack('!I', len(body)) + body
+
+        try:
+            if os.path.exists(self.filename) and \
+                    os.path.getsize(self.filename) + len(data) > \
+                    self.max_bytes:
+                os.rename(self.filename, self.filename + '.1')
+            file_handle = open(self.filename, 'ab')
+            try:
+                file_handle.write(data)
+            finally:
+                file_handle.close()
+        except (IOError, OSError) as error:
+            print '[JOURNAL] unable to write %s: %s' % (self.filename, error)
+
+    def lease(self, nic, routes):
+        """
+        Records the decoded Routes of the NIC's lease
+        """
+        import hashlib
+        digest = hashlib.sha1(''.join(
+            '%08x%02x%08x' % (route.network, route.prefixlen, route.gateway)
+            for route in routes)).digest()[:8]
+        with self.lock:
+            self.interfaces.setdefault(nic, ['\0' * 8, []])[0] = digest
+
+    def operation(self, nic, result):
+        """
+        Records the RouteResult of an operation on the NIC's routes
+        """
+        verb = JOURNAL_VERBS.index(result.routeverb)
+        if result.error:
+            verb |= JOURNAL_FAILED
+        route = result.route
+        with self.lock:
+            self.interfaces.setdefault(nic, ['\0' * 8, []])[1].append(
+                (verb, route.network, route.prefixlen, route.gateway))
+
+    def phase(self, name, seconds):
+        """
+        Records the duration of a phase, spans not in JOURNAL_PHASES
+        (commands, decodes, ...) are left out
+        """
+        if name in JOURNAL_PHASES:
+            with self.lock:
+                self.phases.append((JOURNAL_PHASES.index(name), seconds))
+
+
+class Interface(object):
+    """
+    A network interface as read by get_interface_inventory
+
+    addresses is a list of (ip address, prefix length, broadcast) tuples,
+    up and running reflect the interface flags and link is True, False or
+    None when the interface doesnt report a link state.
+    """
+    __slots__ = ('name', 'flags', 'addresses', 'up', 'running', 'link')
+
+    def __init__(self, name, flags, addresses, up, running, link):
+        self.name = name
+        self.flags = flags
+        self.addresses = addresses
+        self.up = up
+        self.running = running
+        self.link = link
+
+    def __repr__(self):
+        return ('Interface(name=%r, flags=%r, addresses=%r, up=%r, '
+                'running=%r, link=%r)'
+                % (self.name, self.flags, self.addresses, self.up,
+                   self.running, self.link))
+
+
+class Lease(object):
+    """
+    The DHCP lease of an interface as read by get_lease
+
+    addresses are the (ip address, prefix length, broadcast) tuples of the
+    interface, option_data the option 121 (or 249) bytes of its DHCP
+    packet and routes the decoded Routes, None until decode_lease is
+    called.
+    """
+    __slots__ = ('nic', 'addresses', 'option_data', 'routes')
+
+    def __init__(self, nic, addresses, option_data, routes=None):
+        self.nic = nic
+        self.addresses = addresses
+        self.option_data = option_data
+        self.routes = routes
+
+    def __repr__(self):
+        return ('Lease(nic=%r, addresses=%r, option_data=%r, routes=%r)'
+                % (self.nic, self.addresses, self.option_data, self.routes))
+
+
+class PrefixTrie(object):
+    """
+    A path compressed binary (Patricia) trie of IPv4 prefixes
+
+    Prefixes are (network, prefixlen) integer pairs.  Inserts, exact
+    lookups and longest prefix matches walk at most one node per bit of
+    the prefix, independent of how many prefixes are stored.
+    """
+
+    class _Node(object):
+        __slots__ = ('network', 'prefixlen', 'present', 'children')
+
+        def __init__(self, network, prefixlen, present):
+            self.network = network
+            self.prefixlen = prefixlen
+            self.present = present
+            self.children = [None, None]
+
+    def __init__(self):
+        self._root = self._Node(0, 0, False)
+        self._count = 0
+
+    def __contains__(self, prefix):
+        node = self._find(prefix[0], prefix[1])
+        return node is not None and node.present
+
+    def __len__(self):
+        return self._count
+
+    def _find(self, network, prefixlen):
+        node = self._root
+        while node is not None and node.prefixlen < prefixlen:
+            node = node.children[(network >> (31 - node.prefixlen)) & 1]
+        if node is None or node.prefixlen != prefixlen or \
+                node.network != network:
+            return None
+        return node
+
+    def insert(self, network, prefixlen):
+        """
+        Adds the (network, prefixlen) prefix, network must be masked
+        """
+        node = self._root
+        while node.prefixlen != prefixlen:
+            bit = (network >> (31 - node.prefixlen)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = self._Node(network, prefixlen, True)
+                self._count += 1
+                return
+
+            # the number of leading bits shared with the child's prefix
+            common = min(prefixlen, child.prefixlen)
+            difference = network ^ child.network
+            if difference:
+                common = min(common, 32 - difference.bit_length())
+
+            if common == child.prefixlen:
+                node = child
+                continue
+
+            # the child splits off below a new node, either the prefix
+            # itself or an intermediate fork where the two diverge
+            if common == prefixlen:
+                fork = self._Node(network, prefixlen, True)
+                self._count += 1
+            else:
+                fork = self._Node(network & PREFIX_MASKS[common], common,
+                                  False)
+                fork.children[(network >> (31 - common)) & 1] = \
+                    self._Node(network, prefixlen, True)
+                self._count += 1
+            fork.children[(child.network >> (31 - common)) & 1] = child
+            node.children[bit] = fork
+            return
+
+        if not node.present:
+            node.present = True
+            self._count += 1
+
+    def longest_match(self, address):
+        """
+        Returns the most specific (network, prefixlen) containing the 32bit
+        address, or None when no prefix contains it
+        """
+        node = self._root
+        best = None
+        while node is not None:
+            if (address ^ node.network) & PREFIX_MASKS[node.prefixlen]:
+                break
+            if node.present:
+                best = (node.network, node.prefixlen)
+            if node.prefixlen == 32:
+                break
+            node = node.children[(address >> (31 - node.prefixlen)) & 1]
+        return best
+
+    def remove(self, network, prefixlen):
+        """
+        Removes the (network, prefixlen) prefix if it is present
+        """
+        node = self._find(network, prefixlen)
+        if node is not None and node.present:
+            node.present = False
+            self._count -= 1
+
+
+class Route(object):
+    """
+    An IPv4 route held as integers: the network and gateway as 32bit
+    addresses, the prefix length and the ifindex of its interface (an
+    index into INTERFACE_NAMES, see get_ifindex, 0 for none)
+
+    Routes compare equal when all four fields are.  Dotted quads are only
+    made when a route is printed, str() gives "10.0.0.0/8 via 192.168.0.1".
+    """
+    __slots__ = ('network', 'prefixlen', 'gateway', 'ifindex')
+
+    def __init__(self, network, prefixlen, gateway=0, ifindex=0):
+        self.network = network
+        self.prefixlen = prefixlen
+        self.gateway = gateway
+        self.ifindex = ifindex
+
+    def __eq__(self, other):
+        return isinstance(other, Route) and \
+            (self.network, self.prefixlen, self.gateway, self.ifindex) == \
+            (other.network, other.prefixlen, other.gateway, other.ifindex)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.network, self.prefixlen, self.gateway,
+                     self.ifindex))
+
+    def __repr__(self):
+        return ('Route(network=%r, prefixlen=%r, gateway=%r, ifindex=%r)'
+                % (self.network, self.prefixlen, self.gateway, self.ifindex))
+
+    def __str__(self):
+        return '%s/%d via %s' % (int_to_ip(self.network), self.prefixlen,
+                                 int_to_ip(self.gateway))
+
+    @property
+    def interface(self):
+        """
+        The name of the route's interface, '' when it has none
+        """
+        return INTERFACE_NAMES[self.ifindex]
+
+    @property
+    def key(self):
+        """
+        The (network, prefixlen) prefix of the route
+        """
+        return self.network, self.prefixlen
+
+    @classmethod
+    def parse(cls, subnet, mask, gateway='', interface=''):
+        """
+        Returns the Route for dotted quad subnet and gateway strings, the
+        subnet masked to mask bits
+        """
+        prefixlen = int(mask)
+        return cls(ip_to_int(subnet) & PREFIX_MASKS[prefixlen], prefixlen,
+                   ip_to_int(gateway) if gateway else 0,
+                   get_ifindex(interface))
+
+
+class RouteTable(object):
+    """
+    An indexed view of the IPv4 routing table
+
+    Routes are Route records as built by get_route_table_with_masks.
+    They are indexed by their (network, prefixlen), by interface and by a
+    PrefixTrie for longest prefix matching.  Iterating the table yields
+    the routes in the order they were added.  default_interface is the
+    interface of the default route, when the table was read with one.
+
+    Adding and discarding a route take the same time however large the
+    table is, so a RouteMirror can follow route messages one at a time.
+    """
+
+    class _Routes(object):
+        """
+        Routes in the order they were added, each discarded by identity in
+        constant time: its slot is emptied and the list compacted once
+        half of it is empty
+        """
+        __slots__ = ('routes', 'positions', 'holes')
+
+        def __init__(self):
+            self.routes = []
+            self.positions = {}
+            self.holes = 0
+
+        def __iter__(self):
+            if not self.holes:
+                return iter(self.routes)
+            return (route for route in self.routes if route is not None)
+
+        def __len__(self):
+            return len(self.routes) - self.holes
+
+        def append(self, route):
+            self.positions[id(route)] = len(self.routes)
+            self.routes.append(route)
+
+        def discard(self, route):
+            self.routes[self.positions.pop(id(route))] = None
+            self.holes += 1
+            if self.holes * 2 > len(self.routes):
+                self.routes = [held for held in self.routes
+                               if held is not None]
+                self.positions = dict((id(held), position) for position,
+                                      held in enumerate(self.routes))
+                self.holes = 0
+
+    def __init__(self, routes=()):
+        self.default_interface = None
+        self._routes = self._Routes()
+        self._by_prefix = {}
+        self._by_interface = {}
+        self._trie = PrefixTrie()
+        for route in routes:
+            self.add(route)
+
+    def __contains__(self, prefix):
+        return prefix in self._by_prefix
+
+    def __iter__(self):
+        return iter(self._routes)
+
+    def __len__(self):
+        return len(self._routes)
+
+    def add(self, route):
+        """
+        Adds a Route to the table
+        """
+        key = route.network, route.prefixlen
+        self._routes.append(route)
+        self._by_prefix.setdefault(key, []).append(route)
+        by_interface = self._by_interface.get(route.ifindex)
+        if by_interface is None:
+            by_interface = self._by_interface[route.ifindex] = \
+                self._Routes()
+        by_interface.append(route)
+        self._trie.insert(*key)
+
+    def get(self, network, prefixlen):
+        """
+        Returns the routes for an exact (network, prefixlen) match
+        """
+        return list(self._by_prefix.get((network, prefixlen), ()))
+
+    def discard(self, route):
+        """
+        Removes the Route equal to route from the table, if it holds one
+        """
+        key = route.network, route.prefixlen
+        routes = self._by_prefix.get(key, [])
+        if route not in routes:
+            return
+        # the routes of a prefix are few, the others are found by identity
+        held = routes.pop(routes.index(route))
+        self._routes.discard(held)
+        self._by_interface[held.ifindex].discard(held)
+        if not routes:
+            del self._by_prefix[key]
+            self._trie.remove(*key)
+        if not self._by_interface[held.ifindex]:
+            del self._by_interface[held.ifindex]
+
+    def interfaces(self):
+        """
+        Returns the names of the interfaces that have routes
+        """
+        return [INTERFACE_NAMES[ifindex] for ifindex in self._by_interface]
+
+    def longest_match(self, address):
+        """
+        Returns the routes of the most specific prefix that contains the
+        32bit address, an empty list if no route matches
+        """
+        prefix = self._trie.longest_match(address)
+        if prefix is None:
+            return []
+        return self.get(*prefix)
+
+    def routes_on(self, interface):
+        """
+        Returns the routes that leave through the named interface
+        """
+        ifindex = INTERFACE_INDEXES.get(interface)
+        return list(self._by_interface.get(ifindex, ()))
+
+
+class RouteMirror(object):
+    """
+    A RouteTable kept in step with the kernel's IPv4 routing table
+
+    The table is loaded once with dump_route_table and then follows the
+    route messages read from a routing socket (AF_NETLINK on Linux,
+    PF_ROUTE on macOS), so reading it costs no netstat run and no parse
+    of the whole table.  Messages are applied when the table is read.
+
+    The kernel doesnt report everything: the routes of an interface that
+    goes down or loses its address can go without a message and a full
+    socket drops messages.  Those cases reload the table, and every
+    ROUTE_MIRROR_RESYNC seconds the checksum of a fresh dump is compared
+    with the mirror's to catch any other drift.  The checksum is the XOR
+    of the CRC-32 of every route, kept as routes come and go.
+    """
+
+    def __init__(self):
+        import socket
+        import threading
+        if sys.platform.startswith('linux'):
+            self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                         NETLINK_ROUTE)
+            self._socket.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR |
+                               RTMGRP_IPV4_ROUTE))
+        else:
+            self._socket = socket.socket(PF_ROUTE, socket.SOCK_RAW, 0)
+        # room for the messages of a large change between two reads
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                1024 * 1024)
+        self._socket.setblocking(False)
+        self.lock = threading.Lock()
+        self.table, self.checksum = self._load()
+        self.next_check = time.time() + ROUTE_MIRROR_RESYNC
+
+    @staticmethod
+    def _checksum(route):
+        import struct
+        import zlib
+        return zlib.crc32(struct.pack('!LBLL', route.network,
+                                      route.prefixlen, route.gateway,
+                                      route.ifindex))
+
+    def _load(self):
+        """
+        Returns a RouteTable of a dump of the routing table and its
+        checksum
+        """
+        table = RouteTable()
+        checksum = 0
+        for route in dump_route_table():
+            checksum ^= self._update(table, 'add', route)
+        return table, checksum
+
+    def _update(self, table, routeverb, route, any_interface=False):
+        """
+        Adds a Route to table, replacing the route of the same prefix on
+        its interface, or deletes it.  any_interface replaces or deletes
+        the prefix on every interface.
+
+        Returns the change to the checksum
+        """
+        checksum = 0
+        if not route.prefixlen:
+            # the table holds the default route as its default_interface
+            if routeverb == 'delete':
+                if any_interface or \
+                        route.interface == table.default_interface:
+                    table.default_interface = None
+            else:
+                table.default_interface = route.interface
+            return checksum
+
+        for held in table.get(*route.key):
+            if any_interface or held.ifindex == route.ifindex:
+                table.discard(held)
+                checksum ^= self._checksum(held)
+        if routeverb != 'delete':
+            table.add(route)
+            checksum ^= self._checksum(route)
+        return checksum
+
+    def close(self):
+        self._socket.close()
+
+    def read(self):
+        """
+        Applies the route messages received since the last read, reloading
+        the table when they cant be followed or a check is due
+
+        Returns the RouteTable, updated in place
+        """
+        with self.lock:
+            if not self._receive():
+                self.table, self.checksum = self._load()
+                self.next_check = time.time() + ROUTE_MIRROR_RESYNC
+            elif time.time() >= self.next_check:
+                table, checksum = self._load()
+                if checksum != self.checksum:
+                    print '[MIRROR] the routing table drifted from its ' \
+                        'mirror, reloaded'
+                    self.table, self.checksum = table, checksum
+                self.next_check = time.time() + ROUTE_MIRROR_RESYNC
+            return self.table
+
+    def _receive(self):
+        """
+        Applies every pending route message to the table
+
+        Returns False when a message couldnt be followed and the table
+        needs reloading
+        """
+        import socket
+        netlink = sys.platform.startswith('linux')
+        in_step = True
+        while True:
+            try:
+                data = self._socket.recv(65536)
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return in_step
+                if error.errno == errno.ENOBUFS:
+                    # the socket overflowed, messages were lost
+                    in_step = False
+                    continue
+                raise
+            if not data:
+                return in_step
+
+            if netlink:
+                messages = iter_netlink_routes(data)
+            else:
+                messages = [parse_routing_message(data)]
+            for message_type, route in messages:
+                if message_type in (RTM_NEWLINK, RTM_DELLINK,
+                                    RTM_DELADDR_NETLINK) and netlink or \
+                        message_type in (RTM_IFINFO, RTM_DELADDR) and \
+                        not netlink:
+                    in_step = False
+                elif route is None:
+                    continue
+                elif message_type in (RTM_DELROUTE, RTM_DELETE):
+                    self.checksum ^= self._update(self.table, 'delete',
+                                                  route, not netlink)
+                else:
+                    self.checksum ^= self._update(self.table, 'add', route,
+                                                  not netlink)
+
+
+class RoutePlan(object):
+    """
+    The route operations that take an interface from its current routes
+    to the desired ones, see plan_routes
+
+    Routes are Route records.  deletes holds the routes to
+    remove, changes the routes whose gateway is replaced, adds the routes
+    to install and skipped (route, reason) pairs for desired routes that
+    need no operation.  desired holds the desired routes the interface
+    ends up with (the ones it keeps, changes or adds, not those left to
+    another interface) and results the RouteResults of its operations
+    once the plan has been applied.
+    """
+
+    def __init__(self, nic=''):
+        self.nic = nic
+        self.desired = []
+        self.deletes = []
+        self.changes = []
+        self.adds = []
+        self.skipped = []
+        self.results = []
+
+    def __len__(self):
+        return len(self.deletes) + len(self.changes) + len(self.adds)
+
+    def operations(self):
+        """
+        Returns (routeverb, route) pairs in the order they are applied:
+        deletes, then changes, then adds
+        """
+        return ([('delete', route) for route in self.deletes] +
+                [('change', route) for route in self.changes] +
+                [('add', route) for route in self.adds])
+
+    def report(self):
+        """
+        Returns a line per operation and per skipped route
+        """
+        lines = ['%s %s' % (routeverb, route)
+                 for routeverb, route in self.operations()]
+        for route, reason in self.skipped:
+            lines.append('skip %s (%s)' % (route, reason.replace('_', ' ')))
+        return lines
+
+
+class RouteResult(object):
+    """
+    The outcome of a route operation, see apply_operations
+
+    report is the route command style report of the backend, error the
+    reason the operation failed ('' when it succeeded) and seconds the
+    time the operation took.
+    """
+    __slots__ = ('routeverb', 'route', 'report', 'error', 'seconds')
+
+    def __init__(self, routeverb, route, report='', error='', seconds=0.0):
+        self.routeverb = routeverb
+        self.route = route
+        self.report = report
+        self.error = error
+        self.seconds = seconds
+
+    def __repr__(self):
+        return ('RouteResult(routeverb=%r, route=%r, report=%r, error=%r, '
+                'seconds=%r)' % (self.routeverb, self.route, self.report,
+                                 self.error, self.seconds))
+
+
+class RouteBackend(object):
+    """
+    Programs routes into the kernel routing table
+
+    clear_routes and reconcile_interfaces (through apply_plans) hand every
+    route operation to a backend with route_cmd, see get_route_backend for
+    how one is chosen.  Backends report each operation in the style of the
+    route command's output: "add net 10.0.0.0: gateway 192.168.0.1",
+    followed by ": File exists" (or another error) when the operation
+    failed.  Backends that are concurrent can apply operations from
+    several threads at once.
+    """
+    name = ''
+    concurrent = False
+
+    def apply(self, routeverb, route):
+        """
+        Performs routeverb ('add', 'change' or 'delete') for the Route
+
+        Returns the route command style report of the operation
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases any resources held by the backend
+        """
+        pass
+
+
+class DhcpPacket(object):
+    """
+    A DHCP packet parsed from its BOOTP wire bytes in a single pass
+
+    data:
+        the packet from the BOOTP op field on, from a capture or from
+        getpacket_to_bytes
+
+    Every option is indexed by its code as a memoryview of data, so
+    looking one up (get) is a dictionary access that copies nothing.  An
+    option sent as several instances (RFC 3396) is concatenated, the only
+    case where its data is copied.  The sname and file fields are read for
+    options too when the overload option (52) says they hold some.
+    Indexing stops at the end option or at an option that runs past the
+    end of the data.
+
+    Raises ValueError when data is shorter than a BOOTP header or lacks
+    the DHCP magic cookie
+    """
+    __slots__ = ('op', 'xid', 'ciaddr', 'yiaddr', 'siaddr', 'giaddr',
+                 'chaddr', 'options')
+
+    def __init__(self, data):
+        import socket
+        import struct
+        view = memoryview(data)
+        if len(view) < BOOTP_HEADER_SIZE + 4 or \
+                view[BOOTP_HEADER_SIZE:BOOTP_HEADER_SIZE + 4].tobytes() \
+                != DHCP_MAGIC_COOKIE:
+            raise ValueError('not a DHCP packet')
+        (self.op, htype, hlen, hops, self.xid, secs, flags, ciaddr, yiaddr,
+         siaddr, giaddr, chaddr, sname, filename) = \
+            struct.unpack_from(BOOTP_HEADER, view)
+        self.ciaddr = socket.inet_ntoa(ciaddr)
+        self.yiaddr = socket.inet_ntoa(yiaddr)
+        self.siaddr = socket.inet_ntoa(siaddr)
+        self.giaddr = socket.inet_ntoa(giaddr)
+        self.chaddr = ':'.join('%x' % ord(octet)
+                               for octet in chaddr[:min(hlen, 16)])
+
+        instances = {}
+        self._index(view, BOOTP_HEADER_SIZE + 4, len(view), instances)
+        overload = instances.get(DHCP_OVERLOAD)
+        if overload and len(overload[0]):
+            overload = ord(overload[0][0])
+            if overload & 1:
+                self._index(view, 108, 236, instances)
+            if overload & 2:
+                self._index(view, 44, 108, instances)
+
+        self.options = {}
+        for code, views in instances.items():
+            if len(views) == 1:
+                self.options[code] = views[0]
+            else:
+                self.options[code] = memoryview(
+                    ''.join(part.tobytes() for part in views))
+
+    def __contains__(self, code):
+        return code in self.options
+
+    def __repr__(self):
+        return 'DhcpPacket(op=%r, yiaddr=%r, options=%r)' % (
+            self.op, self.yiaddr, sorted(self.options))
+
+    @staticmethod
+    def _index(view, offset, end, instances):
+        while offset < end:
+            code = ord(view[offset])
+            if code == DHCP_END:
+                return
+            if code == DHCP_PAD:
+                offset += 1
+                continue
+            if offset + 2 > end:
+                return
+            start = offset + 2
+            offset = start + ord(view[offset + 1])
+            if offset > end:
+                return
+            instances.setdefault(code, []).append(view[start:offset])
+
+    def get(self, code, default=None):
+        """
+        Returns the data of option code as a memoryview, or default
+        """
+        return self.options.get(code, default)
+
+
+class FakeRouteBackend(RouteBackend):
+    """
+    An in-memory routing table for tests and dry runs, no privileges needed
+
+    routes:
+        an optional iterable of Routes the table starts with (a RouteTable
+        for instance)
+
+    The table is kept in the routes attribute as a dictionary of
+    (network, prefixlen) to gateway, every operation attempted is appended
+    to the operations attribute as (routeverb, route).
+    """
+    name = 'fake'
+
+    def __init__(self, routes=()):
+        self.routes = {}
+        self.operations = []
+        for route in routes:
+            self.routes[route.key] = route.gateway
+
+    def apply(self, routeverb, route):
+        self.operations.append((routeverb, route))
+        key = route.key
+        error = None
+        if routeverb == 'add':
+            if key in self.routes:
+                error = errno.EEXIST
+            else:
+                self.routes[key] = route.gateway
+        elif routeverb == 'change':
+            if key in self.routes:
+                self.routes[key] = route.gateway
+            else:
+                error = errno.ESRCH
+        elif routeverb == 'delete':
+            if key in self.routes:
+                del self.routes[key]
+            else:
+                error = errno.ESRCH
+        else:
+            error = errno.EINVAL
+        return route_report(routeverb, route, error)
+
+
+class NetlinkRouteBackend(RouteBackend):
+    """
+    Programs routes with rtnetlink messages on an AF_NETLINK socket (Linux)
+
+    Each operation is one RTM_NEWROUTE (NLM_F_REPLACE for a change) or
+    RTM_DELROUTE request for the main table, acknowledged by the kernel on
+    the same socket.
+    """
+    name = 'netlink'
+
+    def __init__(self):
+        import socket
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                     NETLINK_ROUTE)
+        self._socket.bind((0, 0))
+        self._sequence = 0
+        # the netlink port id the kernel assigned, route change messages
+        # caused by this backend carry it
+        self.port_id = self._socket.getsockname()[0]
+
+    def apply(self, routeverb, route):
+        import socket
+        import struct
+        mask = route.prefixlen
+        self._sequence += 1
+        flags = NLM_F_REQUEST | NLM_F_ACK
+        if routeverb in ('add', 'change'):
+            message_type = RTM_NEWROUTE
+            if routeverb == 'add':
+                flags |= NLM_F_CREATE | NLM_F_EXCL
+            else:
+                flags |= NLM_F_REPLACE
+            rtmsg = struct.pack('=BBBBBBBBL', socket.AF_INET, mask, 0, 0,
+                                RT_TABLE_MAIN, RTPROT_STATIC,
+                                RT_SCOPE_UNIVERSE, RTN_UNICAST, 0)
+        elif routeverb == 'delete':
+            # wildcard the protocol, scope and type to match any route
+            # for the prefix, as 'ip route del' does
+            message_type = RTM_DELROUTE
+            rtmsg = struct.pack('=BBBBBBBBL', socket.AF_INET, mask, 0, 0,
+                                RT_TABLE_MAIN, 0, RT_SCOPE_NOWHERE, 0, 0)
+        else:
+            return route_report(routeverb, route, errno.EINVAL)
+
+        attributes = struct.pack('=HH', 8, NETLINK_RTA_DST) + \
+            struct.pack('!L', route.network)
+        if route.gateway:
+            attributes += struct.pack('=HH', 8, NETLINK_RTA_GATEWAY) + \
+                struct.pack('!L', route.gateway)
+        body = rtmsg + attributes
+        header = struct.pack('=LHHLL', 16 + len(body), message_type, flags,
+                             self._sequence, 0)
+        self._socket.send(header + body)
+        return route_report(routeverb, route, self._read_ack())
+
+    def _read_ack(self):
+        """
+        Returns the errno of the acknowledgement for the last request,
+        None when it succeeded
+        """
+        import struct
+        while True:
+            data = self._socket.recv(65536)
+            offset = 0
+            while offset + 16 <= len(data):
+                length, message_type, _, sequence, _ = \
+                    struct.unpack_from('=LHHLL', data, offset)
+                if message_type == NLMSG_ERROR and \
+                        sequence == self._sequence:
+                    error = struct.unpack_from('=i', data, offset + 16)[0]
+                    return -error or None
+                offset += (length + 3) & ~3 or len(data)
+
+    def close(self):
+        self._socket.close()
+
+
+class RoutingSocketBackend(RouteBackend):
+    """
+    Programs routes with RTM_ADD, RTM_CHANGE and RTM_DELETE messages
+    written to a PF_ROUTE socket (macOS and the other BSD derived systems)
+
+    The message layout is the macOS struct rt_msghdr followed by the
+    destination, gateway and netmask sockaddr_in structures.  A failed
+    write carries the error the route command would have reported.
+    """
+    name = 'socket'
+
+    def __init__(self):
+        import socket
+        self._socket = socket.socket(PF_ROUTE, socket.SOCK_RAW, 0)
+        # our own messages are not read back, as with the route command
+        self._socket.shutdown(socket.SHUT_RD)
+        self._sequence = 0
+
+    def apply(self, routeverb, route):
+        import socket
+        import struct
+        mask = route.prefixlen
+        if routeverb == 'add':
+            message_type = RTM_ADD
+        elif routeverb == 'change':
+            message_type = RTM_CHANGE
+        elif routeverb == 'delete':
+            message_type = RTM_DELETE
+        else:
+            return route_report(routeverb, route, errno.EINVAL)
+
+        flags = RTF_UP | RTF_GATEWAY | RTF_STATIC
+        addresses = RTA_DST | RTA_GATEWAY
+        sockaddrs = sockaddr_in(route.network) + sockaddr_in(route.gateway)
+        if mask == 32:
+            flags |= RTF_HOST
+        else:
+            addresses |= RTA_NETMASK
+            sockaddrs += sockaddr_in(PREFIX_MASKS[mask])
+
+        self._sequence += 1
+        header = struct.pack(RT_MSGHDR, RT_MSGHDR_SIZE + len(sockaddrs),
+                             RTM_VERSION, message_type, 0, flags, addresses,
+                             0, self._sequence, 0, 0, 0, *([0] * 14))
+        try:
+            self._socket.send(header + sockaddrs)
+        except socket.error as error:
+            return route_report(routeverb, route, error.errno)
+        return route_report(routeverb, route)
+
+    def close(self):
+        self._socket.close()
+
+
+class SubprocessRouteBackend(RouteBackend):
+    """
+    Programs routes by running the UNIX route command once per operation
+    """
+    name = 'subprocess'
+    concurrent = True
+
+    def apply(self, routeverb, route):
+        cmd = 'route %s %s/%d %s' % (routeverb, int_to_ip(route.network),
+                                     route.prefixlen,
+                                     int_to_ip(route.gateway))
+        try:
+            return run_command(cmd)
+        except OSError as error:
+            if error.errno != errno.ETIMEDOUT:
+                raise
+            return route_report(routeverb, route, error.errno)
+
+
+def aggregate_routes(desired, barriers=()):
+    """
+    Collapses the desired routes of an interface into fewer routes that
+    forward every address the same way
+
+    desired:
+        the ordered dictionary of routes from get_desired_routes
+
+    barriers:
+        (network, prefixlen) prefixes routed some other way, such as the
+        routes of other interfaces, the connected networks and the default
+        route.  Routes are never merged or dropped where that would change
+        which of them an address matches.
+
+    Sibling prefixes with the same gateway are merged into their parent,
+    from the longest prefixes up, then routes whose nearest enclosing
+    prefix is a route with the same gateway are dropped.  The result is
+    checked with verify_aggregation, the routes are left as they were if
+    the check fails.
+
+    Returns an ordered dictionary like desired and a list of (route,
+    reason) pairs for the routes aggregated away
+    """
+    import collections
+    barriers = set(barriers)
+    routes = dict(desired)
+    replaced = {}
+
+    # siblings merge bottom up, so that merged parents can merge again
+    for prefixlen in range(32, 0, -1):
+        for key in [key for key in routes if key[1] == prefixlen]:
+            route = routes.get(key)
+            if route is None:
+                continue
+            sibling = (key[0] ^ (1 << (32 - prefixlen)), prefixlen)
+            parent = (key[0] & PREFIX_MASKS[prefixlen - 1], prefixlen - 1)
+            other = routes.get(sibling)
+            existing = routes.get(parent, other)
+            if other is None or key in barriers or sibling in barriers or \
+                    parent in barriers:
+                continue
+            if (other.gateway, other.ifindex) != \
+                    (route.gateway, route.ifindex) or \
+                    (existing.gateway, existing.ifindex) != \
+                    (route.gateway, route.ifindex):
+                continue
+            routes.setdefault(parent, Route(parent[0], parent[1],
+                                            route.gateway, route.ifindex))
+            del routes[key], routes[sibling]
+            replaced[key] = replaced[sibling] = parent
+
+    # a route is covered when the nearest prefix enclosing it is a route
+    # with the same gateway, every covered route is dropped at once
+    prefixes = set(routes) | barriers
+    covered = {}
+    for key, route in routes.items():
+        if key in barriers:
+            continue
+        for prefixlen in range(key[1] - 1, -1, -1):
+            enclosing = (key[0] & PREFIX_MASKS[prefixlen], prefixlen)
+            if enclosing in prefixes:
+                break
+        else:
+            continue
+        other = routes.get(enclosing)
+        if other is not None and enclosing not in barriers and \
+                (other.gateway, other.ifindex) == \
+                (route.gateway, route.ifindex):
+            covered[key] = enclosing
+    for key in covered:
+        del routes[key]
+    replaced.update(covered)
+
+    aggregated = collections.OrderedDict()
+    skipped = []
+    for key, route in desired.items():
+        target = key
+        while target not in routes:
+            target = replaced[target]
+        if target != key:
+            skipped.append((route, 'aggregated_into_%s/%d'
+                            % (int_to_ip(target[0]), target[1])))
+        if target not in aggregated:
+            aggregated[target] = routes[target]
+
+    if not verify_aggregation(desired.values(), aggregated.values(),
+                              barriers):
+        print '[AGGREGATE] aggregation changes forwarding, not aggregating'
+        return collections.OrderedDict(desired), []
+    return aggregated, skipped
+
+
+def apply_operations(operations, backend=None):
+    """
+    Applies (routeverb, route) operations, up to ROUTE_WORKERS at a time
+    when the backend is concurrent and one after the other otherwise
+
+    The operations of a prefix are applied in the order given, so that a
+    delete is done before the prefix is added again, while those of
+    different prefixes dont wait on each other.  A prefix that is added or
+    changed and is the nearest enclosing one of a deleted route, such as
+    an aggregate replacing the routes it covers, is programmed before any
+    route is deleted, so that their addresses are never left to a shorter
+    prefix.  An operation that fails, or whose backend raises an
+    EnvironmentError, doesnt stop the others.
+
+    backend:
+        the RouteBackend to program routes with, see get_route_backend
+
+    Returns a RouteResult per operation, in the order of operations
+    """
+    import collections
+    backend = backend or get_route_backend()
+    operations = list(operations)
+    results = [None] * len(operations)
+    chains = collections.OrderedDict()
+    for index, (_, route) in enumerate(operations):
+        chains.setdefault(route.key, []).append(index)
+
+    def apply_chain(indexes):
+        for index in indexes:
+            routeverb, route = operations[index]
+            result = RouteResult(routeverb, route)
+            start = time.time()
+            try:
+                result.report = route_cmd(route, routeverb, backend) or ''
+                match = ROUTE_REPORT_ERROR.search(result.report)
+                if match:
+                    result.error = match.group(1)
+            except EnvironmentError as error:
+                result.error = str(error)
+            result.seconds = time.time() - start
+            results[index] = result
+
+    # the covering prefixes of the deleted routes go first
+    installed = set(route.key for routeverb, route in operations
+                    if routeverb != 'delete')
+    covering = set()
+    for routeverb, route in operations:
+        if routeverb != 'delete':
+            continue
+        for prefixlen in range(route.prefixlen - 1, -1, -1):
+            enclosing = (route.network & PREFIX_MASKS[prefixlen], prefixlen)
+            if enclosing in installed:
+                covering.add(enclosing)
+                break
+
+    workers = ROUTE_WORKERS if backend.concurrent else 1
+    run_parallel(apply_chain, [indexes for key, indexes in chains.items()
+                               if key in covering], workers)
+    run_parallel(apply_chain, [indexes for key, indexes in chains.items()
+                               if key not in covering], workers)
+    return results
+
+
+def apply_plans(plans, backend=None):
+    """
+    Applies the RoutePlans of several interfaces together: the deletes of
+    every plan are queued before the changes and adds of every plan, so
+    that a prefix moving between interfaces is released before it is
+    installed again, while the prefixes covering deleted routes are still
+    installed first, see apply_operations
+
+    backend:
+        the RouteBackend to program routes with, see get_route_backend
+
+    Returns the plans, with the RouteResults of their operations in
+    results
+    """
+    queued = []
+    for routeverbs in (('delete',), ('change', 'add')):
+        for plan in plans:
+            queued.extend((plan, routeverb, route)
+                          for routeverb, route in plan.operations()
+                          if routeverb in routeverbs)
+    results = apply_operations([(routeverb, route)
+                                for _, routeverb, route in queued], backend)
+    for plan in plans:
+        plan.results = []
+    for (plan, _, _), result in zip(queued, results):
+        plan.results.append(result)
+    return plans
+
+
+def bytes_to_hexdump(data):
+    """
+    Renders option data in the hexdump layout used by 'ipconfig getpacket',
+    the inverse of hexdump_to_bytes
+
+    data:
+        the raw option bytes
+
+    Returns a list of strings, one per 16 bytes of data
+    """
+    data = bytearray(data)
+    lines = []
+    for offset in range(0, len(data), 16):
+        chunk = data[offset:offset + 16]
+        hex_bytes = ['%02x' % byte for byte in chunk]
+        hex_area = ' '.join(hex_bytes[:8])
+        if len(hex_bytes) > 8:
+            hex_area = hex_area + '  ' + ' '.join(hex_bytes[8:])
+        lines.append('%04x  %-48s  %s' % (offset, hex_area, '.' * len(chunk)))
+    return lines
+
 
 def check_for_override_file():
     """
@@ -111,19 +2011,26 @@ def check_for_override_file():
 
             # set gateway check to 0 or False to disable
             if re.match(r'(\W){0,}gatewaycheck(\W){0,}=(\W){0,}', line):
-                gatewaycheck = line.split('=')[1].strip()
-                print '[OVERRIDE] disabling gateway check'
+                gatewaycheck = line.split('=')[1].strip() not in \
+                    ('0', 'False', 'false')
+                if not gatewaycheck:
+                    print '[OVERRIDE] disabling gateway check'
+
+            # set NICs whose routes are always cleared
+            if re.match(r'(\W){0,}forcenics(\W){0,}=(\W){0,}', line):
+                force_nics = line.split('=')[1].strip().strip('"')
+                print '[OVERRIDE] always clearing routes on: %s' % force_nics
 
             # set route-safe NIC for nics that can exist with routes
             # in the event that the DHCP nic goes offline.
             if re.match(r'(\W){0,}safe_nics(\W){0,}=(\W){0,}', line):
-                safe_nics = line.split('=')[1].strip()
+                safe_nics = line.split('=')[1].strip().strip('"')
                 print '[OVERRIDE] ignoring routes on: %s' % safe_nics
 
             # set static routes "dynamically"
             if re.match(r'(\W){0,}staticroutes(\W){0,}=(\W){0,}', line):
-                static_routes = line.split('=')[1].strip()
-                print '[OVERRIDE] ignoring routes on: %s' % safe_nics
+                static_routes = line.split('=')[1].strip().strip('"')
+                print '[OVERRIDE] adding static routes: %s' % static_routes
 
     return nic, gatewaycheck, force_nics, safe_nics, static_routes
 
@@ -147,28 +2054,32 @@ def check_version():
     """
     if sys.platform != 'darwin':
         sys.exit('macOS required but not detected')
-    if pkg_resources.parse_version(platform.release()) >= \
-            pkg_resources.parse_version('15.6.0'):
+    if parse_release(os.uname()[2]) >= parse_release(UNSUPPORTED_RELEASE):
         sys.exit('Exiting: DHCP option 121 is built into this OS')
 
 
-def clear_routes(forcenics, safenics):
+def clear_routes(forcenics, safenics, backend=None, interfaces=None):
     """
     Clears out all static routes associated with NICs that are in a down state
     and not on the safenics override list.
 
     If the NIC isnt down but is specified on the forcenics override, that NICs
     routes will be deleted.
+
+    backend:
+        the RouteBackend to delete routes with, see get_route_backend
+
+    interfaces:
+        the Interface records of get_interface_inventory when the caller
+        already read them, otherwise they are read here
     """
+    backend = backend or get_route_backend()
     # Get routing table with masks
-    routes = get_route_table_with_masks()
+    routes = get_route_snapshot()
 
-    # Build up a list of nics
-    nics = []
-    interfaces = get_ipv4_interfaces()
-    for line in interfaces.splitlines():
-        if re.match(r'^\w+: ', line):
-            nics.append(line.split(':')[0].strip())
+    # Build up a list of nics, read in one pass with their link states
+    if interfaces is None:
+        interfaces = get_interface_inventory()
 
     # Build up a list of nics to clear the routes from
     clear_nics = []
@@ -183,26 +2094,48 @@ def clear_routes(forcenics, safenics):
 
     # Remove the routes from the list of clear_nics if the nic
     # isnt in the safenic_list and the nic is down
-    for nic in nics:
+    for interface in interfaces:
+        nic = interface.name
         if nic not in safenics_list:
-            # should match "None" and "not set"
-            if re.match('[Nn][Oo]', get_hardware_link_state(nic)[:2]):
+            # only a link known to be down, an unknown link state (no
+            # media, such as lo0) is left alone
+            if interface.link is False:
                 if nic not in clear_nics:
                     clear_nics.append(nic)
 
     # For each nic in the clear_nics list, go through the route table
     # and remove the nics associated routes
+    operations = []
     for nic in clear_nics:
-        for route in routes:
-            if nic == route[3]:
-                route_cmd(route=[route[0], route[1], route[2]],
-                          routeverb='delete')
+        for route in routes.routes_on(nic):
+            print '[CLEAR] delete %s on %s' % (route, nic)
+            operations.append(('delete', route))
+    for result in apply_operations(operations, backend):
+        count_metric('dhcp_121_route_operations_total',
+                     interface=result.route.interface, operation='delete')
+        if JOURNAL is not None:
+            JOURNAL.operation(result.route.interface, result)
+        if result.error:
+            count_metric('dhcp_121_route_failures_total',
+                         interface=result.route.interface,
+                         operation='delete')
+            print '[CLEAR] failed delete %s: %s' % (result.route,
+                                                    result.error)
+
+
+def count_metric(name, value=1, **labels):
+    """
+    Adds value to the counter name with the labels while metrics are on,
+    see METRICS
+    """
+    if METRICS is not None:
+        METRICS.add(name, value, **labels)
 
 
 def decode_option_121(option_data):
     """
     This function decodes the DHCP option 121 data format
-    into a list of tuples in the form of (netmask, subnet_route, gateway)
+    into a list of Routes
 
     DHCP option 121 data comes across from the output of
     'ipconfig getpacket <interface>' in the following format:
@@ -227,104 +2160,247 @@ def decode_option_121(option_data):
     0030  a8 06 c0 a8 00 1d 11 0a  02 f0 c0 a8 0a c8        ..............
 
     end (none):
+
+    The hexdump is converted to bytes once (see hexdump_to_bytes) and the
+    routes are decoded from those bytes by decode_classless_routes.
     """
-    # The byte_stream is a list that will be filled in with just the data
-    # bytes containing network mask, subnet and gateway information:
-    byte_stream = []
+    return decode_classless_routes(hexdump_to_bytes(option_data))
 
-    # Fill the byte_stream only with right sized byte representations from
-    # the output parsed line by line - filter out the line numbers and byte
-    # count dots
-    for line in option_data:
-        splitted = line.split()
-        for entry in splitted:
 
-            # Only append entries two characters wide that were surrounded by
-            # spaces
-            if len(entry) < 3:
-                # Guard against including the byte count dots when only two
-                # data bytes are present
-                if entry is not '..':
-                    byte_stream.append(entry)
+def decode_classless_routes(data):
+    """
+    Decodes option 121 (or 249) data into a list of Routes, without an
+    interface, see iter_classless_routes
+
+    data:
+        the option data as bytes or a memoryview, from DhcpPacket.get for
+        instance
 
-    # By default a subnet_mask is not assumed to be set:
-    subnet_mask = 0
+    Routes that decoded before any malformed data are kept.
+    """
+    routes = []
+    try:
+        for network, prefixlen, gateway in iter_classless_routes(data):
+            routes.append(Route(network, prefixlen, gateway))
+    except ValueError as error:
+        print '[OPTION121] ignoring malformed option data: %s' % error
+    return routes
 
-    # By default there is no subnet specified:
-    net_bytes = 0
 
-    # A gateway will always be specified with four bytes:
-    gateway_bytes = 4
+def decode_lease(lease):
+    """
+    Decodes the option 121 data of a Lease from get_lease into its routes
 
-    # Pattern build up holding lists:
-    dot_subnet = []
-    dot_gateway = []
+    Returns the Routes
+    """
+    with trace_span('decode_routes', nic=lease.nic) as span:
+        lease.routes = decode_classless_routes(lease.option_data)
+        span.set('routes', len(lease.routes))
+    count_metric('dhcp_121_routes_decoded_total', len(lease.routes),
+                 interface=lease.nic)
+    if JOURNAL is not None:
+        JOURNAL.lease(lease.nic, lease.routes)
+    return lease.routes
 
-    # This list will be returned by the function
-    routes = []
 
-    # Parse the byte stream one byte at a time:
-    for byte in byte_stream:
-        # Convert the bytes to decimal
-        byte = int(byte, 16)
+def dump_route_table():
+    """
+    Reads the kernel's IPv4 routing table without running netstat: an
+    RTM_GETROUTE dump of the main table over netlink on Linux, the
+    NET_RT_DUMP sysctl elsewhere
 
-        # If the subnet_mask is set then we're looking for the subnet and
-        # gateway bytes that must appear after
-        if subnet_mask:
-            if net_bytes:
-                dot_subnet.append(str(byte))
-                net_bytes -= 1
+    Only the routes netstat would list with a gateway address are kept
+    (see iter_route_table), along with the default route at prefix
+    length 0.
 
-            # Once the net_bytes counter is depleted we know the next
-            # bytes in the stream represent the gateway
-            else:
-                dot_gateway.append(str(byte))
-                gateway_bytes -= 1
-
-            # Once the gateway_bytes are taken from the stream a complete
-            # route is present and stored.  There are potentially additional
-            # routes to process so it must reset the control logic variables
-            # for the next route to be determined.
-            if not gateway_bytes:
-                while len(dot_subnet) < 4:
-                    dot_subnet.append('0')
-                subnet = '.'.join(dot_subnet)
-                gateway = '.'.join(dot_gateway)
-                routes.append((subnet, subnet_mask, gateway))
-
-                # Reset the following for the next bytes in the stream:
-                subnet_mask = 0
-                dot_subnet = []
-                dot_gateway = []
-                gateway_bytes = 4
-        else:
-            # Subnet_mask is determined by bit position,
-            # where its always leading so as to determine
-            # the byte positions for the subnet and gateway
-            subnet_mask = byte
-
-            # The number of bytes following the subnet entry
-            # that represent the subnet and gateway
-            net_bytes = subnet_mask / 8
+    Returns a list of Routes
+    """
+    import socket
+    import struct
+    if sys.platform.startswith('linux'):
+        dump = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                             NETLINK_ROUTE)
+        try:
+            dump.bind((0, 0))
+            rtmsg = struct.pack('=BBBBBBBBL', socket.AF_INET, 0, 0, 0, 0, 0,
+                                0, 0, 0)
+            dump.send(struct.pack('=LHHLL', 16 + len(rtmsg), RTM_GETROUTE,
+                                  NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + rtmsg)
+            routes = []
+            while True:
+                for message_type, route in iter_netlink_routes(
+                        dump.recv(65536)):
+                    if message_type == NLMSG_DONE:
+                        return routes
+                    if route is not None:
+                        routes.append(route)
+        finally:
+            dump.close()
+
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    name = (ctypes.c_int * 6)(CTL_NET, PF_ROUTE, 0, socket.AF_INET,
+                              NET_RT_DUMP, 0)
+    size = ctypes.c_size_t()
+    # the table can grow between sizing the buffer and filling it
+    while True:
+        if libc.sysctl(name, 6, None, ctypes.byref(size), None, 0) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        size.value += size.value // 8
+        data = ctypes.create_string_buffer(size.value)
+        if libc.sysctl(name, 6, data, ctypes.byref(size), None, 0) == 0:
+            break
+        if ctypes.get_errno() != errno.ENOMEM:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    routes = []
+    data = data.raw[:size.value]
+    offset = 0
+    while offset + 2 <= len(data):
+        length = struct.unpack_from('=H', data, offset)[0]
+        if not length:
+            break
+        route = parse_routing_message(data[offset:offset + length])[1]
+        if route is not None:
+            routes.append(route)
+        offset += length
     return routes
 
 
+def encode_option_121(routes):
+    """
+    Encodes routes into the RFC 3442 classless static route format,
+    the inverse of iter_classless_routes
+
+    routes:
+        an iterable of (network, prefixlen, gateway) integer records
+
+    Returns the option payload as bytes (without the code and length
+    octets, see split_option for the wire format)
+    """
+    import struct
+    payload = bytearray()
+    for network, prefixlen, gateway in routes:
+        if not 0 <= prefixlen <= 32:
+            raise ValueError('invalid prefix length: %s' % prefixlen)
+        significant = (prefixlen + 7) // 8
+        payload.append(prefixlen)
+        payload.extend(struct.pack('!L', network)[:significant])
+        payload.extend(struct.pack('!L', gateway))
+    return bytes(payload)
+
+
+def evict_state_cache(reason):
+    """
+    Removes the STATE_FILE so the next run does the full work
+    """
+    print '[CACHE] discarding %s: %s' % (STATE_FILE, reason)
+    try:
+        os.remove(STATE_FILE)
+    except OSError:
+        pass
+
+
+def format_labels(labels):
+    """
+    Returns a dictionary of metric labels in the Prometheus text format,
+    {name="value",...} in the order of the names, '' when there are none
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items()))
+
+
+def get_command_runner():
+    """
+    Returns the CommandRunner that run_command uses, a plain CommandRunner
+    unless set_command_runner chose another
+    """
+    if COMMAND_RUNNER is None:
+        set_command_runner(CommandRunner())
+    return COMMAND_RUNNER
+
+
 def get_default_nic():
     """
     Returns the NIC with the default route, which is usually where the DHCP
     response packet can be found
     """
     # by default, check en1 (Macbook Pro, etc.)
-    nic = 'en1'
+    return get_route_snapshot().default_interface or 'en1'
+
+
+def get_desired_routes(routes, addresses, gatewaycheck, static_routes):
+    """
+    Determines the routes that should be in the routing table: the decoded
+    option 121 routes followed by the override file's static routes, less
+    any whose gateway isnt on a network of the addresses.
+
+    routes:
+        Routes from decode_option_121
+
+    addresses:
+        (ip address, mask, broadcast) tuples from get_ip_addresses
+
+    gatewaycheck:
+        False to keep routes regardless of their gateway
+
+    static_routes:
+        the staticroutes override value, see parse_static_routes
+
+    Returns an ordered dictionary of (network, prefixlen) to Routes, and
+    a list of (route, reason) pairs for the routes left out.  The first
+    route given for a prefix wins.
+    """
+    import collections
+    routes = list(routes) + parse_static_routes(static_routes)
+    # A gateway is reachable when a network of the addresses contains it
+    if gatewaycheck:
+        reachable = get_reachable_gateways(
+            [route.gateway for route in routes], addresses)
+    else:
+        reachable = [True] * len(routes)
+
+    desired = collections.OrderedDict()
+    skipped = []
+    for route, gateway_reachable in zip(routes, reachable):
+        if not gateway_reachable:
+            skipped.append((route, 'gateway_unreachable'))
+        elif route.key in desired:
+            skipped.append((route, 'duplicate'))
+        else:
+            desired[route.key] = route
+    return desired, skipped
+
+
+def get_early_option(argv, name):
+    """
+    Returns the value of the command line option name ('--replay DIR' or
+    '--replay=DIR') from argv, or None, for the options that are needed
+    before parse_args is called
+    """
+    for index, arg in enumerate(argv):
+        if arg == name and index + 1 < len(argv):
+            return argv[index + 1]
+        if arg.startswith(name + '='):
+            return arg[len(name) + 1:]
+    return None
 
-    route_table = get_route_table()
 
-    # check the route_table for a default route and parse the nic
-    for line in route_table.splitlines():
-        # assumes one default route exists:
-        if re.search('^default', line):
-            nic = line.split()[5]
-    return nic
+def get_fixture_name(cmd, number=1):
+    """
+    Returns the fixture file name for the numberth output of cmd, such as
+    'netstat_-f_inet_-rn.out' or 'netstat_-f_inet_-rn.2.out'
+    """
+    name = re.sub(r'[^A-Za-z0-9.-]+', '_', cmd).strip('_')
+    if number > 1:
+        name = '%s.%d' % (name, number)
+    return name + '.out'
 
 
 def get_hardware_link_state(nic):
@@ -338,13 +2414,7 @@ def get_hardware_link_state(nic):
     """
     # get the media state of the specific nic
     cmd = 'networksetup -getmedia %s' % nic
-
-    try:
-        p = subprocess.Popen(cmd.split(), stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-    except subprocess.CalledProcessError:
-        stdout = ''
+    stdout = run_command(cmd)
 
     state = ''
     if stdout:
@@ -354,6 +2424,160 @@ def get_hardware_link_state(nic):
     return state
 
 
+def get_ifindex(interface):
+    """
+    Returns the ifindex Routes use for the interface name, registering the
+    name in INTERFACE_NAMES the first time it is seen
+    """
+    ifindex = INTERFACE_INDEXES.get(interface)
+    if ifindex is None:
+        ifindex = INTERFACE_INDEXES.setdefault(interface,
+                                               len(INTERFACE_NAMES))
+        if ifindex == len(INTERFACE_NAMES):
+            INTERFACE_NAMES.append(interface)
+    return ifindex
+
+
+def get_interface_inventory():
+    """
+    Reads every network interface with its IPv4 addressing and link state
+    in a single pass, with getifaddrs where it is available and from the
+    ifconfig and networksetup commands otherwise
+
+    Returns a list of Interface records in the order the system lists them
+    """
+    if not get_command_runner().native:
+        return get_interfaces_from_ifconfig()
+    try:
+        return get_interfaces_from_getifaddrs()
+    except (ImportError, AttributeError, OSError) as error:
+        print '[INVENTORY] getifaddrs unavailable, using ifconfig: %s' % error
+        return get_interfaces_from_ifconfig()
+
+
+def get_interfaces_from_getifaddrs():
+    """
+    Builds the interface inventory from getifaddrs(3), called through ctypes
+
+    The link state comes from /sys/class/net on Linux and from the
+    SIOCGIFMEDIA ioctl elsewhere, see get_link_state.
+
+    Returns a list of Interface records
+    """
+    import socket
+    import struct
+    import ctypes
+
+    class IfAddrs(ctypes.Structure):
+        pass
+    IfAddrs._fields_ = [('ifa_next', ctypes.POINTER(IfAddrs)),
+                        ('ifa_name', ctypes.c_char_p),
+                        ('ifa_flags', ctypes.c_uint),
+                        ('ifa_addr', ctypes.c_void_p),
+                        ('ifa_netmask', ctypes.c_void_p),
+                        ('ifa_dstaddr', ctypes.c_void_p),
+                        ('ifa_data', ctypes.c_void_p)]
+
+    # BSD sockaddrs lead with a length octet before the family octet,
+    # Linux uses a 16 bit family in host byte order
+    bsd_sockaddr = not sys.platform.startswith('linux')
+
+    def ipv4_address(pointer):
+        if not pointer:
+            return None
+        raw = ctypes.string_at(pointer, 8)
+        if bsd_sockaddr:
+            family = ord(raw[1:2])
+        else:
+            family = struct.unpack('=H', raw[:2])[0]
+        if family != socket.AF_INET:
+            return None
+        return socket.inet_ntoa(raw[4:8])
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    head = ctypes.POINTER(IfAddrs)()
+    if libc.getifaddrs(ctypes.byref(head)) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+    names = []
+    flags = {}
+    addresses = {}
+    try:
+        entry = head
+        while entry:
+            ifaddr = entry.contents
+            name = ifaddr.ifa_name
+            if name not in flags:
+                names.append(name)
+                addresses[name] = []
+            flags[name] = int(ifaddr.ifa_flags)
+            ip_address = ipv4_address(ifaddr.ifa_addr)
+            if ip_address:
+                netmask = ipv4_address(ifaddr.ifa_netmask) or '0.0.0.0'
+                broadcast = None
+                if ifaddr.ifa_flags & IFF_BROADCAST:
+                    broadcast = ipv4_address(ifaddr.ifa_dstaddr)
+                addresses[name].append(
+                    (ip_address, bin(ip_to_int(netmask)).count('1'),
+                     broadcast))
+            entry = ifaddr.ifa_next
+    finally:
+        libc.freeifaddrs(head)
+
+    interfaces = []
+    media_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for name in names:
+            interfaces.append(Interface(
+                name=name, flags=flags[name], addresses=addresses[name],
+                up=bool(flags[name] & IFF_UP),
+                running=bool(flags[name] & IFF_RUNNING),
+                link=get_link_state(name, media_socket)))
+    finally:
+        media_socket.close()
+    return interfaces
+
+
+def get_interfaces_from_ifconfig():
+    """
+    Builds the interface inventory from 'ifconfig -a inet' output, with the
+    link state of each interface from get_hardware_link_state, the
+    interfaces' networksetup commands running side by side
+
+    Returns a list of Interface records
+    """
+    interfaces = []
+    name = None
+    for line in get_ipv4_interfaces().splitlines():
+        header = re.match(r'^(\S+): flags=([0-9a-fA-F]+)', line)
+        if header:
+            name = header.group(1)
+            flags = int(header.group(2), 16)
+            interfaces.append(Interface(
+                name=name, flags=flags, addresses=[],
+                up=bool(flags & IFF_UP), running=bool(flags & IFF_RUNNING),
+                link=None))
+            continue
+        inet = re.search(r'inet ((?:[0-9]{1,3}\.){3}[0-9]{1,3}) .*'
+                         r'netmask (0x[0-9a-fA-F]{8})'
+                         r'(?: broadcast ((?:[0-9]{1,3}\.){3}[0-9]{1,3}))?',
+                         line)
+        if inet and interfaces:
+            ip_address, mask, broadcast = inet.groups()
+            interfaces[-1].addresses.append(
+                (ip_address, bin(int(mask, 0)).count('1'), broadcast))
+
+    states = run_parallel(get_hardware_link_state,
+                          [interface.name for interface in interfaces],
+                          COMMAND_CONCURRENCY)
+    for interface, state in zip(interfaces, states):
+        # "None" and "not set" are a down link
+        if state:
+            interface.link = not re.match('[Nn][Oo]', state[:2])
+    return interfaces
+
+
 def get_ip_addresses(interface):
     """
     Determine the IPv4 addreses for the specified interface
@@ -361,24 +2585,12 @@ def get_ip_addresses(interface):
     interface:
         the macOS network interface name, such as 'en1' for /dev/en1
 
-    Returns a list of "ip address, netmask" tuples
-    """
-    cmd = '/sbin/ifconfig %s inet' % interface
-    p = subprocess.Popen(cmd.split(), stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    addresses = []
-    for line in stdout.splitlines():
-        inet = re.search(r'inet ((?:[0-9]{1,3}\.){3}[0-9]{1,3}) '
-                         r'netmask (0x[f0]{8}) '
-                         r'broadcast ((?:[0-9]{1,3}\.){3}[0-9]{1,3})',
-                         line)
-        if inet:
-            ip_address = inet.groups()[0]
-            mask = bin(int(inet.groups()[1], 0)).count('1')
-            broadcast = inet.groups()[2]
-            addresses.append((ip_address, mask, broadcast))
-    return addresses
+    Returns a list of "ip address, netmask, broadcast" tuples
+    """
+    for record in get_interface_inventory():
+        if record.name == interface:
+            return list(record.addresses)
+    return []
 
 
 def get_ipv4_interfaces():
@@ -387,10 +2599,7 @@ def get_ipv4_interfaces():
     """
     # show all the interfaces and ipv4 networking info
     cmd = 'ifconfig -a inet'
-    p = subprocess.Popen(cmd.split(), stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    return stdout
+    return run_command(cmd)
 
 
 def get_ipv4_routes(route_table):
@@ -411,34 +2620,176 @@ def get_ipv4_routes(route_table):
     return only_ipv4_routes
 
 
-def get_option(packet, option_code):
+def get_kernel_interface_name(index):
     """
-    Parses for the option_code's data from ipconfig output
+    Returns the name of the interface with the kernel interface index,
+    as if_indextoname(3) gives it, '' when there is no such interface
+    """
+    import ctypes
+    if not index:
+        return ''
+    name = ctypes.create_string_buffer(16)
+    if not ctypes.CDLL(None).if_indextoname(index, name):
+        return ''
+    return name.value
 
-    packet:
-        the packet data from "ipconfig getpacket"
 
-    option_code:
-        the DHCP option code to parse, for example "option_121"
+def get_lease(nic, addresses):
+    """
+    Reads the DHCP packet of the NIC and takes out its option 121 data,
+    which decode_lease decodes once the state cache has been checked
 
-    Returns a list populated with each line of packet data corresponding to
-    the DHCP option code.
+    addresses:
+        the (ip address, mask, broadcast) tuples of the NIC
+
+    Returns a Lease, or None when the NIC has no DHCP packet or its packet
+    cant be read, leaving the NIC's routes alone
     """
-    option = False
+    import socket
+    import struct
+    try:
+        packet = get_packet(nic)
+    except OSError as error:
+        if error.errno != errno.ETIMEDOUT:
+            raise
+        # a cut short packet would decode to part of the routes
+        print '[LEASE] %s: skipped, %s' % (nic, error.strerror)
+        return None
+    if not packet:
+        return None
+    with trace_span('decode', nic=nic) as span:
+        try:
+            packet = DhcpPacket(getpacket_to_bytes(packet))
+        except (ValueError, struct.error, socket.error) as error:
+            print '[LEASE] %s: skipped, unreadable DHCP packet: %s' % (
+                nic, error)
+            return None
+        option_data = packet.get(DHCP_CLASSLESS_ROUTES)
+        if option_data is None:
+            option_data = packet.get(DHCP_MS_CLASSLESS_ROUTES,
+                                     memoryview(''))
+        span.set('bytes', len(option_data))
+    return Lease(nic, addresses, option_data.tobytes())
+
+
+def get_lease_candidates(nic, default_nic, interfaces):
+    """
+    Lists the interfaces that may hold a DHCP lease in the order they win
+    a prefix that several of them route: the override nic, the NIC with
+    the default route, then every other interface that is up with an
+    IPv4 address and a link that isnt down, by name
+
+    interfaces:
+        the Interface records from get_interface_inventory
+
+    Returns a list of interface names
+    """
+    candidates = [name for name in (nic, default_nic) if name]
+    for interface in sorted(interfaces, key=lambda record: record.name):
+        if interface.up and interface.addresses and \
+                interface.link is not False and \
+                not interface.flags & IFF_LOOPBACK:
+            candidates.append(interface.name)
+    unique = []
+    for name in candidates:
+        if name not in unique:
+            unique.append(name)
+    return unique
+
+
+def get_link_state(nic, media_socket):
+    """
+    Report the hardware link state of a specified nic without running
+    networksetup
+
+    nic:
+        specify a device name, such as 'en1'
+
+    media_socket:
+        an AF_INET datagram socket to issue the SIOCGIFMEDIA ioctl on
+
+    Returns True when the link is active, False when it is down and None
+    when the interface doesnt report a link state
+    """
+    import struct
+    if sys.platform.startswith('linux'):
+        try:
+            operstate_file = open('/sys/class/net/%s/operstate' % nic)
+            try:
+                operstate = operstate_file.read().strip()
+            finally:
+                operstate_file.close()
+        except IOError:
+            return None
+        if operstate == 'up':
+            return True
+        if operstate in ('down', 'lowerlayerdown', 'dormant'):
+            return False
+        return None
+
+    import fcntl
+    request = struct.pack(IFMEDIAREQ, nic[:15], 0, 0, 0, 0, 0, 0)
+    try:
+        reply = fcntl.ioctl(media_socket.fileno(), SIOCGIFMEDIA, request)
+    except IOError:
+        return None
+    status = struct.unpack(IFMEDIAREQ, reply)[3]
+    if not status & IFM_AVALID:
+        return None
+    return bool(status & IFM_ACTIVE)
+
+
+def get_option(packet, option_code):
+    """
+    Parses for the option_code's data from ipconfig output
+
+    packet:
+        the packet data from "ipconfig getpacket"
+
+    option_code:
+        the DHCP option code to parse, for example "option_121"
+
+    Returns a list populated with each line of packet data corresponding to
+    the DHCP option code, the data lines of every instance of the option
+    when it was split (RFC 3396).  Option labels are matched exactly, so
+    option_12 doesnt pick up the lines of option_121.
+    """
+    option = False
     option_data = []
     for line in packet.splitlines():
-        if option:
+        label = GETPACKET_OPTION.match(line)
+        if label:
+            option = label.group(1) == option_code
+        elif option:
             if line:
                 option_data.append(line)
             else:
                 option = False
-
-        # this has to come after the decoder for the option line
-        if option_code in line:
-            option = True
     return option_data
 
 
+def get_override_value(name, default=''):
+    """
+    Returns the value of a "name = value" setting in the override file, with
+    any surrounding quotes removed, or default if the setting isnt present.
+    See the OVERRIDE_FILE comment at the top of this code.
+    """
+    value = default
+    if os.path.isfile(OVERRIDE_FILE) and os.access(OVERRIDE_FILE, os.R_OK):
+        file_handle = open(OVERRIDE_FILE)
+        try:
+            for line in file_handle:
+                if re.match(r'^\#', line) or '=' not in line:
+                    continue
+                key, setting = line.split('=', 1)
+                # the last setting in the file wins
+                if key.strip() == name:
+                    value = setting.strip().strip('"')
+        finally:
+            file_handle.close()
+    return value
+
+
 def get_packet(interface):
     """
     Retrieve the DHCP packet information to obtain the option data
@@ -453,68 +2804,302 @@ def get_packet(interface):
     Returns the getpacket data for the interface as a list of strings
     """
     cmd = '/usr/sbin/ipconfig getpacket %s' % interface
-    try:
-        p = subprocess.Popen(cmd.split(), stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-    except subprocess.CalledProcessError:
-        stdout = ''
-    return stdout
+    return run_command(cmd)
 
 
-def get_route_table():
+def get_reachable_gateways(gateways, addresses):
     """
-    Returns a routing table
+    Checks which gateways are on a network of the addresses
+
+    gateways:
+        32bit gateway addresses, those of a set of routes for instance
+
+    addresses:
+        (ip address, mask, broadcast) tuples from get_ip_addresses
+
+    With REACHABILITY_NUMPY_MIN gateways or more and NumPy installed, the
+    whole gateway by network matrix is computed at once on uint32 arrays.
+    Otherwise each gateway is masked once per distinct prefix length of
+    the networks and looked up in a set of the networks of that length.
+
+    Returns a list of booleans in the order of gateways
     """
-    # only show the ipv4 routing table without name resolution:
-    cmd = 'netstat -f inet -rn'
-    p = subprocess.Popen(cmd.split(), stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    return stdout
+    networks = {}
+    for ip_address, prefixlen, _ in addresses:
+        mask = PREFIX_MASKS[int(prefixlen)]
+        networks.setdefault(mask, set()).add(ip_to_int(ip_address) & mask)
+    if not networks:
+        return [False] * len(gateways)
+
+    if len(gateways) >= REACHABILITY_NUMPY_MIN:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None:
+            pairs = [(group_mask, network)
+                     for group_mask, group in networks.items()
+                     for network in group]
+            masks = numpy.array([group_mask for group_mask, _ in pairs],
+                                dtype=numpy.uint32)
+            connected = numpy.array([network for _, network in pairs],
+                                    dtype=numpy.uint32)
+            candidates = numpy.array(gateways, dtype=numpy.uint32)
+            matrix = (candidates[:, None] & masks) == connected
+            return matrix.any(axis=1).tolist()
+
+    groups = list(networks.items())
+    return [any((gateway & mask) in group for mask, group in groups)
+            for gateway in gateways]
+
+
+def get_route_backend(name=''):
+    """
+    Returns the RouteBackend to program routes with
 
+    name:
+        'subprocess' runs the route command per operation, 'socket' writes
+        route messages to the kernel routing socket (PF_ROUTE on macOS,
+        AF_NETLINK on Linux) and 'fake' keeps an in-memory table only.
+        By default the routing socket is used where it can be opened, with
+        the route command as the fallback.
 
-def get_route_table_with_masks():
+    Backends are created once and shared by every later call for the same
+    name, so one routing socket serves a whole run.
+    """
+    import socket
+    if name in ROUTE_BACKENDS:
+        return ROUTE_BACKENDS[name]
+
+    backend = None
+    if name == 'fake':
+        backend = FakeRouteBackend()
+    elif name in ('', 'socket'):
+        try:
+            if sys.platform.startswith('linux'):
+                backend = NetlinkRouteBackend()
+            elif sys.platform == 'darwin' or 'bsd' in sys.platform:
+                backend = RoutingSocketBackend()
+        except (AttributeError, socket.error) as error:
+            print '[BACKEND] routing socket unavailable: %s' % error
+    elif name != 'subprocess':
+        print '[BACKEND] unknown backend %s, using subprocess' % name
+
+    backend = backend or SubprocessRouteBackend()
+    ROUTE_BACKENDS[name] = backend
+    return backend
+
+
+def get_route_snapshot():
+    """
+    Returns the RouteTable of the system's routing table, read on the first
+    call and shared by the later ones until a route is written (see
+    invalidate_route_snapshot).  With a ROUTE_MIRROR the mirror's table is
+    returned, up to date with every route message received.
+    """
+    global ROUTE_SNAPSHOT
+    if ROUTE_MIRROR is not None:
+        return ROUTE_MIRROR.read()
+    if ROUTE_SNAPSHOT is None:
+        ROUTE_SNAPSHOT = get_route_table_with_masks()
+    return ROUTE_SNAPSHOT
+
+
+def get_route_table_with_masks(route_table=None):
     """
     Return a route table with the subnet routes 0 padded.  Subnets without
-    a bit
+    a bit count are given their classful mask, host routes a 32 bit mask.
+
+    route_table:
+        netstat output to parse instead of querying the system, which is
+        otherwise read as netstat writes it (see iter_route_table)
+
+    Returns a RouteTable of Routes
     """
-    # Parse the netstat output into a split line by line list of lists
-    route_table = [item.split() for item in get_route_table().splitlines()]
+    if route_table is None:
+        lines = get_command_runner().stream('netstat -f inet -rn')
+    else:
+        lines = route_table.splitlines()
 
-    # Build a list of only the IPv4 static routes
-    only_ipv4_routes = get_ipv4_routes(route_table)
+    routes = RouteTable()
+    for route in iter_route_table(lines):
+        if not route.prefixlen:
+            # assumes one default route exists
+            routes.default_interface = route.interface
+        else:
+            routes.add(route)
+    return routes
 
-    # Build the final list in presentable view
-    routes = []
-    for route in only_ipv4_routes:
-        # Subnet, mask, gateway and interface
-        if '/' in route[0]:
-            target, mask = route[0].split('/')
+
+def get_state_key(leases, interfaces):
+    """
+    Hashes everything a run derives its routes from: the leased NICs and
+    their raw option 121 data, in order, the override file and the
+    addresses and link states of every interface
+
+    Returns the hex digest
+    """
+    import hashlib
+    digest = hashlib.sha256()
+    for lease in leases:
+        digest.update(lease.nic + '\0')
+        digest.update(lease.option_data + '\0')
+    if os.path.isfile(OVERRIDE_FILE) and os.access(OVERRIDE_FILE, os.R_OK):
+        file_handle = open(OVERRIDE_FILE, 'rb')
+        try:
+            digest.update(file_handle.read())
+        finally:
+            file_handle.close()
+    digest.update('\0')
+    for interface in interfaces:
+        digest.update(repr((interface.name, interface.addresses,
+                            interface.link)))
+    return digest.hexdigest()
+
+
+def get_watch_state():
+    """
+    Returns the modification times of the WATCH_PATHS and the override
+    file, None for a missing file, to detect changes by comparison
+    """
+    state = []
+    for path in WATCH_PATHS + [OVERRIDE_FILE]:
+        try:
+            state.append(os.stat(path).st_mtime)
+        except OSError:
+            state.append(None)
+    return tuple(state)
+
+
+def getpacket_to_bytes(packet):
+    """
+    Rebuilds the BOOTP wire bytes of a DHCP packet from 'ipconfig
+    getpacket' output, for DhcpPacket
+
+    packet:
+        the packet data from "ipconfig getpacket"
+
+    Hexdumped options are taken byte for byte.  Options shown as values
+    are encoded back by their type (uint8, uint16, uint32, ip, ip_mult,
+    ip_pairs, string and their _mult forms), options of other types are
+    left out.  Options over 255 bytes are split (RFC 3396).
+
+    Returns the packet as bytes
+    """
+    import collections
+    import struct
+    fields = {}
+    options = collections.OrderedDict()
+    label = None
+    for line in packet.splitlines():
+        match = GETPACKET_OPTION.match(line)
+        if match:
+            name, kind, value = match.groups()
+            code = GETPACKET_OPTION_CODES.get(name)
+            if code is None and re.match(r'^option_\d+$', name):
+                code = int(name[len('option_'):])
+            label = None
+            if code is not None and kind != 'none':
+                label = options.setdefault(code, [kind, [], []])
+                label[1].append(value)
+            continue
+        if label is not None:
+            if line:
+                label[2].append(line)
+            else:
+                label = None
+            continue
+        match = GETPACKET_FIELD.match(line)
+        if match and not options:
+            fields[match.group(1)] = match.group(2).strip()
+
+    def number(name):
+        value = fields.get(name, '0').split()
+        if not value:
+            return 0
+        if value[-1] in ('BOOTREQUEST', 'BOOTREPLY'):
+            return 1 if value[-1] == 'BOOTREQUEST' else 2
+        return int(value[-1], 0)
+
+    def address(name):
+        return struct.pack('!L', ip_to_int(fields.get(name) or '0.0.0.0'))
+
+    chaddr = bytearray(int(octet, 16) for octet in
+                       fields.get('chaddr', '').split(':') if octet)
+    wire = bytearray(struct.pack(
+        BOOTP_HEADER, number('op'), number('htype'), number('hlen'),
+        number('hops'), number('xid'), number('secs'), number('flags'),
+        address('ciaddr'), address('yiaddr'), address('siaddr'),
+        address('giaddr'), bytes(chaddr[:16]),
+        fields.get('sname', '')[:64], fields.get('file', '')[:128]))
+    wire.extend(DHCP_MAGIC_COOKIE)
+
+    formats = {'uint8': '!B', 'uint16': '!H', 'uint32': '!L',
+               'int32': '!l', 'bool': '!B'}
+    for code, (kind, values, hexdump) in options.items():
+        base = kind.replace('_mult', '')
+        if hexdump:
+            payload = hexdump_to_bytes(hexdump)
+        elif base in ('ip', 'ip_pairs'):
+            payload = ''.join(
+                struct.pack('!L', ip_to_int(ip_address)) for ip_address in
+                re.findall(r'(?:[0-9]{1,3}\.){3}[0-9]{1,3}', ' '.join(values)))
+        elif base in formats:
+            numbers = re.findall(r'0x[0-9a-fA-F]+|\b[0-9]+\b',
+                                 ' '.join(values))
+            if base == kind:
+                # the value ends the line, "ACK 0x5" for instance
+                numbers = numbers[-1:]
+            payload = ''.join(struct.pack(formats[base], int(value, 0))
+                              for value in numbers)
+        elif kind == 'string':
+            payload = ''.join(values)
         else:
-            target = route[0]
-            mask = ''
-
-        # Pads out the route entries as an IP (target) within
-        # the subnet.
-        while target.count('.') < 3:
-            target = target + '.0'
-
-        if not mask:
-            bit_subnet = ip_address_to_32bit(target)
-            if bit_subnet[:1] == '0':
-                mask = '8'
-            if bit_subnet[:2] == '10':
-                mask = '16'
-            if bit_subnet[:3] == '11':
-                mask = '24'
-
-        # The new routing moves the old fields over except the padded address
-        # and adds in the bits field to preserve the subnet information that
-        # may have been removed from the old address in route[0]
-        routes.append([target, mask, route[1], route[5]])
+            continue
+        wire.extend(split_option(code, payload))
+    wire.append(DHCP_END)
+    return bytes(wire)
 
-    return routes
+
+def hexdump_to_bytes(option_data):
+    """
+    Converts the hexdump lines of an 'ipconfig getpacket' option into bytes
+
+    option_data:
+        a list of hexdump lines as returned by get_option
+
+    Only the 16 byte columns following the offset are read, so the byte
+    count dots (or any printable characters shown in their place) are never
+    mistaken for data.  Long options sent as several option instances
+    (RFC 3396) are reassembled by concatenating their data in the order
+    the lines appear.
+
+    Returns the option data as bytes
+    """
+    hex_digits = []
+    for line in option_data:
+        match = HEXDUMP_LINE.match(line)
+        if match:
+            hex_digits.extend(HEX_BYTE.findall(match.group(1)[:48]))
+    return binascii.unhexlify(''.join(hex_digits))
+
+
+def int_to_ip(address):
+    """
+    Returns the dotted quad string for a 32bit integer address
+    """
+    import socket
+    import struct
+    return socket.inet_ntoa(struct.pack('!L', address))
+
+
+def invalidate_route_snapshot():
+    """
+    Discards the shared routing table snapshot, see get_route_snapshot,
+    the next reader reads the routing table again
+    """
+    global ROUTE_SNAPSHOT
+    ROUTE_SNAPSHOT = None
 
 
 def ip_address_to_32bit(address):
@@ -522,6 +3107,8 @@ def ip_address_to_32bit(address):
     Returns IP address converted to a "32bit" long binary string
     127.0.0.1 will be returned as 01111111000000000000000000000001
     """
+    import socket
+    import struct
     binary = bin(struct.unpack('!L', socket.inet_aton(address))[0])
     # Remove the leading '0b' text:
     binary = binary[2:]
@@ -531,13 +3118,731 @@ def ip_address_to_32bit(address):
     return binary
 
 
-def route_cmd(route, routeverb=''):
+def ip_to_int(address):
+    """
+    Returns the 32bit integer for a dotted quad string address
+    """
+    import socket
+    import struct
+    return struct.unpack('!L', socket.inet_aton(address))[0]
+
+
+def iter_classless_routes(data):
+    """
+    Decodes RFC 3442 classless static route data
+
+    data:
+        the option payload as bytes, bytearray or memoryview
+
+    Each route is a prefix length octet, the significant octets of the
+    network ((prefixlen + 7) / 8 of them) and four gateway octets.  The
+    fields are read straight from a memoryview of the data, the network
+    being the leading octets of the 32bit word that starts after the
+    prefix length (the gateway octets always follow, so the word is
+    always present in well formed data).
+
+    Raises ValueError on a prefix length above 32 or a truncated route,
+    after yielding the routes that preceded it.
+
+    Yields (network, prefixlen, gateway) integer records
+    """
+    import struct
+    view = memoryview(data)
+    length = len(view)
+    unpack_byte = struct.Struct('!B').unpack_from
+    unpack_word = struct.Struct('!L').unpack_from
+    offset = 0
+    while offset < length:
+        prefixlen = unpack_byte(view, offset)[0]
+        if prefixlen > 32:
+            raise ValueError('invalid prefix length %d at offset %d'
+                             % (prefixlen, offset))
+        significant = (prefixlen + 7) // 8
+        end = offset + 1 + significant + 4
+        if end > length:
+            raise ValueError('truncated route at offset %d' % offset)
+        mask = PREFIX_MASKS[prefixlen]
+        network = unpack_word(view, offset + 1)[0] & mask
+        gateway = unpack_word(view, offset + 1 + significant)[0]
+        yield network, prefixlen, gateway
+        offset = end
+
+
+def iter_netlink_routes(data):
+    """
+    Parses the rtnetlink messages of a netlink read, as read by
+    dump_route_table and RouteMirror
+
+    Yields (message type, Route) for the IPv4 unicast routes of the main
+    table through a gateway and the default route, (message type, None)
+    for every other message (cloned routes included)
+    """
+    import socket
+    import struct
+    offset = 0
+    while offset + 16 <= len(data):
+        length, message_type = struct.unpack_from('=LH', data, offset)
+        route = None
+        if message_type in (RTM_NEWROUTE, RTM_DELROUTE) and \
+                length >= 28:
+            family, prefixlen, _, _, table, _, _, route_type, flags = \
+                struct.unpack_from('=BBBBBBBBL', data, offset + 16)
+            network = gateway = ifindex = 0
+            position = offset + 28
+            while position + 4 <= offset + length:
+                size, attribute = struct.unpack_from('=HH', data, position)
+                if size < 4:
+                    break
+                if attribute == NETLINK_RTA_DST:
+                    network = struct.unpack_from('!L', data, position + 4)[0]
+                elif attribute == NETLINK_RTA_GATEWAY:
+                    gateway = struct.unpack_from('!L', data, position + 4)[0]
+                elif attribute == NETLINK_RTA_OIF:
+                    ifindex = struct.unpack_from('=i', data, position + 4)[0]
+                elif attribute == NETLINK_RTA_TABLE:
+                    table = struct.unpack_from('=I', data, position + 4)[0]
+                position += (size + 3) & ~3
+            # cloned routes are the kernel's route cache, not the table
+            if family == socket.AF_INET and table == RT_TABLE_MAIN and \
+                    route_type == RTN_UNICAST and \
+                    not flags & RTM_F_CLONED and (gateway or not prefixlen):
+                route = Route(network & PREFIX_MASKS[prefixlen], prefixlen,
+                              gateway,
+                              get_ifindex(get_kernel_interface_name(ifindex)))
+        yield message_type, route
+        offset += (length + 3) & ~3 or len(data)
+
+
+def iter_route_table(lines):
+    """
+    Parses 'netstat -f inet -rn' output a line at a time, so the output is
+    never held whole
+
+    lines:
+        an iterable of netstat output lines, such as the stream of a
+        CommandRunner
+
+    Only IPv4 routes through a gateway address are kept (see
+    get_ipv4_routes), their targets 0 padded.  Subnets without a bit count
+    are given their classful mask, host routes a 32 bit mask.  The default
+    route is yielded as 0.0.0.0/0, with a gateway of 0 when it isnt an
+    address.
+
+    Yields Routes
+    """
+    import socket
+    import struct
+    inet_aton = socket.inet_aton
+    unpack_word = struct.Struct('!L').unpack
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 6:
+            continue
+        target = fields[0]
+        gateway = fields[1]
+        if target == 'default':
+            if NETSTAT_GATEWAY.match(gateway):
+                gateway = unpack_word(inet_aton(gateway))[0]
+            else:
+                gateway = 0
+            yield Route(0, 0, gateway, get_ifindex(fields[5]))
+            continue
+        if not NETSTAT_GATEWAY.match(gateway) or 'default' in target:
+            continue
+
+        if '/' in target:
+            target, mask = target.split('/', 1)
+            prefixlen = int(mask)
+        else:
+            prefixlen = None
+        # Pads out the route entries as an IP (target) within the subnet
+        dots = target.count('.')
+        if dots < 3:
+            target += '.0' * (3 - dots)
+        network = unpack_word(inet_aton(target))[0]
+
+        if prefixlen is None:
+            if 'H' in fields[2]:
+                prefixlen = 32
+            elif network < 0x80000000:
+                prefixlen = 8
+            elif network < 0xc0000000:
+                prefixlen = 16
+            elif network < 0xe0000000:
+                prefixlen = 24
+            else:
+                # class D and E destinations have no classful mask
+                prefixlen = 32
+        yield Route(network & PREFIX_MASKS[prefixlen], prefixlen,
+                    unpack_word(inet_aton(gateway))[0],
+                    get_ifindex(fields[5]))
+
+
+def open_route_monitor():
+    """
+    Opens a socket that receives the kernel's interface, address and route
+    change messages: a PF_ROUTE socket on macOS, an AF_NETLINK socket joined
+    to the link, IPv4 address and IPv4 route groups on Linux
+
+    Returns the non-blocking socket, or None if one can't be opened
+    """
+    import socket
+    try:
+        if sys.platform.startswith('linux'):
+            monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                    NETLINK_ROUTE)
+            monitor.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR |
+                          RTMGRP_IPV4_ROUTE))
+        else:
+            monitor = socket.socket(PF_ROUTE, socket.SOCK_RAW, 0)
+    except (AttributeError, socket.error) as error:
+        print '[DAEMON] routing socket unavailable, watching files: %s' % error
+        return None
+    monitor.setblocking(False)
+    return monitor
+
+
+def parse_args(argv=None):
+    """
+    Returns the parsed command line options
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Set the DHCP option 121 static routes of this host')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report the route changes without making them')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and reconcile the routes '
+                             'whenever interfaces or routes change')
+    fixtures = parser.add_mutually_exclusive_group()
+    fixtures.add_argument('--record', metavar='DIR',
+                          help='save the output of every command ran to DIR')
+    fixtures.add_argument('--replay', metavar='DIR',
+                          help='serve the command outputs from a --record '
+                               'DIR instead of running them')
+    parser.add_argument('--replay-latency', type=float, default=0.0,
+                        metavar='SECONDS',
+                        help='delay every replayed command by SECONDS')
+    parser.add_argument('--trace', metavar='DESTINATION',
+                        help='write a JSON line per traced phase to the '
+                             'file DESTINATION, or unix:PATH for a socket')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the run and write the pstats to FILE')
+    parser.add_argument('--journal-report', action='store_true',
+                        help='summarize the run journal instead of running')
+    parser.add_argument('--journal', metavar='FILE', default=JOURNAL_FILE,
+                        help='the journal to summarize')
+    parser.add_argument('--window', type=float, default=24.0,
+                        metavar='HOURS',
+                        help='summarize the passes of the last HOURS')
+    return parser.parse_args(argv)
+
+
+def parse_release(release):
+    """
+    Returns the leading dotted numbers of a release string as a tuple of
+    three or more integers for comparison, '14.5.0' is (14, 5, 0) and
+    '15.6' is (15, 6, 0)
+    """
+    numbers = []
+    for part in release.split('.'):
+        match = re.match(r'\d+', part)
+        if not match:
+            break
+        numbers.append(int(match.group()))
+        if match.end() != len(part):
+            break
+    while len(numbers) < 3:
+        numbers.append(0)
+    return tuple(numbers)
+
+
+def parse_routing_message(data):
+    """
+    Parses a PF_ROUTE message, a struct rt_msghdr followed by its sockaddrs,
+    as read from a routing socket or the NET_RT_DUMP sysctl
+
+    Interface scoped routes (the per interface copies macOS keeps of a
+    route), routes cloned from another (RTF_WASCLONED), link layer (ARP)
+    entries and failed requests are left out, as are the routes netstat
+    wouldnt list with a gateway address (see iter_route_table).
+
+    Returns (message type, Route), the Route None for any other message
+    """
+    import socket
+    import struct
+    if len(data) < 4:
+        return None, None
+    message_type = ord(data[3])
+    if message_type not in (RTM_ADD, RTM_DELETE, RTM_CHANGE, RTM_GET) or \
+            len(data) < RT_MSGHDR_SIZE:
+        return message_type, None
+    fields = struct.unpack_from(RT_MSGHDR, data)
+    length, index, flags, addresses, error = \
+        fields[0], fields[3], fields[4], fields[5], fields[8]
+    if error or flags & (RTF_IFSCOPE | RTF_WASCLONED | RTF_LLINFO):
+        return message_type, None
+
+    # the sockaddrs present, in RTA_* bit order, each padded to 4 bytes
+    sockaddrs = []
+    position = RT_MSGHDR_SIZE
+    for bit in range(8):
+        if addresses & (1 << bit) and position < length:
+            size = ord(data[position])
+            sockaddrs.append(data[position:position + size])
+            position += (size + 3) & ~3 or 4
+        else:
+            sockaddrs.append(None)
+    destination, gateway, netmask = sockaddrs[:3]
+    if not destination or len(destination) < 8 or \
+            ord(destination[1]) != socket.AF_INET:
+        return message_type, None
+    network = struct.unpack('!L', destination[4:8])[0]
+
+    if flags & RTF_HOST:
+        prefixlen = 32
+    elif netmask is None:
+        prefixlen = 32
+    else:
+        # the netmask sockaddr is cut short after its last nonzero byte
+        mask = (netmask[4:8] + '\0' * 4)[:4]
+        prefixlen = bin(struct.unpack('!L', mask)[0]).count('1')
+    if gateway and len(gateway) >= 8 and ord(gateway[1]) == socket.AF_INET:
+        gateway = struct.unpack('!L', gateway[4:8])[0]
+    elif prefixlen:
+        return message_type, None
+    else:
+        gateway = 0
+    return message_type, Route(
+        network & PREFIX_MASKS[prefixlen], prefixlen, gateway,
+        get_ifindex(get_kernel_interface_name(index)))
+
+
+def parse_static_routes(static_routes):
+    """
+    Parses the staticroutes override value, routes separated by semicolons:
+    "10.0.1.0/24 192.168.1.254; 10.0.2.0/25 192.168.1.253"
+
+    Returns a list of Routes
+    """
+    routes = []
+    for static in static_routes.split(';'):
+        if not static.strip():
+            continue
+        subnet = static.split('/')[0].strip()
+        mask = (static.split('/')[1].strip()).split()[0]
+        gateway = (static.split('/')[1].strip()).split()[1]
+        routes.append(Route.parse(subnet, mask, gateway))
+    return routes
+
+
+def plan_routes(desired, current_routes, nic, released=()):
+    """
+    Computes the minimal RoutePlan that makes the routes of a NIC match the
+    desired routes
+
+    desired:
+        the ordered dictionary of routes from get_desired_routes
+
+    current_routes:
+        the RouteTable from get_route_table_with_masks
+
+    nic:
+        the interface whose routes are reconciled
+
+    released:
+        (network, prefixlen) prefixes that the plans applied along with
+        this one delete from other interfaces, see apply_plans
+
+    Routes on the NIC that arent desired are deleted, those with another
+    gateway are changed and missing ones are added.  A desired route that
+    exists on another interface is skipped, as adding it would fail,
+    unless its prefix is released.
+    """
+    import collections
+    plan = RoutePlan(nic)
+
+    present = collections.OrderedDict()
+    for route in current_routes.routes_on(nic):
+        present.setdefault(route.key, route)
+
+    for key, route in present.items():
+        if key not in desired:
+            plan.deletes.append(route)
+        elif desired[key].gateway != route.gateway:
+            plan.changes.append(desired[key])
+
+    for key, route in desired.items():
+        if key in present:
+            plan.desired.append(route)
+            if present[key].gateway == route.gateway:
+                plan.skipped.append((route, 'already_present'))
+        elif key in current_routes and key not in released:
+            # the route of another interface, this plan doesnt own it
+            plan.skipped.append((route, 'already_present'))
+        else:
+            plan.desired.append(route)
+            plan.adds.append(route)
+    return plan
+
+
+def profile_call(filename, function, *args):
+    """
+    Calls function with args under cProfile and writes the pstats dump to
+    filename, even when function raises
+
+    Returns the return value of function
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(filename)
+        print '[PROFILE] statistics written to %s' % filename
+
+
+def read_journal(filename):
+    """
+    Reads the records of a journal written by Journal, the rotated
+    filename.1 first, stopping with a warning at a record cut short or
+    corrupt (a crash in the middle of an append for instance)
+
+    Yields a dictionary per pass: start (unix time), duration_ms, success,
+    phases as (name, milliseconds) pairs and interfaces, a dictionary of
+    name to (routes hash, [(routeverb, failed, Route), ...])
+    """
+    import struct
+
+    def decode(body):
+        # every field is checked against the end of the record body
+        position = [0]
+
+        def take(layout):
+            size = struct.calcsize(layout)
+            if position[0] + size > len(body):
+                raise ValueError('record cut short')
+            fields = struct.unpack_from(layout, body, position[0])
+            position[0] += size
+            return fields
+
+        version, start, duration, success, phase_count = \
+            take(Journal.record)
+        if version != JOURNAL_VERSION:
+            return None
+        phases = []
+        for _ in range(phase_count):
+            index, milliseconds = take(Journal.phase_record)
+            if index >= len(JOURNAL_PHASES):
+                raise ValueError('unknown phase %d' % index)
+            phases.append((JOURNAL_PHASES[index], milliseconds))
+        interfaces = {}
+        for _ in range(take('!B')[0]):
+            size = take('!B')[0]
+            nic = take('%ds' % size)[0]
+            digest, count = take(Journal.interface_record)
+            operations = []
+            for _ in range(count):
+                verb, network, prefixlen, gateway = \
+                    take(Journal.operation_record)
+                if verb & ~JOURNAL_FAILED >= len(JOURNAL_VERBS) or \
+                        prefixlen > 32:
+                    raise ValueError('bad route operation')
+                operations.append((
+                    JOURNAL_VERBS[verb & ~JOURNAL_FAILED],
+                    bool(verb & JOURNAL_FAILED),
+                    Route(network, prefixlen, gateway)))
+            interfaces[nic] = (digest, operations)
+        if position[0] != len(body):
+            raise ValueError('trailing bytes')
+        return {'start': start, 'duration_ms': duration,
+                'success': bool(success), 'phases': phases,
+                'interfaces': interfaces}
+
+    for name in (filename + '.1', filename):
+        try:
+            file_handle = open(name, 'rb')
+        except IOError:
+            continue
+        try:
+            data = file_handle.read()
+        finally:
+            file_handle.close()
+
+        offset = 0
+        while offset < len(data):
+            try:
+                if offset + 4 > len(data):
+                    raise ValueError('length cut short')
+                length = struct.unpack_from('!I', data, offset)[0]
+                if offset + 4 + length > len(data):
+                    raise ValueError('record cut short')
+                record = decode(data[offset + 4:offset + 4 + length])
+            except ValueError as error:
+                print '[JOURNAL] %s: %s at byte %d, the rest is skipped' % (
+                    name, error, offset)
+                break
+            offset += 4 + length
+            if record is not None:
+                yield record
+
+
+def read_route_events(monitor, own_ids=()):
+    """
+    Reads every pending message from a route monitor socket
+
+    monitor:
+        the socket from open_route_monitor
+
+    own_ids:
+        process ids (PF_ROUTE) or netlink port ids whose route messages are
+        ignored, so the daemon isnt woken by its own route operations
+
+    Only the route messages of IPv4 routes netstat would list are counted
+    (see parse_routing_message and iter_netlink_routes), so ARP and
+    neighbour entries, cloned routes and IPv6 dont wake the daemon.
+
+    Returns the number of interface, address and route change messages
+    """
+    import socket
+    import struct
+    netlink = sys.platform.startswith('linux')
+    events = 0
+    while True:
+        try:
+            data = monitor.recv(65536)
+        except socket.error as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return events
+            raise
+        if not data:
+            return events
+
+        if netlink:
+            offset = 0
+            while offset + 16 <= len(data):
+                length, message_type, _, _, sender = \
+                    struct.unpack_from('=LHHLL', data, offset)
+                if message_type in (RTM_NEWLINK, RTM_DELLINK,
+                                    RTM_NEWADDR_NETLINK, RTM_DELADDR_NETLINK):
+                    events += 1
+                elif message_type in (RTM_NEWROUTE, RTM_DELROUTE) and \
+                        sender not in own_ids:
+                    for _, route in iter_netlink_routes(
+                            data[offset:offset + length]):
+                        if route is not None:
+                            events += 1
+                offset += (length + 3) & ~3 or len(data)
+        elif len(data) >= 4:
+            # every routing socket message holds one message
+            message_type = struct.unpack_from('=B', data, 3)[0]
+            if message_type in (RTM_IFINFO, RTM_NEWADDR, RTM_DELADDR):
+                events += 1
+            elif message_type in (RTM_ADD, RTM_DELETE, RTM_CHANGE) and \
+                    len(data) >= 20 and \
+                    struct.unpack_from('=i', data, 16)[0] not in own_ids and \
+                    parse_routing_message(data)[1] is not None:
+                events += 1
+
+
+def read_state_cache():
+    """
+    Reads the STATE_FILE record of the last applied routes, discarding a
+    record that is unreadable or older than STATE_MAX_AGE
+
+    Returns the record as a dictionary, or None
+    """
+    import json
+    import socket
+    try:
+        file_handle = open(STATE_FILE)
+    except IOError:
+        return None
+    try:
+        try:
+            record = json.load(file_handle)
+            key = record['key']
+            age = time.time() - float(record['time'])
+            routes = [Route.parse(subnet, mask, gateway)
+                      for subnet, mask, gateway in record['routes']]
+        except (ValueError, KeyError, TypeError, socket.error) as error:
+            evict_state_cache('unreadable record (%s)' % error)
+            return None
+    finally:
+        file_handle.close()
+    if not 0 <= age <= STATE_MAX_AGE:
+        evict_state_cache('record is stale')
+        return None
+    return {'key': key, 'routes': routes}
+
+
+def reconcile_interfaces(leases, gatewaycheck, static_routes, backend=None,
+                         aggregate=False):
+    """
+    Brings the routes of every leased interface in line with its option
+    121 routes and the static routes, touching only the routes that
+    differ (see plan_routes).  gatewaycheck and static_routes are those of
+    get_desired_routes.
+
+    leases:
+        Leases from get_lease, in the order of get_lease_candidates.  A
+        prefix that several leases route is given to the first of them,
+        the others skip it.
+
+    backend:
+        the RouteBackend to program routes with, see get_route_backend
+
+    aggregate:
+        True to collapse the routes of each interface with
+        aggregate_routes, the barriers being the connected networks of
+        the leases, the default route and the routes of the other
+        interfaces
+
+    Returns the applied RoutePlans in the order of leases
+    """
+    claimed = {}
+    wanted = []
+    for lease in leases:
+        desired, skipped = get_desired_routes(
+            lease.routes, lease.addresses, gatewaycheck, static_routes)
+        for key in list(desired):
+            if key in claimed:
+                skipped.append((desired.pop(key),
+                                'claimed_by_%s' % claimed[key]))
+            else:
+                claimed[key] = lease.nic
+        wanted.append((lease.nic, desired, skipped))
+
+    current_routes = get_route_snapshot()
+    if aggregate:
+        connected = set([(0, 0)])
+        for lease in leases:
+            for ip_address, mask, _ in lease.addresses:
+                mask = int(mask)
+                connected.add((ip_to_int(ip_address) & PREFIX_MASKS[mask],
+                               mask))
+        for index, (nic, desired, skipped) in enumerate(wanted):
+            barriers = set(connected)
+            barriers.update(route.key for route in current_routes
+                            if route.interface != nic)
+            for other, other_desired, _ in wanted:
+                if other != nic:
+                    barriers.update(other_desired)
+            desired, aggregated = aggregate_routes(desired, barriers)
+            wanted[index] = (nic, desired, skipped + aggregated)
+
+    # the prefixes one interface gives up can be taken by another
+    released = set()
+    for nic, desired, skipped in wanted:
+        for route in current_routes.routes_on(nic):
+            if route.key not in desired:
+                released.add(route.key)
+
+    plans = []
+    for nic, desired, skipped in wanted:
+        plan = plan_routes(desired, current_routes, nic, released)
+        plan.skipped[:0] = skipped
+        for line in plan.report():
+            print '[ROUTES] %s: %s' % (nic, line)
+        plans.append(plan)
+
+    apply_plans(plans, backend)
+    for plan in plans:
+        for result in plan.results:
+            count_metric('dhcp_121_route_operations_total',
+                         interface=plan.nic, operation=result.routeverb)
+            if JOURNAL is not None:
+                JOURNAL.operation(plan.nic, result)
+            if result.error:
+                count_metric('dhcp_121_route_failures_total',
+                             interface=plan.nic, operation=result.routeverb)
+                print '[ROUTES] %s: failed %s %s: %s' % (
+                    plan.nic, result.routeverb, result.route, result.error)
+        for route, reason in plan.skipped:
+            # claimed_by_en1 and aggregated_into_10.0.0.0/8 are counted
+            # as claimed and aggregated
+            count_metric('dhcp_121_routes_skipped_total', interface=plan.nic,
+                         reason=reason.split('_by_')[0].split('_into_')[0])
+    return plans
+
+
+def report_journal(filename, hours):
+    """
+    Prints a summary of the passes journaled in the last hours: the pass
+    latency percentiles overall and per phase, the route churn and flaps
+    of each interface and the prefixes changed most often.  A flap is a
+    prefix deleted from an interface and added back to it later.
+    """
+    since = time.time() - hours * 3600
+
+    def get_percentiles(values):
+        values = sorted(values)
+        return ['%.1f' % values[int(round(fraction * (len(values) - 1)))]
+                for fraction in (0.5, 0.95, 0.99)]
+
+    passes = [record for record in read_journal(filename)
+              if record['start'] >= since]
+    print '[JOURNAL] %s: %d passes in the last %g hours' % (
+        filename, len(passes), hours)
+    if not passes:
+        return
+    print '  failed passes: %d' % sum(1 for record in passes
+                                      if not record['success'])
+    print '  latency ms p50/p95/p99: %s' % '/'.join(
+        get_percentiles([record['duration_ms'] for record in passes]))
+    phases = {}
+    for record in passes:
+        for name, milliseconds in record['phases']:
+            phases.setdefault(name, []).append(milliseconds)
+    for name in JOURNAL_PHASES:
+        if name in phases:
+            print '    %-20s p50/p95/p99: %s' % (
+                name, '/'.join(get_percentiles(phases[name])))
+
+    churn = {}
+    interfaces = {}
+    for record in passes:
+        for nic, (digest, operations) in record['interfaces'].items():
+            counts = interfaces.setdefault(
+                nic, {'passes': 0, 'leases': 0, 'operations': 0,
+                      'flaps': 0, 'deleted': set(), 'digest': None})
+            counts['passes'] += 1
+            if digest.strip('\0') and digest != counts['digest']:
+                counts['leases'] += 1
+                counts['digest'] = digest
+            for routeverb, failed, route in operations:
+                if failed:
+                    continue
+                counts['operations'] += 1
+                prefix = '%s/%d' % (int_to_ip(route.network),
+                                    route.prefixlen)
+                churn[prefix] = churn.get(prefix, 0) + 1
+                if routeverb == 'delete':
+                    counts['deleted'].add(route.key)
+                elif routeverb == 'add' and route.key in counts['deleted']:
+                    counts['deleted'].discard(route.key)
+                    counts['flaps'] += 1
+
+    print '  interfaces (passes, route sets seen, operations, flaps/hour):'
+    for nic in sorted(interfaces):
+        counts = interfaces[nic]
+        print '    %-8s %5d %5d %7d %8.2f' % (
+            nic or '-', counts['passes'], counts['leases'],
+            counts['operations'], counts['flaps'] / float(hours))
+    if churn:
+        print '  most changed prefixes:'
+        for prefix, count in sorted(churn.items(),
+                                    key=lambda item: (-item[1], item[0]))[:10]:
+            print '    %-18s %d' % (prefix, count)
+
+
+def route_cmd(route, routeverb='', backend=None):
     """
     Adds a specified route with the UNIX route command
 
-    route - a tuple with three fields:
-        subnet - network address to route
-        mask - length of subnet mask in bits (24, etc.)
+    route - a Route:
+        network - network address to route
+        prefixlen - length of subnet mask in bits (24, etc.)
         gateway - the next hop router for the packet
 
     UNIX Errors:
@@ -558,61 +3863,420 @@ def route_cmd(route, routeverb=''):
         network topology, disable and enable the interface again (to run this
         script) and the DHCP specified static routes will populate as expected.
 
-    Returns the stdout from the operation
+    backend:
+        the RouteBackend to program the route with, see get_route_backend
+
+    Returns the route command style report of the operation
     """
     routeverb = routeverb or 'add'
-    subnet = route[0]
-    mask = route[1]
-    gateway = route[2]
-    cmd = 'route %s %s/%s %s' % (routeverb, subnet, mask, gateway)
-    p = subprocess.Popen(cmd.split(), stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    return stdout
+    backend = backend or get_route_backend()
+    try:
+        return backend.apply(routeverb, route)
+    finally:
+        invalidate_route_snapshot()
 
 
-def set_routes(routes, addresses, gatewaycheck, static_routes):
+def route_report(routeverb, route, error=None):
     """
-    Checks to see if the specified route should be added to the UNIX routing
-    table.
+    Formats a route operation the way the route command reports it, for
+    example "add net 10.0.0.0: gateway 192.168.0.1: File exists"
 
-    Returns a dictionary of the stdouts from each route attempted
+    error:
+        the errno of a failed operation, None when it succeeded
     """
-    stdouts = []
+    report = '%s net %s: gateway %s' % (routeverb, int_to_ip(route.network),
+                                        int_to_ip(route.gateway))
+    if error:
+        report = '%s: %s' % (report, os.strerror(error))
+    return report
 
-    current_routes = get_route_table_with_masks()
 
-    # Add in the forceroutes from the override file:
-    if static_routes:
-        for static in static_routes.split(';'):
-            subnet = static.split('/')[0].strip()
-            mask = (static.split('/')[1].strip()).split()[0]
-            gateway = (static.split('/')[1].strip()).split()[1]
-            routes.append([subnet, mask, gateway])
+def run(options, backend=None):
+    """
+    One pass of option 121 route handling: read the DHCP lease of every
+    interface that may have one, decode their option 121 routes and
+    reconcile the routing table with them
+
+    options:
+        the command line options from parse_args
+
+    backend:
+        the RouteBackend to program routes with instead of the one chosen
+        for the run, such as a FakeRouteBackend keeping the operations of
+        an offline plan (see dhcp_121_fleet.py)
+
+    Returns the applied RoutePlans of the leased NICs, empty when no NIC
+    holds a lease.  When the state cache shows nothing changed the plans
+    have no operations.
+    """
+    # Every pass reads the routing table afresh (or the latest of the
+    # ROUTE_MIRROR)
+    invalidate_route_snapshot()
+
+    # Override Variables, see the OVERRIDE_FILE comment at the top
+    # of this code for explanation
+    with trace_span('override'):
+        nic, gatewaycheck, forcenics, safenics, static_routes = \
+            check_for_override_file()
+
+    # The override nic and the NIC with the default route come first,
+    # followed by any other interface that may hold a DHCP lease
+    # The inventory and the routing table are read side by side
+    with trace_span('discover_nic') as span:
+        interfaces, default_nic = run_parallel(
+            lambda query: query(), [get_interface_inventory, get_default_nic])
+        candidates = get_lease_candidates(nic, default_nic, interfaces)
+        span.set('nics', candidates)
+
+    # The backend every route operation of this run goes through, a dry
+    # run works on an in-memory copy of the routing table
+    if options.dry_run:
+        print '[DRY-RUN] no routes will be changed'
+        backend = backend or FakeRouteBackend(get_route_snapshot())
+    elif backend is None and not get_command_runner().native:
+        # recorded and replayed runs change routes with the route command
+        backend = get_route_backend('subprocess')
+    elif backend is None:
+        backend = get_route_backend(get_override_value('backend'))
+
+    # Retrieve the DHCP response packet of every candidate at once, the
+    # NICs with a packet hold a lease
+    addresses = dict((interface.name, interface.addresses)
+                     for interface in interfaces)
+    with trace_span('get_packet') as span:
+        leases = [lease for lease in run_parallel(
+            lambda name: get_lease(name, addresses.get(name, [])),
+            candidates) if lease]
+        span.set('leases', [lease.nic for lease in leases])
+    if leases:
+        nics = [lease.nic for lease in leases]
+
+        # Nothing to do when the inputs match the last run and its routes
+        # are still in place.  Recorded and replayed runs always make a
+        # full pass and leave the state file alone.
+        use_cache = not options.dry_run and get_command_runner().native
+        with trace_span('state_cache') as span:
+            state_key = get_state_key(leases, interfaces)
+            if use_cache:
+                cached = read_state_cache()
+                if cached and cached['key'] == state_key:
+                    span.set('hit', True)
+                    if verify_state_routes(cached['routes'],
+                                           get_route_snapshot()):
+                        print '[CACHE] no changes since the last run'
+                        return [RoutePlan(name) for name in nics]
+                    evict_state_cache(
+                        'routes no longer in the routing table')
+
+        # The option 121 routes are only decoded once the cache missed
+        for lease in leases:
+            decode_lease(lease)
+
+        # Stale static routes on other NICs are cleared out, the leased
+        # NICs' routes are reconciled below rather than cleared
+        with trace_span('clear_routes'):
+            clear_routes(' '.join(n for n in forcenics.split()
+                                  if n not in nics),
+                         ' '.join([safenics] + nics), backend, interfaces)
+
+        # Apply only the differences between the current routes of each
+        # NIC and the derived static routes
+        with trace_span('reconcile_interfaces') as span:
+            plans = reconcile_interfaces(
+                leases, gatewaycheck, static_routes, backend,
+                get_override_value('aggregate') not in
+                ('', '0', 'False', 'false'))
+            span.set('operations', sum(len(plan) for plan in plans))
+            span.set('errors', sum(1 for plan in plans
+                                   for result in plan.results
+                                   if result.error))
+        if use_cache:
+            write_state_cache(state_key, nics,
+                              [route for plan in plans
+                               for route in plan.desired])
+        return plans
+
+    # Clear the routes on any down NIC, inclusive of any down DHCP
+    # interface (When WiFi drops, the routes are removed)
+    with trace_span('clear_routes'):
+        clear_routes(forcenics, safenics, backend, interfaces)
+    return []
+
+
+def run_command(cmd):
+    """
+    Runs the command line cmd (split on whitespace) with the current
+    CommandRunner, see get_command_runner
+
+    Returns the standard output of the command
+    """
+    return get_command_runner()(cmd)
+
+
+def run_parallel(function, items, workers=LEASE_WORKERS):
+    """
+    Calls function on every item with up to workers threads at a time
+
+    Returns the results in the order of items.  An exception raised by a
+    call is raised again once every call has finished.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    import threading
+    results = [None] * len(items)
+    errors = []
+    pending = iter(enumerate(items))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                try:
+                    index, item = next(pending)
+                except StopIteration:
+                    return
+            try:
+                results[index] = function(item)
+            except Exception:
+                errors.append((index, sys.exc_info()))
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        kind, value, traceback = min(errors)[1]
+        raise kind, value, traceback
+    return results
+
+
+def run_pass(options):
+    """
+    Runs a pass of run, its duration and outcome added to the metrics
+    and the journal which are written once the pass is over (see METRICS
+    and JOURNAL_FILE)
+
+    Returns the RoutePlans of run
+    """
+    start = time.time()
+    success = False
+    nics = []
+    try:
+        plans = run(options)
+        success = True
+        nics = [plan.nic for plan in plans
+                if not [result for result in plan.results if result.error]]
+        return plans
+    finally:
+        if METRICS is not None:
+            METRICS.finish_pass(time.time() - start, success, nics)
+        if JOURNAL is not None:
+            JOURNAL.finish_pass(start, time.time() - start, success)
+
+
+def run_single_flight(options):
+    """
+    Runs a pass of run unless another invocation is already running one
+
+    An invocation that finds LOCK_FILE locked marks the run dirty and
+    returns at once.  The running invocation clears the mark before each
+    pass and makes another pass if it was set again once the pass is
+    done, so however many invocations overlap a pass they cost one more
+    pass between them.
+    """
+    import fcntl
+
+    def lock(handle):
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
+
+    handle = open(LOCK_FILE, 'a')
+    try:
+        if not lock(handle):
+            open(DIRTY_FILE, 'w').close()
+            # the running invocation may have finished before the mark
+            if not lock(handle):
+                print '[LOCK] a run is in progress, it will run again'
+                return
+        while True:
+            try:
+                os.remove(DIRTY_FILE)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+            run_pass(options)
+            fcntl.flock(handle, fcntl.LOCK_UN)
+            # another invocation that took the lock makes the pass itself
+            if not os.path.exists(DIRTY_FILE) or not lock(handle):
+                break
+            print '[LOCK] runs were started during the pass, running again'
+    finally:
+        handle.close()
+
+
+def run_daemon(options):
+    """
+    Runs as a long lived process (see dhcp_121_daemon.plist): a pass is made
+    at startup and then whenever the kernel reports an interface, address
+    or route change, or one of the WATCH_PATHS or the override file
+    changes.  Bursts of events are coalesced into a single pass.  The
+    routing table is read from a RouteMirror, kept up to date between the
+    passes, rather than once per pass.
+
+    options:
+        the command line options from parse_args
+    """
+    import select
+    monitor = open_route_monitor()
+    if get_command_runner().native and ROUTE_MIRROR is None:
+        try:
+            set_route_mirror(RouteMirror())
+        except (AttributeError, EnvironmentError) as error:
+            print '[MIRROR] unavailable, reading the routing table every ' \
+                'pass: %s' % error
+
+    # route messages caused by our own operations dont need another pass
+    own_ids = set([os.getpid()])
+    for backend in ROUTE_BACKENDS.values():
+        if isinstance(backend, NetlinkRouteBackend):
+            own_ids.add(backend.port_id)
+
+    watch_state = get_watch_state()
+    pending = True
+    while True:
+        if pending:
+            try:
+                run_pass(options)
+            except Exception as error:
+                print '[DAEMON] pass failed: %s' % error
+            for backend in ROUTE_BACKENDS.values():
+                if isinstance(backend, NetlinkRouteBackend):
+                    own_ids.add(backend.port_id)
+            pending = False
+
+        sockets = [monitor] if monitor else []
+        readable = select.select(sockets, [], [], DAEMON_WATCH_INTERVAL)[0]
+        if readable and read_route_events(monitor, own_ids):
+            pending = True
+        if ROUTE_MIRROR is not None:
+            # keeps the mirror's socket drained and its resyncs on time
+            ROUTE_MIRROR.read()
+
+        current_state = get_watch_state()
+        if current_state != watch_state:
+            watch_state = current_state
+            pending = True
+
+        # let a burst of events settle before making a pass
+        if pending and monitor:
+            deadline = time.time() + DAEMON_DEBOUNCE
+            while time.time() < deadline:
+                select.select(sockets, [], [],
+                              max(0, deadline - time.time()))
+                read_route_events(monitor, own_ids)
+
+
+def set_command_runner(runner):
+    """
+    Makes runner the CommandRunner of every later run_command call
+
+    Returns the runner
+    """
+    global COMMAND_RUNNER
+    COMMAND_RUNNER = runner
+    return runner
+
+
+def set_route_mirror(mirror):
+    """
+    Makes mirror the RouteMirror every later routing table read is served
+    from, None goes back to reading the table once per pass
+
+    Returns the mirror
+    """
+    global ROUTE_MIRROR
+    ROUTE_MIRROR = mirror
+    return mirror
+
+
+def set_tracer(tracer):
+    """
+    Makes tracer the Tracer of every later trace_span, None turns tracing
+    off
+
+    Returns the tracer
+    """
+    global TRACER
+    TRACER = tracer
+    return tracer
+
+
+def set_journal(journal):
+    """
+    Makes journal the Journal that every later pass is recorded in, None
+    turns the journal off
+
+    Returns the journal
+    """
+    global JOURNAL
+    JOURNAL = journal
+    return journal
+
+
+def set_metrics(metrics):
+    """
+    Makes metrics the Metrics that count_metric and run_pass record to,
+    None turns metrics off
+
+    Returns the metrics
+    """
+    global METRICS
+    METRICS = metrics
+    return metrics
+
+
+def sockaddr_in(address):
+    """
+    Returns a BSD struct sockaddr_in (with its length octet) for the 32bit
+    address, as carried in routing socket messages
+    """
+    import socket
+    import struct
+    return struct.pack('=BBH', 16, socket.AF_INET, 0) + \
+        struct.pack('!L8x', address)
 
-    for route in routes:
-        set_route = False
-
-        # Check if the gateway is on a reachable subnet before
-        # attempting to add the route
-        if gatewaycheck:
-            for ip_address, mask, _ in addresses:
-                if subnet_check(mask, ip_address, route[2]):
-                    set_route = True
-        else:
-            set_route = True
 
-        # Determine if there is an existing route before
-        # trying to add it, which would likely fail if attempted
-        for current in current_routes:
-            if current[0] == route[0]:
-                if current[1] == route[1]:
-                    set_route = False
+def split_option(option_code, payload):
+    """
+    Encodes a DHCP option for the wire, splitting payloads longer than 255
+    bytes across several instances of the same option (RFC 3396)
 
-        if set_route:
-            stdouts.append(route_cmd(route))
+    option_code:
+        the numeric DHCP option code, for example 121
 
-    return stdouts
+    payload:
+        the option data as bytes
+
+    Returns the code, length and data octets of every instance as bytes
+    """
+    payload = bytearray(payload)
+    wire = bytearray()
+    for offset in range(0, len(payload), 255):
+        chunk = payload[offset:offset + 255]
+        wire.append(option_code)
+        wire.append(len(chunk))
+        wire.extend(chunk)
+    return bytes(wire)
 
 
 def subnet_check(netmask_bits, ip_address, target):
@@ -632,61 +4296,177 @@ def subnet_check(netmask_bits, ip_address, target):
     Returns True only if the specified target is within the calculated subnet
     range
     """
+    import socket
+    import struct
     ip_decimal = struct.unpack('!L', socket.inet_aton(ip_address))[0]
     target_decimal = struct.unpack('!L', socket.inet_aton(target))[0]
     netmask_decimal = (0xFFFFFFFF >> int(netmask_bits)) ^ 0xFFFFFFFF
     return ip_decimal & netmask_decimal == target_decimal & netmask_decimal
 
 
-def main():
+def trace_span(name, **attributes):
     """
-    Attempts to automatically determine the interface where DHCP responses
-    are received, then looks to decode DHCP option 121 static route
-    statements and sets them as appropriate if and only if an existing
-    NIC is configured to reach each specified routes gateway.
+    Returns a TraceSpan named name for a with block, it is a child of the
+    span whose with block it is in.  While tracing is off this is the
+    shared NULL_SPAN, which costs no more than the call.
+
+    attributes:
+        values recorded with the span, such as the nic
     """
-    # Exit if the version is new enough to have option 121 support
-    check_version()
+    if TRACER is None and JOURNAL is None:
+        return NULL_SPAN
+    return TraceSpan(TRACER, name, attributes)
 
-    # Exit if not executed wtih root permissions
-    check_root()
 
-    # Override Variables, see the OVERRIDE_FILE comment at the top
-    # of this code for explanation
-    nic, gatewaycheck, safenics, forcenics, static_routes = \
-        check_for_override_file()
+def verify_aggregation(routes, aggregated, barriers=()):
+    """
+    Checks that two sets of Routes forward every IPv4 address the same way
+    alongside the barrier prefixes, see aggregate_routes
 
-    # if the override nic isnt present, determine the NIC with the
-    # DHCP response based upon the default route.
-    if not nic:
-        nic = get_default_nic()
+    The longest prefix match can only change at the first address of a
+    prefix or just past its last, so comparing the next hops at those
+    addresses of every prefix covers the whole address space.
+    """
+    def get_forwarding(routes):
+        hops = dict((key, ('barrier',) + tuple(key)) for key in barriers)
+        hops.update((route.key, (route.gateway, route.ifindex))
+                    for route in routes)
+        trie = PrefixTrie()
+        for key in hops:
+            trie.insert(*key)
+        return hops, trie
+
+    before = get_forwarding(routes)
+    after = get_forwarding(aggregated)
+    addresses = set([0])
+    for network, prefixlen in set(before[0]) | set(after[0]):
+        addresses.add(network)
+        last = network | (~PREFIX_MASKS[prefixlen] & 0xFFFFFFFF)
+        if last < 0xFFFFFFFF:
+            addresses.add(last + 1)
+
+    for address in addresses:
+        if before[0].get(before[1].longest_match(address)) != \
+                after[0].get(after[1].longest_match(address)):
+            return False
+    return True
+
+
+def verify_state_routes(routes, current_routes):
+    """
+    Checks that every Route is in the RouteTable with the same gateway
+    """
+    for route in routes:
+        if not any(present.gateway == route.gateway
+                   for present in current_routes.get(*route.key)):
+            return False
+    return True
 
-    # Retrieve the nic IP addressing information
-    addresses = get_ip_addresses(nic)
 
-    # Retrieve the DHCP response packet information for the NIC
-    packet = get_packet(nic)
-    if packet:
+def write_file_atomically(filename, data):
+    """
+    Replaces the file with data without readers ever seeing a partial
+    file: the data is written and synced to a temporary file in the same
+    directory which is then renamed over the original
+    """
+    import tempfile
+    directory = os.path.dirname(filename) or '.'
+    handle, temp_name = tempfile.mkstemp(
+        dir=directory, prefix='.%s.' % os.path.basename(filename))
+    try:
+        try:
+            os.write(handle, data)
+            os.fsync(handle)
+        finally:
+            os.close(handle)
+        os.chmod(temp_name, 0o644)
+        os.rename(temp_name, filename)
+    except OSError:
+        os.remove(temp_name)
+        raise
 
-        # Retrieve the option_121 data from the DHCP options
-        option_data = get_option(packet, 'option_121')
 
-        # Decodes any option_121 data into route statements
-        routes = decode_option_121(option_data)
+def write_state_cache(key, nics, routes):
+    """
+    Records the routes applied for the list of NICs under the state key,
+    see get_state_key, in the STATE_FILE
+    """
+    import json
+    record = {'key': key, 'nics': nics, 'time': time.time(),
+              'routes': [[int_to_ip(route.network), route.prefixlen,
+                          int_to_ip(route.gateway)] for route in routes]}
+    try:
+        write_file_atomically(STATE_FILE, json.dumps(record))
+    except (IOError, OSError) as error:
+        print '[CACHE] cannot write %s: %s' % (STATE_FILE, error)
 
-        # Stale static routes must be cleared out before
-        # attempting to add any
-        preforcenics = forcenics
-        if nic not in preforcenics:
-            preforcenics = preforcenics + ' ' + nic
-        clear_routes(preforcenics, safenics)
 
-        # Attempt to add the derived static routes
-        set_routes(routes, addresses, gatewaycheck, static_routes)
-    else:
-        # Clear the routes on any down NIC, inclusive of any down DHCP
-        # interface (When WiFi drops, the routes are removed)
-        clear_routes(forcenics, safenics)
+def main(argv=None):
+    """
+    Attempts to automatically determine the interface where DHCP responses
+    are received, then looks to decode DHCP option 121 static route
+    statements and sets them as appropriate if and only if an existing
+    NIC is configured to reach each specified routes gateway.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # Tracing starts ahead of everything else so that the version check
+    # is traced too
+    destination = get_early_option(argv, '--trace')
+    if destination:
+        try:
+            set_tracer(Tracer(destination))
+        except (IOError, OSError) as error:
+            print '[TRACE] unable to trace to %s: %s' % (destination, error)
+
+    try:
+        with trace_span('main'):
+            # Exit if the version is new enough to have option 121 support,
+            # this is decided before anything else is loaded.  A replayed
+            # run may come from any system.
+            with trace_span('check_version'):
+                if get_early_option(argv, '--replay') is None and \
+                        '--journal-report' not in argv:
+                    check_version()
+
+            options = parse_args(argv)
+            if options.journal_report:
+                report_journal(options.journal, options.window)
+                return
+
+            if options.record:
+                set_command_runner(RecordingRunner(options.record))
+            elif options.replay:
+                set_command_runner(ReplayRunner(options.replay,
+                                                options.replay_latency))
+
+            # Exit if not executed wtih root permissions, a dry run or a
+            # replay only reads
+            if not (options.dry_run or options.replay):
+                check_root()
+                # only runs that change routes are counted
+                metrics_file = get_override_value('metrics_file')
+                if metrics_file:
+                    set_metrics(Metrics(metrics_file))
+                set_journal(Journal(JOURNAL_FILE))
+
+            # A dry run or a replay changes nothing, and so doesnt need to
+            # wait its turn
+            if options.daemon:
+                target = run_daemon
+            elif options.dry_run or options.replay:
+                target = run_pass
+            else:
+                target = run_single_flight
+            if options.profile:
+                profile_call(options.profile, target, options)
+            else:
+                target(options)
+            print '[COMMANDS] %s' % get_command_runner().summary()
+    finally:
+        if TRACER:
+            TRACER.close()
 
 
 if __name__ == "__main__":
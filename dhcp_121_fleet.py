@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+Plans what dhcp_121.py would do on every host of a fleet, offline
+
+Each host is a directory of command outputs in the layout of
+"dhcp_121.py --record DIR" (netstat_-f_inet_-rn.out,
+usr_sbin_ipconfig_getpacket_en0.out, ifconfig_-a_inet.out, ...), with an
+optional dhcp_121_override file holding the host's override settings.
+Every host directory below the capture directory is replayed through a
+dry run of dhcp_121 in a pool of processes and its plan is written as a
+line of JSON, in the order the hosts finish:
+
+    {"host": "lab/mac-0042", "nics": ["en1"], "operations": [...],
+     "plans": [{"nic": "en1", "deletes": [...], "changes": [...],
+                "adds": [...], "skipped": [["10.0.0.0/8 via ...",
+                                            "gateway_unreachable"]]}]}
+
+A host that fails to plan is written as {"host": ..., "error": ...}.  The
+directory is walked as the hosts are planned and at most --max-pending
+hosts are queued at a time, so the memory used doesnt grow with the size
+of the fleet.
+
+Run from the directory holding dhcp_121.py, for example:
+    python dhcp_121_fleet.py /srv/captures > plans.jsonl
+    python dhcp_121_fleet.py /srv/captures --processes 16 \\
+        --output plans.jsonl
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# A directory holding this recording is a host capture
+HOST_MARKER = 'netstat_-f_inet_-rn.out'
+
+# The override file of a host, in its capture directory
+HOST_OVERRIDE_FILE = 'dhcp_121_override'
+
+# Hosts queued per worker process, bounding the memory of the queue
+PENDING_PER_PROCESS = 64
+
+# Worker processes are replaced after planning this many hosts, so that
+# nothing a host leaves behind builds up over a long run
+HOSTS_PER_CHILD = 1000
+
+
+def parse_args(argv=None):
+    """
+    Returns the parsed command line options
+    """
+    parser = argparse.ArgumentParser(
+        description='Plan dhcp_121.py route changes for captured hosts')
+    parser.add_argument('capture_dir',
+                        help='the directory holding the host captures')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='worker processes, one per CPU by default')
+    parser.add_argument('--max-pending', type=int, default=0,
+                        help='hosts queued at a time, %d per process by '
+                        'default' % PENDING_PER_PROCESS)
+    parser.add_argument('--output',
+                        help='write the plans here instead of stdout')
+    return parser.parse_args(argv)
+
+
+def init_worker():
+    """
+    Prepares a worker process: dhcp_121's reports of its own (the
+    [ROUTES] lines and so on) are discarded, only the JSON plans are
+    written
+    """
+    sys.path.insert(0, HERE)
+    sys.stdout = open(os.devnull, 'w')
+
+
+def iter_hosts(capture_dir):
+    """
+    Yields the host directories below capture_dir, as it is walked
+    """
+    for dirpath, dirnames, filenames in os.walk(capture_dir):
+        if HOST_MARKER in filenames:
+            # a host capture holds no further hosts
+            dirnames[:] = []
+            yield dirpath
+        else:
+            dirnames.sort()
+
+
+def plan_host(host_dir, capture_dir):
+    """
+    Replays a host capture through a dry run of dhcp_121, the host named
+    by its path below capture_dir
+
+    Returns the JSON line of the host's plan and whether planning failed,
+    whatever goes wrong: a task that raised would never free its queue
+    slot, see run_fleet
+    """
+    host = host_dir
+    try:
+        host = os.path.relpath(host_dir, capture_dir)
+        import dhcp_121
+        dhcp_121.OVERRIDE_FILE = os.path.join(host_dir, HOST_OVERRIDE_FILE)
+        dhcp_121.set_command_runner(dhcp_121.ReplayRunner(host_dir))
+        dhcp_121.invalidate_route_snapshot()
+        backend = dhcp_121.FakeRouteBackend(dhcp_121.get_route_snapshot())
+        plans = dhcp_121.run(dhcp_121.parse_args(['--dry-run']), backend)
+        record = {
+            'host': host,
+            'nics': [plan.nic for plan in plans],
+            'operations': ['%s %s' % (routeverb, route)
+                           for routeverb, route in backend.operations],
+            'plans': [{'nic': plan.nic,
+                       'deletes': [str(route) for route in plan.deletes],
+                       'changes': [str(route) for route in plan.changes],
+                       'adds': [str(route) for route in plan.adds],
+                       'skipped': [[str(route), reason]
+                                   for route, reason in plan.skipped]}
+                      for plan in plans]}
+    except (Exception, SystemExit) as error:
+        record = {'host': host,
+                  'error': '%s: %s' % (type(error).__name__, error)}
+    return json.dumps(record, sort_keys=True), 'error' in record
+
+
+def run_fleet(options, output):
+    """
+    Plans every host of the capture directory with a pool of processes,
+    writing each plan to output as it completes
+
+    Returns the number of hosts planned and the number that failed
+    """
+    import multiprocessing
+    import threading
+    processes = options.processes or multiprocessing.cpu_count()
+    max_pending = options.max_pending or processes * PENDING_PER_PROCESS
+
+    # the pool's result thread writes the plans and frees a queue slot
+    # per host, while this thread walks the directory and queues hosts
+    slots = threading.BoundedSemaphore(max_pending)
+    counts = {'hosts': 0, 'errors': 0}
+
+    def write_plan(result):
+        line, failed = result
+        output.write(line + '\n')
+        counts['hosts'] += 1
+        counts['errors'] += failed
+        slots.release()
+
+    pool = multiprocessing.Pool(processes, init_worker,
+                                maxtasksperchild=HOSTS_PER_CHILD)
+    try:
+        for host_dir in iter_hosts(options.capture_dir):
+            slots.acquire()
+            pool.apply_async(plan_host, (host_dir, options.capture_dir),
+                             callback=write_plan)
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    return counts['hosts'], counts['errors']
+
+
+def main():
+    """
+    Plans the captured hosts and reports the throughput on stderr
+    """
+    options = parse_args()
+    if not os.path.isdir(options.capture_dir):
+        sys.exit('Not a directory: %s' % options.capture_dir)
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    start = time.time()
+    try:
+        hosts, errors = run_fleet(options, output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.time() - start
+    sys.stderr.write('%d hosts planned (%d failed) in %.1fs, %.0f hosts/s\n'
+                     % (hosts, errors, elapsed,
+                        hosts / elapsed if elapsed else 0.0))
+
+
+if __name__ == "__main__":
+    main()
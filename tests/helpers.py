@@ -0,0 +1,138 @@
+"""
+What the test modules share: dhcp_121 made importable from the source
+directory, Quiet, route and the ReplayCase of a captured two NIC Mac
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+import dhcp_121  # noqa: E402
+
+
+class Quiet(object):
+    """
+    Discards what the code under test prints
+    """
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, kind, value, traceback):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def route(prefix, gateway='', interface=''):
+    """
+    Returns the Route of a 'network/prefixlen' prefix
+    """
+    subnet, mask = prefix.split('/')
+    return dhcp_121.Route.parse(subnet, mask, gateway, interface)
+
+
+# A Mac with a lease on en0 and on en1, both handing out 192.168.1.0/24.
+# en0 holds it already, en1 has the default route and so claims it.
+CAPTURE = {
+    'ifconfig_-a_inet.out': """\
+lo0: flags=8049<UP,LOOPBACK,RUNNING,MULTICAST> mtu 16384
+\tinet 127.0.0.1 netmask 0xff000000
+en0: flags=8863<UP,BROADCAST,SMART,RUNNING,SIMPLEX,MULTICAST> mtu 1500
+\tinet 192.168.0.50 netmask 0xffffff00 broadcast 192.168.0.255
+en1: flags=8863<UP,BROADCAST,SMART,RUNNING,SIMPLEX,MULTICAST> mtu 1500
+\tinet 10.1.1.5 netmask 0xffffff00 broadcast 10.1.1.255
+en2: flags=8863<UP,BROADCAST,SMART,RUNNING,SIMPLEX,MULTICAST> mtu 1500
+\tinet 10.9.9.5 netmask 0xffffff00 broadcast 10.9.9.255
+""",
+    'netstat_-f_inet_-rn.out': """\
+Routing tables
+
+Internet:
+Destination        Gateway            Flags        Refs      Use   Netif Expire
+default            10.1.1.1           UGSc           25        0     en1
+10.1.1             link#5             UCS             0        0     en1
+192.168.0          link#4             UCS             2        0     en0
+192.168.1          192.168.0.29       UGSc            0        0     en0
+""",
+    'networksetup_-getmedia_en0.out': 'Current: autoselect\n'
+                                      'Active: autoselect\n',
+    'networksetup_-getmedia_en1.out': 'Current: autoselect\n'
+                                      'Active: autoselect\n',
+    'networksetup_-getmedia_en2.out': 'Current: autoselect\n'
+                                      'Active: autoselect\n',
+    'networksetup_-getmedia_lo0.out': '',
+    'usr_sbin_ipconfig_getpacket_en0.out': """\
+op = BOOTREPLY
+option_121 (opaque):
+0000  18 c0 a8 01 c0 a8 00 1d  10 ac 10 c0 a8 00 01     ...............
+
+end (none):
+""",
+    'usr_sbin_ipconfig_getpacket_en1.out': """\
+op = BOOTREPLY
+option_121 (opaque):
+0000  18 c0 a8 01 0a 01 01 01  10 0a 32 0a 01 01 01     ...............
+
+end (none):
+""",
+    'usr_sbin_ipconfig_getpacket_en2.out': '',
+}
+
+# The routing table once CAPTURE has been reconciled
+RECONCILED = """\
+Routing tables
+
+Internet:
+Destination        Gateway            Flags        Refs      Use   Netif Expire
+default            10.1.1.1           UGSc           25        0     en1
+10.1.1             link#5             UCS             0        0     en1
+10.50/16           10.1.1.1           UGSc            0        0     en1
+172.16/16          192.168.0.1        UGSc            0        0     en0
+192.168.0          link#4             UCS             2        0     en0
+192.168.1          10.1.1.1           UGSc            0        0     en1
+"""
+
+
+class ReplayCase(unittest.TestCase):
+    """
+    Serves CAPTURE, copied to capture_dir, to the runs of a test through a
+    ReplayRunner.  write_fixture replaces a command output of the capture.
+    """
+
+    def setUp(self):
+        self.capture_dir = tempfile.mkdtemp()
+        for name, output in CAPTURE.items():
+            self.write_fixture(name, output)
+        self.override_file = dhcp_121.OVERRIDE_FILE
+        dhcp_121.OVERRIDE_FILE = os.path.join(self.capture_dir,
+                                              'dhcp_121_override')
+        self.runner = dhcp_121.set_command_runner(
+            dhcp_121.ReplayRunner(self.capture_dir))
+        dhcp_121.invalidate_route_snapshot()
+
+    def tearDown(self):
+        dhcp_121.OVERRIDE_FILE = self.override_file
+        dhcp_121.set_command_runner(None)
+        dhcp_121.invalidate_route_snapshot()
+        shutil.rmtree(self.capture_dir)
+
+    def write_fixture(self, name, output):
+        with open(os.path.join(self.capture_dir, name), 'w') as fixture:
+            fixture.write(output)
+
+    def run_pass(self, backend=None, *argv):
+        with Quiet():
+            return dhcp_121.run(dhcp_121.parse_args(list(argv)), backend)
+
+    def table(self, backend):
+        return sorted('%s/%d via %s' % (dhcp_121.int_to_ip(network),
+                                        prefixlen,
+                                        dhcp_121.int_to_ip(gateway))
+                      for (network, prefixlen), gateway
+                      in backend.routes.items())
@@ -0,0 +1,212 @@
+"""
+Tests of aggregate_routes against the routes it aggregates, and of the
+order apply_operations programs an aggregate and the routes it replaces
+
+Run from the source directory with:
+    python -m unittest discover tests
+"""
+
+import collections
+import random
+import unittest
+
+# helpers makes dhcp_121 importable from the tests
+from helpers import Quiet, route
+import dhcp_121
+
+# every random route is within this /16, so that many of them meet
+REGION = dhcp_121.ip_to_int('10.20.0.0')
+
+
+def random_prefix(generator, shortest=16, longest=28):
+    prefixlen = generator.randint(shortest, longest)
+    network = (REGION | generator.getrandbits(16)) & \
+        dhcp_121.PREFIX_MASKS[prefixlen]
+    return network, prefixlen
+
+
+class EquivalenceTest(unittest.TestCase):
+    """
+    Compares the next hops of the aggregated and of the original routes,
+    each looked up in a RouteTable of its own
+    """
+
+    def forwarding(self, routes, barriers):
+        table = dhcp_121.RouteTable(routes)
+        barrier = dhcp_121.get_ifindex('barrier')
+        for number, (network, prefixlen) in enumerate(sorted(barriers)):
+            table.add(dhcp_121.Route(network, prefixlen, number, barrier))
+        return table
+
+    def next_hops(self, table, address):
+        return sorted((held.gateway, held.ifindex)
+                      for held in table.longest_match(address))
+
+    def addresses(self, generator, routes):
+        # the first and last address of every prefix and just outside
+        # them, and random ones within and around the region
+        addresses = set()
+        for held in routes:
+            last = held.network | \
+                (~dhcp_121.PREFIX_MASKS[held.prefixlen] & 0xFFFFFFFF)
+            addresses.update([held.network, last,
+                              max(held.network - 1, 0),
+                              min(last + 1, 0xFFFFFFFF)])
+        for _ in range(2000):
+            addresses.add(REGION | generator.getrandbits(16))
+        for _ in range(200):
+            addresses.add(generator.getrandbits(32))
+        return addresses
+
+    def check(self, seed):
+        generator = random.Random(seed)
+        gateways = [dhcp_121.ip_to_int('192.168.0.%d' % number)
+                    for number in range(1, generator.randint(2, 4))]
+        ifindex = dhcp_121.get_ifindex('en0')
+        desired = collections.OrderedDict()
+        for _ in range(generator.randint(1, 300)):
+            network, prefixlen = random_prefix(generator)
+            desired[network, prefixlen] = dhcp_121.Route(
+                network, prefixlen, generator.choice(gateways), ifindex)
+        barriers = set([(0, 0)])
+        for _ in range(generator.randint(0, 20)):
+            barriers.add(random_prefix(generator, 12))
+
+        aggregated, skipped = dhcp_121.aggregate_routes(desired, barriers)
+        self.assertTrue(len(aggregated) <= len(desired))
+        self.assertEqual(len(skipped) + len(set(aggregated) & set(desired)),
+                         len(desired))
+        for held, reason in skipped:
+            self.assertTrue(reason.startswith('aggregated_into_'), reason)
+            self.assertTrue(held.key in desired)
+
+        before = self.forwarding(desired.values(), barriers)
+        after = self.forwarding(aggregated.values(), barriers)
+        changed = [dhcp_121.int_to_ip(address) for address
+                   in self.addresses(generator, desired.values())
+                   if self.next_hops(before, address) !=
+                   self.next_hops(after, address)]
+        self.assertEqual(changed, [], 'seed %d' % seed)
+        return len(desired) - len(aggregated)
+
+    def test_random_tables(self):
+        saved = sum(self.check(seed) for seed in range(100))
+        # the tables are dense enough for aggregation to happen
+        self.assertTrue(saved > 1000, saved)
+
+    def test_siblings_merge(self):
+        desired = collections.OrderedDict(
+            (held.key, held) for held in [route('10.0.0.0/24', '192.168.0.1'),
+                                          route('10.0.1.0/24', '192.168.0.1'),
+                                          route('10.0.2.0/23', '192.168.0.1'),
+                                          route('10.0.4.0/24', '192.168.0.2')])
+        aggregated, skipped = dhcp_121.aggregate_routes(desired, [(0, 0)])
+        self.assertEqual([str(held) for held in aggregated.values()],
+                         ['10.0.0.0/22 via 192.168.0.1',
+                          '10.0.4.0/24 via 192.168.0.2'])
+        self.assertEqual([reason for held, reason in skipped],
+                         ['aggregated_into_10.0.0.0/22'] * 3)
+
+    def test_barrier_stops_merging(self):
+        desired = collections.OrderedDict(
+            (held.key, held) for held in [route('10.0.0.0/24', '192.168.0.1'),
+                                          route('10.0.1.0/24', '192.168.0.1')])
+        aggregated, skipped = dhcp_121.aggregate_routes(
+            desired, [route('10.0.0.0/23').key])
+        self.assertEqual(aggregated, desired)
+        self.assertEqual(skipped, [])
+
+    def test_verify_catches_a_change(self):
+        routes = [route('10.0.0.0/16', '192.168.0.1'),
+                  route('10.0.1.0/24', '192.168.0.2')]
+        self.assertTrue(dhcp_121.verify_aggregation(routes, routes))
+        self.assertFalse(dhcp_121.verify_aggregation(routes, routes[:1]))
+        self.assertFalse(dhcp_121.verify_aggregation(
+            routes, [route('10.0.0.0/15', '192.168.0.1'), routes[1]]))
+
+
+class ConcurrentFakeRouteBackend(dhcp_121.FakeRouteBackend):
+    concurrent = True
+
+
+class OrderTest(unittest.TestCase):
+    """
+    An aggregate is installed before the routes it covers are deleted
+    """
+
+    def plan(self, deletes, adds, nic='en0'):
+        plan = dhcp_121.RoutePlan(nic)
+        plan.deletes = deletes
+        plan.adds = adds
+        return plan
+
+    def operations(self, backend):
+        return ['%s %s' % operation for operation in backend.operations]
+
+    def test_aggregate_first(self):
+        for backend_class in (dhcp_121.FakeRouteBackend,
+                              ConcurrentFakeRouteBackend):
+            covered = [route('10.0.0.0/24', '192.168.0.1'),
+                       route('10.0.1.0/24', '192.168.0.1')]
+            backend = backend_class(covered)
+            with Quiet():
+                dhcp_121.apply_plans([self.plan(
+                    covered, [route('10.0.0.0/23', '192.168.0.1')])], backend)
+            operations = self.operations(backend)
+            self.assertEqual(operations[0], 'add 10.0.0.0/23 via 192.168.0.1')
+            self.assertEqual(sorted(operations[1:]),
+                             ['delete 10.0.0.0/24 via 192.168.0.1',
+                              'delete 10.0.1.0/24 via 192.168.0.1'])
+            self.assertEqual(backend.routes, {route('10.0.0.0/23').key:
+                                              route('10.0.0.0/23',
+                                                    '192.168.0.1').gateway})
+
+    def test_nearest_enclosing_prefix(self):
+        backend = dhcp_121.FakeRouteBackend(
+            [route('10.0.5.0/24', '192.168.0.1')])
+        with Quiet():
+            dhcp_121.apply_plans([self.plan(
+                [route('10.0.5.0/24', '192.168.0.1')],
+                [route('10.0.99.0/24', '192.168.0.1'),
+                 route('10.0.0.0/8', '192.168.0.2'),
+                 route('10.0.0.0/16', '192.168.0.1')])], backend)
+        # only the /16 covers the deleted route, the /8 is further out
+        self.assertEqual(self.operations(backend),
+                         ['add 10.0.0.0/16 via 192.168.0.1',
+                          'delete 10.0.5.0/24 via 192.168.0.1',
+                          'add 10.0.99.0/24 via 192.168.0.1',
+                          'add 10.0.0.0/8 via 192.168.0.2'])
+
+    def test_moving_aggregate(self):
+        # en1 gives up the /23 that en0 takes over for its two /24s
+        backend = dhcp_121.FakeRouteBackend(
+            [route('10.0.0.0/23', '10.1.1.1', 'en1'),
+             route('10.0.0.0/24', '192.168.0.1'),
+             route('10.0.1.0/24', '192.168.0.1')])
+        with Quiet():
+            dhcp_121.apply_plans([
+                self.plan([route('10.0.0.0/24', '192.168.0.1'),
+                           route('10.0.1.0/24', '192.168.0.1')],
+                          [route('10.0.0.0/23', '192.168.0.1')]),
+                self.plan([route('10.0.0.0/23', '10.1.1.1', 'en1')], [],
+                          'en1')], backend)
+        self.assertEqual(self.operations(backend),
+                         ['delete 10.0.0.0/23 via 10.1.1.1',
+                          'add 10.0.0.0/23 via 192.168.0.1',
+                          'delete 10.0.0.0/24 via 192.168.0.1',
+                          'delete 10.0.1.0/24 via 192.168.0.1'])
+
+    def test_results_follow_the_operations(self):
+        covered = route('10.0.0.0/24', '192.168.0.1')
+        aggregate = route('10.0.0.0/23', '192.168.0.1')
+        with Quiet():
+            results = dhcp_121.apply_operations(
+                [('delete', covered), ('add', aggregate)],
+                dhcp_121.FakeRouteBackend([covered]))
+        self.assertEqual([(result.routeverb, result.route, result.error)
+                          for result in results],
+                         [('delete', covered, ''), ('add', aggregate, '')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+"""
+Tests of the Journal: records read back by read_journal, rotation and
+stopping at a corrupt or cut short tail
+
+Run from the source directory with:
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+# helpers makes dhcp_121 importable from the tests
+from helpers import Quiet, ReplayCase, route
+import dhcp_121
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'dhcp_121.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        with Quiet():
+            return list(dhcp_121.read_journal(self.filename))
+
+    def write_pass(self, journal, start, nic='en0'):
+        journal.phase('override', 0.002)
+        journal.phase('command', 0.5)
+        journal.lease(nic, [route('10.0.0.0/8', '192.168.0.1')])
+        journal.operation(nic, dhcp_121.RouteResult(
+            'add', route('10.0.0.0/8', '192.168.0.1')))
+        journal.operation(nic, dhcp_121.RouteResult(
+            'delete', route('172.16.0.0/12', '192.168.0.1'),
+            error='No such process'))
+        journal.finish_pass(start, 0.25, True)
+
+    def test_round_trip(self):
+        journal = dhcp_121.Journal(self.filename)
+        self.write_pass(journal, 1000.0)
+        # an interface with operations but no lease, a failed pass
+        journal.operation('en1', dhcp_121.RouteResult(
+            'change', route('10.1.0.0/16', '10.1.1.1')))
+        journal.finish_pass(2000.5, 1.5, False)
+
+        first, second = self.read()
+        self.assertEqual(first['start'], 1000.0)
+        self.assertAlmostEqual(first['duration_ms'], 250.0, 3)
+        self.assertTrue(first['success'])
+        # spans that are not phases are left out
+        self.assertEqual([name for name, _ in first['phases']], ['override'])
+        self.assertAlmostEqual(first['phases'][0][1], 2.0, 3)
+        digest, operations = first['interfaces']['en0']
+        self.assertNotEqual(digest, '\0' * 8)
+        self.assertEqual(operations,
+                         [('add', False, route('10.0.0.0/8', '192.168.0.1')),
+                          ('delete', True,
+                           route('172.16.0.0/12', '192.168.0.1'))])
+
+        self.assertEqual(second['start'], 2000.5)
+        self.assertFalse(second['success'])
+        self.assertEqual(second['phases'], [])
+        self.assertEqual(second['interfaces'],
+                         {'en1': ('\0' * 8, [('change', False,
+                                              route('10.1.0.0/16',
+                                                    '10.1.1.1'))])})
+
+    def test_same_routes_same_digest(self):
+        journal = dhcp_121.Journal(self.filename)
+        self.write_pass(journal, 1.0)
+        self.write_pass(journal, 2.0)
+        journal.lease('en0', [route('10.0.0.0/8', '192.168.0.2')])
+        journal.finish_pass(3.0, 0.1, True)
+        digests = [record['interfaces']['en0'][0] for record in self.read()]
+        self.assertEqual(digests[0], digests[1])
+        self.assertNotEqual(digests[1], digests[2])
+
+    def test_rotation(self):
+        journal = dhcp_121.Journal(self.filename, max_bytes=400)
+        for number in range(20):
+            self.write_pass(journal, float(number))
+        self.assertTrue(os.path.getsize(self.filename) <= 400)
+        self.assertTrue(os.path.getsize(self.filename + '.1') <= 400)
+        starts = [record['start'] for record in self.read()]
+        # the rotated journal first, the oldest passes dropped
+        self.assertEqual(starts, sorted(starts))
+        self.assertEqual(starts[-1], 19.0)
+        self.assertTrue(0 < starts[0] < 19.0)
+
+    def test_cut_short(self):
+        journal = dhcp_121.Journal(self.filename)
+        for number in range(3):
+            self.write_pass(journal, float(number))
+        with open(self.filename, 'rb') as journal_file:
+            data = journal_file.read()
+        record_size = len(data) // 3
+        for size in range(2 * record_size, len(data)):
+            with open(self.filename, 'wb') as journal_file:
+                journal_file.write(data[:size])
+            self.assertEqual([record['start'] for record in self.read()],
+                             [0.0, 1.0])
+
+    def test_corrupt_record(self):
+        journal = dhcp_121.Journal(self.filename)
+        for number in range(3):
+            self.write_pass(journal, float(number))
+        with open(self.filename, 'rb') as journal_file:
+            data = journal_file.read()
+        record_size = len(data) // 3
+        # the phase index of the second record, the length of the second
+        # record, and garbage after the last one
+        phase = record_size + 4 + struct.calcsize(dhcp_121.Journal.record)
+        corruptions = [data[:phase] + '\xff' + data[phase + 1:],
+                       data[:record_size] + '\x00\x00\x00\x01' +
+                       data[record_size + 4:],
+                       data + '\x00\x00\x00\x03abc',
+                       data + '\x7f\xff']
+        expected = [[0.0], [0.0], [0.0, 1.0, 2.0], [0.0, 1.0, 2.0]]
+        for corrupted, starts in zip(corruptions, expected):
+            with open(self.filename, 'wb') as journal_file:
+                journal_file.write(corrupted)
+            self.assertEqual([record['start'] for record in self.read()],
+                             starts)
+
+    def test_other_version_is_skipped(self):
+        journal = dhcp_121.Journal(self.filename)
+        self.write_pass(journal, 1.0)
+        self.write_pass(journal, 2.0)
+        with open(self.filename, 'rb') as journal_file:
+            data = journal_file.read()
+        data = data[:4] + chr(dhcp_121.JOURNAL_VERSION + 1) + data[5:]
+        with open(self.filename, 'wb') as journal_file:
+            journal_file.write(data)
+        self.assertEqual([record['start'] for record in self.read()], [2.0])
+
+    def test_no_journal(self):
+        self.assertEqual(self.read(), [])
+
+
+class RunPassJournalTest(ReplayCase):
+    """
+    run_pass journals the phases, leases and operations of a pass
+    """
+
+    def setUp(self):
+        ReplayCase.setUp(self)
+        self.filename = os.path.join(self.capture_dir, 'dhcp_121.journal')
+        dhcp_121.set_journal(dhcp_121.Journal(self.filename))
+
+    def tearDown(self):
+        dhcp_121.set_journal(None)
+        ReplayCase.tearDown(self)
+
+    def test_pass(self):
+        with Quiet():
+            dhcp_121.run_pass(dhcp_121.parse_args([]))
+            record, = dhcp_121.read_journal(self.filename)
+        self.assertTrue(record['success'])
+        self.assertEqual([name for name, _ in record['phases']],
+                         dhcp_121.JOURNAL_PHASES)
+        self.assertEqual(sorted(record['interfaces']), ['en0', 'en1'])
+        self.assertEqual(
+            sorted('%s %s' % (routeverb, journaled)
+                   for nic in ('en0', 'en1')
+                   for routeverb, failed, journaled
+                   in record['interfaces'][nic][1]),
+            ['add 10.50.0.0/16 via 10.1.1.1',
+             'add 172.16.0.0/16 via 192.168.0.1',
+             'add 192.168.1.0/24 via 10.1.1.1',
+             'delete 192.168.1.0/24 via 192.168.0.29'])
+
+
+if __name__ == '__main__':
+    unittest.main()
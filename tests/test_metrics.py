@@ -0,0 +1,137 @@
+"""
+Tests of the Metrics textfile: histogram buckets, counters carried over
+from the previous file and the per interface last success gauge
+
+Run from the source directory with:
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+# helpers makes dhcp_121 importable from the tests
+from helpers import Quiet, ReplayCase
+import dhcp_121
+
+GAUGE = 'dhcp_121_last_success_timestamp_seconds'
+BUCKET = 'dhcp_121_run_duration_seconds_bucket'
+
+
+def read_samples(filename):
+    return dhcp_121.Metrics(filename).read()
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'dhcp_121.prom')
+        dhcp_121.set_command_runner(dhcp_121.CommandRunner())
+
+    def tearDown(self):
+        dhcp_121.set_command_runner(None)
+        shutil.rmtree(self.directory)
+
+    def finish_pass(self, seconds, success=True, nics=()):
+        metrics = dhcp_121.Metrics(self.filename)
+        metrics.finish_pass(seconds, success, nics)
+        return read_samples(self.filename)
+
+    def buckets(self, samples):
+        return [(labels, samples[(BUCKET, labels)])
+                for name, labels in sorted(samples) if name == BUCKET]
+
+    def test_every_bucket_is_written(self):
+        samples = self.finish_pass(0.3)
+        bounds = ['%g' % bound for bound in dhcp_121.RUN_DURATION_BUCKETS]
+        self.assertEqual(
+            dict(self.buckets(samples)),
+            dict([('{le="%s"}' % bound, 1.0 if float(bound) >= 0.3 else 0.0)
+                  for bound in bounds] + [('{le="+Inf"}', 1.0)]))
+        self.assertEqual(samples[('dhcp_121_run_duration_seconds_count',
+                                  '')], 1.0)
+        self.assertAlmostEqual(samples[('dhcp_121_run_duration_seconds_sum',
+                                        '')], 0.3)
+
+    def test_buckets_carry_over(self):
+        self.finish_pass(0.3)
+        samples = self.finish_pass(0.05, success=False)
+        buckets = dict(self.buckets(samples))
+        self.assertEqual(buckets['{le="0.1"}'], 1.0)
+        self.assertEqual(buckets['{le="0.25"}'], 1.0)
+        self.assertEqual(buckets['{le="0.5"}'], 2.0)
+        self.assertEqual(buckets['{le="+Inf"}'], 2.0)
+        self.assertEqual(samples[('dhcp_121_runs_total',
+                                  '{result="success"}')], 1.0)
+        self.assertEqual(samples[('dhcp_121_runs_total',
+                                  '{result="failure"}')], 1.0)
+
+    def test_buckets_in_order(self):
+        self.finish_pass(2.0)
+        with open(self.filename) as metrics_file:
+            bounds = [line.split('"')[1] for line in metrics_file
+                      if line.startswith(BUCKET)]
+        self.assertEqual(bounds, ['%g' % bound for bound in
+                                  dhcp_121.RUN_DURATION_BUCKETS] + ['+Inf'])
+
+    def test_only_the_nics_of_the_pass_are_stamped(self):
+        first = self.finish_pass(0.1, nics=['en0', 'en1'])
+        metrics = dhcp_121.Metrics(self.filename)
+        # en0 had routes decoded but wasnt reconciled
+        metrics.add('dhcp_121_routes_decoded_total', 3, interface='en0')
+        metrics.finish_pass(0.1, True, ['en1'])
+        second = read_samples(self.filename)
+        self.assertEqual(second[(GAUGE, '{interface="en0"}')],
+                         first[(GAUGE, '{interface="en0"}')])
+        self.assertTrue(second[(GAUGE, '{interface="en1"}')] >=
+                        first[(GAUGE, '{interface="en1"}')])
+        self.assertTrue(second[(GAUGE, '')] >= first[(GAUGE, '')])
+
+    def test_failed_pass_stamps_nothing(self):
+        first = self.finish_pass(0.1, nics=['en0'])
+        second = self.finish_pass(0.1, success=False, nics=['en0'])
+        self.assertEqual(second[(GAUGE, '{interface="en0"}')],
+                         first[(GAUGE, '{interface="en0"}')])
+        self.assertEqual(second[(GAUGE, '')], first[(GAUGE, '')])
+
+
+class RunPassMetricsTest(ReplayCase):
+    """
+    run_pass stamps the interfaces reconciled by the pass
+    """
+
+    def setUp(self):
+        ReplayCase.setUp(self)
+        self.filename = os.path.join(self.capture_dir, 'dhcp_121.prom')
+        dhcp_121.set_metrics(dhcp_121.Metrics(self.filename))
+
+    def tearDown(self):
+        dhcp_121.set_metrics(None)
+        ReplayCase.tearDown(self)
+
+    def stamped(self):
+        with Quiet():
+            dhcp_121.run_pass(dhcp_121.parse_args([]))
+        return sorted(labels for name, labels in read_samples(self.filename)
+                      if name == GAUGE)
+
+    def test_leased_nics(self):
+        self.assertEqual(self.stamped(), ['', '{interface="en0"}',
+                                          '{interface="en1"}'])
+
+    def test_failed_operation(self):
+        # en0 fails to add 172.16.0.0/16, en1 is reconciled
+        self.write_fixture('route_add_172.16.0.0_16_192.168.0.1.out',
+                           'add net 172.16.0.0: gateway 192.168.0.1: '
+                           'File exists\n')
+        self.assertEqual(self.stamped(), ['', '{interface="en1"}'])
+
+    def test_lost_lease(self):
+        self.write_fixture('usr_sbin_ipconfig_getpacket_en0.out', '')
+        self.assertEqual(self.stamped(), ['', '{interface="en1"}'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+"""
+Tests of the option 121 codecs: encode_option_121, iter_classless_routes,
+decode_option_121, hexdump_to_bytes and the RFC 3396 split options
+
+Run from the source directory with:
+    python -m unittest discover tests
+"""
+
+import random
+import unittest
+
+# helpers makes dhcp_121 importable from the tests
+from helpers import Quiet
+import dhcp_121
+
+
+def random_routes(count, seed):
+    """
+    Returns count random (network, prefixlen, gateway) records, every
+    prefix length from 0 to 32 included, the networks masked
+    """
+    generator = random.Random(seed)
+    routes = []
+    for _ in range(count):
+        prefixlen = generator.randint(0, 32)
+        network = generator.getrandbits(32) & dhcp_121.PREFIX_MASKS[prefixlen]
+        routes.append((network, prefixlen, generator.getrandbits(32)))
+    return routes
+
+
+def getpacket_text(option_data):
+    """
+    Returns 'ipconfig getpacket' output holding option_data as option 121
+    """
+    return '\n'.join(['op = BOOTREPLY', 'yiaddr = 192.168.0.50',
+                      'option_121 (opaque):'] +
+                     dhcp_121.bytes_to_hexdump(option_data) +
+                     ['', 'end (none):', ''])
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def test_encode_then_iter(self):
+        routes = random_routes(5000, 121)
+        payload = dhcp_121.encode_option_121(routes)
+        self.assertEqual(
+            list(dhcp_121.iter_classless_routes(payload)), routes)
+
+    def test_through_the_hexdump(self):
+        routes = random_routes(3000, 3442)
+        hexdump = dhcp_121.bytes_to_hexdump(
+            dhcp_121.encode_option_121(routes))
+        decoded = dhcp_121.decode_option_121(hexdump)
+        self.assertEqual([(route.network, route.prefixlen, route.gateway)
+                          for route in decoded], routes)
+
+    def test_memoryview_and_bytearray(self):
+        routes = random_routes(100, 1)
+        payload = dhcp_121.encode_option_121(routes)
+        for data in (memoryview(payload), bytearray(payload)):
+            self.assertEqual(
+                list(dhcp_121.iter_classless_routes(data)), routes)
+
+
+class PrefixLengthTest(unittest.TestCase):
+
+    def test_default_route(self):
+        payload = dhcp_121.encode_option_121([(0, 0, 0xc0a80001)])
+        self.assertEqual(payload, '\x00\xc0\xa8\x00\x01')
+        self.assertEqual(list(dhcp_121.iter_classless_routes(payload)),
+                         [(0, 0, 0xc0a80001)])
+
+    def test_host_route(self):
+        payload = dhcp_121.encode_option_121([(0x0a010203, 32, 0x0a000001)])
+        self.assertEqual(payload, '\x20\x0a\x01\x02\x03\x0a\x00\x00\x01')
+        self.assertEqual(list(dhcp_121.iter_classless_routes(payload)),
+                         [(0x0a010203, 32, 0x0a000001)])
+
+    def test_partial_octets(self):
+        # 10.2.128.0/17 takes 3 octets, 10.0.0.0/9 takes 2
+        payload = '\x11\x0a\x02\xf0\xc0\xa8\x0a\xc8' \
+            '\x09\x0a\x80\xc0\xa8\x0a\xc8'
+        self.assertEqual(list(dhcp_121.iter_classless_routes(payload)),
+                         [(0x0a028000, 17, 0xc0a80ac8),
+                          (0x0a800000, 9, 0xc0a80ac8)])
+        for prefixlen in range(33):
+            network = 0xffffffff & dhcp_121.PREFIX_MASKS[prefixlen]
+            payload = dhcp_121.encode_option_121([(network, prefixlen, 1)])
+            self.assertEqual(len(payload), 1 + (prefixlen + 7) // 8 + 4)
+
+    def test_invalid_prefix_length(self):
+        self.assertRaises(ValueError, dhcp_121.encode_option_121,
+                          [(0, 33, 0)])
+        self.assertRaises(ValueError, list,
+                          dhcp_121.iter_classless_routes('\x21' + '\x00' * 8))
+
+
+class TruncatedTest(unittest.TestCase):
+
+    def test_every_truncation(self):
+        routes = random_routes(40, 7)
+        payload = dhcp_121.encode_option_121(routes)
+        ends = set()
+        offset = 0
+        for route in routes:
+            offset += len(dhcp_121.encode_option_121([route]))
+            ends.add(offset)
+        for size in range(len(payload)):
+            decoded = []
+            try:
+                for route in dhcp_121.iter_classless_routes(payload[:size]):
+                    decoded.append(route)
+            except ValueError:
+                self.assertNotIn(size, ends)
+            else:
+                self.assertTrue(size in ends or size == 0)
+            self.assertEqual(decoded, routes[:len(decoded)])
+
+    def test_decode_keeps_the_leading_routes(self):
+        routes = random_routes(10, 8)
+        payload = dhcp_121.encode_option_121(routes)
+        with Quiet():
+            decoded = dhcp_121.decode_classless_routes(payload[:-2])
+        self.assertEqual([(route.network, route.prefixlen, route.gateway)
+                          for route in decoded], routes[:-1])
+
+
+class HexdumpTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        generator = random.Random(16)
+        for size in range(0, 100):
+            data = ''.join(chr(generator.randint(0, 255))
+                           for _ in range(size))
+            self.assertEqual(dhcp_121.hexdump_to_bytes(
+                dhcp_121.bytes_to_hexdump(data)), data)
+
+    def test_text_column_is_ignored(self):
+        lines = ['0000  18 c0 a8 01 0a 01 01 01  10 0a 32 0a 01 01 01'
+                 '     ab cd ef 01 23 45 67',
+                 'not a hexdump line ab cd']
+        self.assertEqual(dhcp_121.hexdump_to_bytes(lines),
+                         '\x18\xc0\xa8\x01\x0a\x01\x01\x01'
+                         '\x10\x0a\x32\x0a\x01\x01\x01')
+
+    def test_split_instances_are_concatenated(self):
+        first = dhcp_121.bytes_to_hexdump('\x18\xc0\xa8\x01')
+        second = dhcp_121.bytes_to_hexdump('\x0a\x01\x01\x01')
+        self.assertEqual(dhcp_121.hexdump_to_bytes(first + second),
+                         '\x18\xc0\xa8\x01\x0a\x01\x01\x01')
+
+
+class SplitOptionTest(unittest.TestCase):
+
+    def packet(self, options):
+        import struct
+        header = struct.pack(dhcp_121.BOOTP_HEADER, 2, 1, 6, 0, 1, 0, 0,
+                             '\0' * 4, '\xc0\xa8\x00\x32', '\0' * 4,
+                             '\0' * 4, '\0' * 16, '\0' * 64, '\0' * 128)
+        return header + dhcp_121.DHCP_MAGIC_COOKIE + options + '\xff'
+
+    def test_split_lengths(self):
+        wire = dhcp_121.split_option(121, 'x' * 600)
+        self.assertEqual([ord(wire[0]), ord(wire[1])], [121, 255])
+        self.assertEqual([ord(wire[257]), ord(wire[258])], [121, 255])
+        self.assertEqual([ord(wire[514]), ord(wire[515])], [121, 90])
+        self.assertEqual(len(wire), 600 + 3 * 2)
+        self.assertEqual(dhcp_121.split_option(121, ''), '')
+
+    def test_packet_reassembles_the_instances(self):
+        payload = dhcp_121.encode_option_121(random_routes(150, 9))
+        self.assertTrue(len(payload) > 255 * 2)
+        packet = dhcp_121.DhcpPacket(self.packet(
+            dhcp_121.split_option(121, payload)))
+        self.assertEqual(packet.get(121).tobytes(), payload)
+
+    def test_getpacket_of_a_long_option(self):
+        routes = random_routes(300, 10)
+        payload = dhcp_121.encode_option_121(routes)
+        packet = dhcp_121.DhcpPacket(
+            dhcp_121.getpacket_to_bytes(getpacket_text(payload)))
+        self.assertEqual(packet.get(121).tobytes(), payload)
+        decoded = dhcp_121.decode_classless_routes(packet.get(121))
+        self.assertEqual([(route.network, route.prefixlen, route.gateway)
+                          for route in decoded], routes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+"""
+Tests of plan_routes and of whole run passes replayed from captured
+command output, the routes programmed through a FakeRouteBackend
+
+Run from the source directory with:
+    python -m unittest discover tests
+"""
+
+import os
+import unittest
+
+# helpers makes dhcp_121 importable from the tests
+from helpers import RECONCILED, ReplayCase, route
+import dhcp_121
+
+
+class PlanRoutesTest(unittest.TestCase):
+
+    def desired(self, *routes):
+        import collections
+        return collections.OrderedDict((route.key, route) for route in routes)
+
+    def test_operations(self):
+        current = dhcp_121.RouteTable([
+            route('10.0.0.0/8', '192.168.0.1', 'en0'),
+            route('10.1.0.0/16', '192.168.0.1', 'en0'),
+            route('10.2.0.0/16', '192.168.0.1', 'en0'),
+            route('172.16.0.0/12', '10.9.9.1', 'en2')])
+        plan = dhcp_121.plan_routes(self.desired(
+            route('10.0.0.0/8', '192.168.0.1'),
+            route('10.1.0.0/16', '192.168.0.254'),
+            route('10.3.0.0/16', '192.168.0.1'),
+            route('172.16.0.0/12', '192.168.0.1')), current, 'en0')
+        self.assertEqual(plan.nic, 'en0')
+        self.assertEqual(plan.deletes, [route('10.2.0.0/16', '192.168.0.1',
+                                              'en0')])
+        self.assertEqual(plan.changes, [route('10.1.0.0/16',
+                                              '192.168.0.254')])
+        self.assertEqual(plan.adds, [route('10.3.0.0/16', '192.168.0.1')])
+        self.assertEqual(plan.skipped,
+                         [(route('10.0.0.0/8', '192.168.0.1'),
+                           'already_present'),
+                          (route('172.16.0.0/12', '192.168.0.1'),
+                           'already_present')])
+        # the en2 route is neither owned nor verified by the en0 plan
+        self.assertEqual(plan.desired, [route('10.0.0.0/8', '192.168.0.1'),
+                                        route('10.1.0.0/16', '192.168.0.254'),
+                                        route('10.3.0.0/16', '192.168.0.1')])
+        self.assertEqual(len(plan), 3)
+
+    def test_released_prefix_is_added(self):
+        current = dhcp_121.RouteTable([
+            route('172.16.0.0/12', '10.9.9.1', 'en2')])
+        plan = dhcp_121.plan_routes(
+            self.desired(route('172.16.0.0/12', '192.168.0.1')), current,
+            'en0', released=[route('172.16.0.0/12').key])
+        self.assertEqual(plan.adds, [route('172.16.0.0/12', '192.168.0.1')])
+        self.assertEqual(plan.skipped, [])
+
+    def test_nothing_to_do(self):
+        current = dhcp_121.RouteTable([
+            route('10.0.0.0/8', '192.168.0.1', 'en0')])
+        plan = dhcp_121.plan_routes(
+            self.desired(route('10.0.0.0/8', '192.168.0.1')), current, 'en0')
+        self.assertEqual(plan.operations(), [])
+        self.assertEqual(plan.report(),
+                         ['skip 10.0.0.0/8 via 192.168.0.1 (already present)'])
+
+
+class ReplayTest(ReplayCase):
+    """
+    Replays CAPTURE through run the way dhcp_121_fleet.py plans a host
+    """
+
+    def test_plans(self):
+        backend = dhcp_121.FakeRouteBackend(dhcp_121.get_route_snapshot())
+        plans = self.run_pass(backend, '--dry-run')
+        self.assertEqual([plan.nic for plan in plans], ['en1', 'en0'])
+        en1, en0 = plans
+        self.assertEqual(en1.report(), ['add 192.168.1.0/24 via 10.1.1.1',
+                                        'add 10.50.0.0/16 via 10.1.1.1'])
+        self.assertEqual(en0.report(),
+                         ['delete 192.168.1.0/24 via 192.168.0.29',
+                          'add 172.16.0.0/16 via 192.168.0.1',
+                          'skip 192.168.1.0/24 via 192.168.0.29 '
+                          '(claimed by en1)'])
+        self.assertEqual([str(route) for plan in plans
+                          for route in plan.desired],
+                         ['192.168.1.0/24 via 10.1.1.1',
+                          '10.50.0.0/16 via 10.1.1.1',
+                          '172.16.0.0/16 via 192.168.0.1'])
+        self.assertFalse([result for plan in plans
+                          for result in plan.results if result.error])
+
+    def test_operations(self):
+        backend = dhcp_121.FakeRouteBackend(dhcp_121.get_route_snapshot())
+        self.run_pass(backend, '--dry-run')
+        # the en0 route is deleted before en1 adds its own
+        self.assertEqual(['%s %s' % operation
+                          for operation in backend.operations],
+                         ['delete 192.168.1.0/24 via 192.168.0.29',
+                          'add 192.168.1.0/24 via 10.1.1.1',
+                          'add 10.50.0.0/16 via 10.1.1.1',
+                          'add 172.16.0.0/16 via 192.168.0.1'])
+        self.assertEqual(self.table(backend),
+                         ['10.50.0.0/16 via 10.1.1.1',
+                          '172.16.0.0/16 via 192.168.0.1',
+                          '192.168.1.0/24 via 10.1.1.1'])
+
+    def test_reconciled_table(self):
+        self.write_fixture('netstat_-f_inet_-rn.out', RECONCILED)
+        backend = dhcp_121.FakeRouteBackend(dhcp_121.get_route_snapshot())
+        plans = self.run_pass(backend, '--dry-run')
+        self.assertEqual(backend.operations, [])
+        self.assertEqual([len(plan) for plan in plans], [0, 0])
+
+    def test_override_nic(self):
+        self.write_fixture('dhcp_121_override', 'nic = en0\n')
+        backend = dhcp_121.FakeRouteBackend(dhcp_121.get_route_snapshot())
+        plans = self.run_pass(backend, '--dry-run')
+        # the override NIC comes first and so keeps 192.168.1.0/24
+        self.assertEqual([plan.nic for plan in plans], ['en0', 'en1'])
+        self.assertEqual(['%s %s' % operation
+                          for operation in backend.operations],
+                         ['add 172.16.0.0/16 via 192.168.0.1',
+                          'add 10.50.0.0/16 via 10.1.1.1'])
+
+    def test_no_lease(self):
+        for nic in ('en0', 'en1'):
+            self.write_fixture('usr_sbin_ipconfig_getpacket_%s.out' % nic,
+                               '')
+        backend = dhcp_121.FakeRouteBackend(dhcp_121.get_route_snapshot())
+        self.assertEqual(self.run_pass(backend, '--dry-run'), [])
+        self.assertEqual(backend.operations, [])
+
+    def spawns(self):
+        counts = {}
+        for cmd, seconds in self.runner.calls:
+            name = os.path.basename(cmd.split()[0])
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def test_dry_run_spawns(self):
+        self.run_pass(None, '--dry-run')
+        # the routing table is read once, the inventory and a lease
+        # per interface, no route command
+        self.assertEqual(self.spawns(), {'ifconfig': 1, 'ipconfig': 3,
+                                         'netstat': 1, 'networksetup': 4})
+        self.assertEqual(len(self.runner.calls), 9)
+
+    def test_route_command_spawns(self):
+        self.run_pass()
+        self.assertEqual(self.spawns(), {'ifconfig': 1, 'ipconfig': 3,
+                                         'netstat': 1, 'networksetup': 4,
+                                         'route': 4})
+        commands = [cmd for cmd, seconds in self.runner.calls
+                    if cmd.startswith('route ')]
+        self.assertEqual(sorted(commands),
+                         ['route add 10.50.0.0/16 10.1.1.1',
+                          'route add 172.16.0.0/16 192.168.0.1',
+                          'route add 192.168.1.0/24 10.1.1.1',
+                          'route delete 192.168.1.0/24 192.168.0.29'])
+        # the prefixes are programmed side by side, each in order
+        self.assertTrue(
+            commands.index('route delete 192.168.1.0/24 192.168.0.29') <
+            commands.index('route add 192.168.1.0/24 10.1.1.1'))
+
+    def test_replay_latency(self):
+        self.runner = dhcp_121.set_command_runner(
+            dhcp_121.ReplayRunner(self.capture_dir, latency=0.01))
+        self.run_pass(None, '--dry-run')
+        self.assertEqual(len(self.runner.calls), 9)
+        for cmd, seconds in self.runner.calls:
+            self.assertTrue(seconds >= 0.01, cmd)
+
+
+if __name__ == '__main__':
+    unittest.main()
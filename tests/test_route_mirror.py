@@ -0,0 +1,226 @@
+"""
+Tests of RouteMirror following route messages and of its checksum, the
+routing socket replaced by a queue of messages and dump_route_table by a
+list of routes
+
+Run from the source directory with:
+    python -m unittest discover tests
+"""
+
+import errno
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+
+# helpers makes dhcp_121 importable from the tests
+from helpers import Quiet, route
+import dhcp_121
+
+NETLINK = sys.platform.startswith('linux')
+
+
+def route_message(routeverb, held):
+    """
+    Returns the route message the kernel sends for an added or deleted
+    Route: rtnetlink on Linux, PF_ROUTE elsewhere
+    """
+    if NETLINK:
+        rtmsg = struct.pack('=BBBBBBBBL', socket.AF_INET, held.prefixlen, 0,
+                            0, dhcp_121.RT_TABLE_MAIN, dhcp_121.RTPROT_STATIC,
+                            dhcp_121.RT_SCOPE_UNIVERSE, dhcp_121.RTN_UNICAST,
+                            0)
+        attributes = struct.pack('=HH', 8, dhcp_121.NETLINK_RTA_DST) + \
+            struct.pack('!L', held.network)
+        if held.gateway:
+            attributes += struct.pack('=HH', 8,
+                                      dhcp_121.NETLINK_RTA_GATEWAY) + \
+                struct.pack('!L', held.gateway)
+        message_type = dhcp_121.RTM_DELROUTE if routeverb == 'delete' \
+            else dhcp_121.RTM_NEWROUTE
+        return struct.pack('=LHHLL', 16 + len(rtmsg) + len(attributes),
+                           message_type, 0, 0, 0) + rtmsg + attributes
+
+    message_type = {'add': dhcp_121.RTM_ADD, 'change': dhcp_121.RTM_CHANGE,
+                    'delete': dhcp_121.RTM_DELETE}[routeverb]
+    flags = dhcp_121.RTF_UP | dhcp_121.RTF_GATEWAY | dhcp_121.RTF_STATIC
+    addresses = dhcp_121.RTA_DST | dhcp_121.RTA_GATEWAY
+    sockaddrs = dhcp_121.sockaddr_in(held.network) + \
+        dhcp_121.sockaddr_in(held.gateway)
+    if held.prefixlen == 32:
+        flags |= dhcp_121.RTF_HOST
+    else:
+        addresses |= dhcp_121.RTA_NETMASK
+        sockaddrs += dhcp_121.sockaddr_in(
+            dhcp_121.PREFIX_MASKS[held.prefixlen])
+    return struct.pack(dhcp_121.RT_MSGHDR,
+                       dhcp_121.RT_MSGHDR_SIZE + len(sockaddrs),
+                       dhcp_121.RTM_VERSION, message_type, 0, flags,
+                       addresses, 0, 1, 0, 0, 0, *([0] * 14)) + sockaddrs
+
+
+def link_message():
+    """
+    Returns the message of an interface going down
+    """
+    if NETLINK:
+        return struct.pack('=LHHLL', 16, dhcp_121.RTM_NEWLINK, 0, 0, 0)
+    return struct.pack('=HBB', 4, dhcp_121.RTM_VERSION, dhcp_121.RTM_IFINFO)
+
+
+class FakeSocket(object):
+    """
+    Serves the queued messages one per recv, then EAGAIN.  A queued
+    errno is raised instead of being served.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def recv(self, size):
+        if not self.messages:
+            raise socket.error(errno.EAGAIN, 'Resource temporarily '
+                               'unavailable')
+        message = self.messages.pop(0)
+        if isinstance(message, int):
+            raise socket.error(message, 'No buffer space available')
+        return message
+
+    def close(self):
+        pass
+
+
+class RouteMirrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.kernel = [route('0.0.0.0/0', '10.1.1.1'),
+                       route('10.0.0.0/8', '192.168.0.1'),
+                       route('172.16.0.0/12', '192.168.0.1')]
+        self.dumps = 0
+        self.dump_route_table = dhcp_121.dump_route_table
+        dhcp_121.dump_route_table = self.dump
+        # the mirror of RouteMirror.__init__, on a FakeSocket
+        self.socket = FakeSocket()
+        self.mirror = dhcp_121.RouteMirror.__new__(dhcp_121.RouteMirror)
+        self.mirror._socket = self.socket
+        self.mirror.lock = threading.Lock()
+        self.mirror.table, self.mirror.checksum = self.mirror._load()
+        self.mirror.next_check = time.time() + dhcp_121.ROUTE_MIRROR_RESYNC
+
+    def tearDown(self):
+        dhcp_121.dump_route_table = self.dump_route_table
+
+    def dump(self):
+        self.dumps += 1
+        return list(self.kernel)
+
+    def change(self, routeverb, held):
+        """
+        Changes the kernel table and queues the message of the change
+        """
+        self.kernel = [other for other in self.kernel
+                       if other.key != held.key]
+        if routeverb != 'delete':
+            self.kernel.append(held)
+        self.socket.messages.append(route_message(routeverb, held))
+
+    def read(self):
+        with Quiet():
+            return self.mirror.read()
+
+    def check_in_step(self):
+        table, checksum = self.mirror._load()
+        self.assertEqual(sorted(self.mirror.table, key=repr),
+                         sorted(table, key=repr))
+        self.assertEqual(self.mirror.checksum, checksum)
+        self.assertEqual(self.mirror.table.default_interface,
+                         table.default_interface)
+
+    def test_load(self):
+        self.assertEqual(self.dumps, 1)
+        self.assertEqual(sorted(str(held) for held in self.mirror.table),
+                         ['10.0.0.0/8 via 192.168.0.1',
+                          '172.16.0.0/12 via 192.168.0.1'])
+        self.assertEqual(self.mirror.table.default_interface, '')
+        self.assertNotEqual(self.mirror.checksum, 0)
+
+    def test_follows_route_messages(self):
+        table = self.mirror.table
+        self.change('add', route('10.1.0.0/16', '192.168.0.2'))
+        self.change('add', route('10.1.2.3/32', '192.168.0.3'))
+        self.change('delete', route('172.16.0.0/12', '192.168.0.1'))
+        self.change('add', route('10.0.0.0/8', '192.168.0.9'))
+        self.assertTrue(self.read() is table)
+        self.assertEqual(sorted(str(held) for held in table),
+                         ['10.0.0.0/8 via 192.168.0.9',
+                          '10.1.0.0/16 via 192.168.0.2',
+                          '10.1.2.3/32 via 192.168.0.3'])
+        self.assertEqual(table.longest_match(
+            dhcp_121.ip_to_int('10.1.2.3')), [route('10.1.2.3/32',
+                                                    '192.168.0.3')])
+        # the messages were followed, the table wasnt dumped again
+        self.assertEqual(self.dumps, 1)
+        self.dumps = 0
+        self.check_in_step()
+
+    def test_checksum_returns_with_the_routes(self):
+        checksum = self.mirror.checksum
+        self.change('add', route('10.1.0.0/16', '192.168.0.2'))
+        self.read()
+        self.assertNotEqual(self.mirror.checksum, checksum)
+        self.change('delete', route('10.1.0.0/16', '192.168.0.2'))
+        self.read()
+        self.assertEqual(self.mirror.checksum, checksum)
+
+    def test_default_route(self):
+        self.change('delete', route('0.0.0.0/0', '10.1.1.1'))
+        self.assertEqual(self.read().default_interface, None)
+        self.change('add', route('0.0.0.0/0', '10.1.1.254'))
+        self.assertEqual(self.read().default_interface, '')
+        self.assertEqual(self.dumps, 1)
+
+    def test_routes_without_a_gateway_are_ignored(self):
+        checksum = self.mirror.checksum
+        self.socket.messages.append(route_message(
+            'add', route('10.9.0.0/16')))
+        self.assertEqual(len(self.read()), 2)
+        self.assertEqual(self.mirror.checksum, checksum)
+
+    def test_link_message_reloads(self):
+        self.kernel.append(route('10.2.0.0/16', '192.168.0.1'))
+        self.socket.messages.append(link_message())
+        table = self.read()
+        self.assertEqual(self.dumps, 2)
+        self.assertTrue(route('10.2.0.0/16', '192.168.0.1') in list(table))
+        self.check_in_step()
+
+    def test_overflow_reloads(self):
+        self.change('add', route('10.1.0.0/16', '192.168.0.2'))
+        self.socket.messages.append(errno.ENOBUFS)
+        self.kernel.append(route('10.2.0.0/16', '192.168.0.1'))
+        table = self.read()
+        self.assertEqual(self.dumps, 2)
+        self.assertEqual(len(table), 4)
+        self.check_in_step()
+
+    def test_resync_keeps_a_mirror_in_step(self):
+        self.change('add', route('10.1.0.0/16', '192.168.0.2'))
+        table = self.mirror.table
+        self.mirror.next_check = 0
+        self.assertTrue(self.read() is table)
+        self.assertEqual(self.dumps, 2)
+        self.assertTrue(self.mirror.next_check > time.time())
+
+    def test_resync_replaces_a_drifted_mirror(self):
+        # a change the kernel sent no message for
+        self.kernel.append(route('10.2.0.0/16', '192.168.0.1'))
+        self.assertEqual(len(self.read()), 2)
+        self.mirror.next_check = 0
+        self.assertEqual(len(self.read()), 3)
+        self.check_in_step()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+"""
+Tests of PrefixTrie and of the RouteTable indexes against a brute force
+scan of the same prefixes and routes
+
+Run from the source directory with:
+    python -m unittest discover tests
+"""
+
+import random
+import unittest
+
+# helpers makes dhcp_121 importable from the tests
+from helpers import route
+import dhcp_121
+
+# most random prefixes are within this /16, so that they nest and share
+# trie nodes
+REGION = dhcp_121.ip_to_int('10.20.0.0')
+
+
+def random_prefix(generator):
+    prefixlen = generator.choice([0, 1, 8, 32] + range(12, 33))
+    if generator.random() < 0.9:
+        network = REGION | generator.getrandbits(16)
+    else:
+        network = generator.getrandbits(32)
+    return network & dhcp_121.PREFIX_MASKS[prefixlen], prefixlen
+
+
+def contains(prefix, address):
+    network, prefixlen = prefix
+    return not (address ^ network) & dhcp_121.PREFIX_MASKS[prefixlen]
+
+
+def sample_addresses(generator, prefixes):
+    # the first and last address of every prefix and just outside them,
+    # and random ones within and around the region
+    addresses = set()
+    for network, prefixlen in prefixes:
+        last = network | (~dhcp_121.PREFIX_MASKS[prefixlen] & 0xFFFFFFFF)
+        addresses.update([network, last, max(network - 1, 0),
+                          min(last + 1, 0xFFFFFFFF)])
+    for _ in range(300):
+        addresses.add(REGION | generator.getrandbits(16))
+        addresses.add(generator.getrandbits(32))
+    return addresses
+
+
+class PrefixTrieTest(unittest.TestCase):
+
+    def scan(self, prefixes, address):
+        matches = [prefix for prefix in prefixes if contains(prefix, address)]
+        if not matches:
+            return None
+        return max(matches, key=lambda prefix: prefix[1])
+
+    def check(self, trie, prefixes, generator):
+        self.assertEqual(len(trie), len(prefixes))
+        for prefix in prefixes:
+            self.assertTrue(prefix in trie, prefix)
+        for address in sample_addresses(generator, prefixes):
+            self.assertEqual(trie.longest_match(address),
+                             self.scan(prefixes, address),
+                             dhcp_121.int_to_ip(address))
+
+    def test_random_inserts_and_removes(self):
+        for seed in range(8):
+            generator = random.Random(seed)
+            trie = dhcp_121.PrefixTrie()
+            prefixes = set()
+            for step in range(400):
+                prefix = random_prefix(generator)
+                if generator.random() < 0.3 and prefixes:
+                    prefix = generator.choice(sorted(prefixes))
+                    trie.remove(*prefix)
+                    prefixes.discard(prefix)
+                    self.assertFalse(prefix in trie)
+                else:
+                    trie.insert(*prefix)
+                    prefixes.add(prefix)
+                if step % 100 == 99:
+                    self.check(trie, prefixes, generator)
+            for prefix in sorted(prefixes):
+                trie.remove(*prefix)
+            self.assertEqual(len(trie), 0)
+            self.assertEqual(trie.longest_match(REGION), None)
+
+    def test_default_and_host_prefixes(self):
+        trie = dhcp_121.PrefixTrie()
+        self.assertEqual(trie.longest_match(0), None)
+        host = route('10.20.1.2/32').key
+        trie.insert(*host)
+        self.assertEqual(trie.longest_match(host[0]), host)
+        self.assertEqual(trie.longest_match(host[0] + 1), None)
+        trie.insert(0, 0)
+        self.assertEqual(trie.longest_match(host[0] + 1), (0, 0))
+        self.assertEqual(trie.longest_match(0xFFFFFFFF), (0, 0))
+        self.assertEqual(trie.longest_match(host[0]), host)
+        self.assertEqual(len(trie), 2)
+
+    def test_insert_twice_and_remove_missing(self):
+        trie = dhcp_121.PrefixTrie()
+        prefix = route('10.20.0.0/16').key
+        trie.insert(*prefix)
+        trie.insert(*prefix)
+        self.assertEqual(len(trie), 1)
+        # a fork node and a prefix that was never inserted
+        trie.insert(*route('10.20.128.0/17').key)
+        trie.insert(*route('10.20.64.0/18').key)
+        trie.remove(*route('10.20.0.0/17').key)
+        trie.remove(*route('10.21.0.0/16').key)
+        self.assertEqual(len(trie), 3)
+        self.assertFalse(route('10.20.0.0/17').key in trie)
+
+
+class RouteTableTest(unittest.TestCase):
+
+    def random_route(self, generator, interfaces):
+        network, prefixlen = random_prefix(generator)
+        return dhcp_121.Route(network, prefixlen,
+                              generator.choice([0, 0x0a010101, 0xc0a80001]),
+                              dhcp_121.get_ifindex(
+                                  generator.choice(interfaces)))
+
+    def check(self, table, routes, generator, interfaces):
+        self.assertEqual(len(table), len(routes))
+        self.assertEqual(list(table), routes)
+        for name in interfaces:
+            self.assertEqual(table.routes_on(name),
+                             [held for held in routes
+                              if held.interface == name])
+        self.assertEqual(sorted(table.interfaces()),
+                         sorted(set(held.interface for held in routes)))
+        for held in routes:
+            self.assertTrue(held.key in table)
+            self.assertEqual(table.get(*held.key),
+                             [other for other in routes
+                              if other.key == held.key])
+        for address in sample_addresses(
+                generator, set(held.key for held in routes)):
+            matches = [held for held in routes
+                       if contains(held.key, address)]
+            if matches:
+                longest = max(held.prefixlen for held in matches)
+                matches = [held for held in matches
+                           if held.prefixlen == longest]
+            self.assertEqual(table.longest_match(address), matches,
+                             dhcp_121.int_to_ip(address))
+
+    def test_random_adds_and_discards(self):
+        interfaces = ['en0', 'en1', 'en2', 'utun3']
+        for seed in range(8):
+            generator = random.Random(seed)
+            table = dhcp_121.RouteTable()
+            routes = []
+            for step in range(600):
+                if generator.random() < 0.4 and routes:
+                    held = generator.choice(routes)
+                    # an equal Route, not the one held by the table
+                    table.discard(dhcp_121.Route(
+                        held.network, held.prefixlen, held.gateway,
+                        held.ifindex))
+                    routes.remove(held)
+                else:
+                    held = self.random_route(generator, interfaces)
+                    table.add(held)
+                    routes.append(held)
+                if step % 150 == 149:
+                    self.check(table, routes, generator, interfaces)
+            # discarding most of the routes compacts the indexes
+            while len(routes) > 3:
+                held = routes.pop(generator.randrange(len(routes)))
+                table.discard(held)
+            self.check(table, routes, generator, interfaces)
+
+    def test_discard_a_missing_route(self):
+        held = route('10.20.0.0/16', '192.168.0.1', 'en0')
+        table = dhcp_121.RouteTable([held])
+        table.discard(route('10.20.0.0/16', '192.168.0.2', 'en0'))
+        table.discard(route('10.21.0.0/16', '192.168.0.1', 'en0'))
+        self.assertEqual(list(table), [held])
+        table.discard(held)
+        self.assertEqual(list(table), [])
+        self.assertEqual(table.interfaces(), [])
+        self.assertEqual(table.routes_on('en0'), [])
+        self.assertEqual(table.longest_match(held.network), [])
+        self.assertFalse(held.key in table)
+
+    def test_same_prefix_on_two_interfaces(self):
+        en0 = route('10.20.0.0/16', '192.168.0.1', 'en0')
+        en1 = route('10.20.0.0/16', '10.1.1.1', 'en1')
+        table = dhcp_121.RouteTable([en0, en1])
+        self.assertEqual(table.longest_match(en0.network + 5), [en0, en1])
+        table.discard(en0)
+        self.assertEqual(table.longest_match(en0.network + 5), [en1])
+        self.assertTrue(en0.key in table)
+        self.assertEqual(table.routes_on('en0'), [])
+        self.assertEqual(table.interfaces(), ['en1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
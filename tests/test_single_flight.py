@@ -0,0 +1,96 @@
+"""
+Tests of run_single_flight: a run that finds the lock taken marks the
+dirty file and returns, and the running invocation makes another pass
+
+Run from the source directory with:
+    python -m unittest discover tests
+"""
+
+import fcntl
+import os
+import shutil
+import tempfile
+import unittest
+
+# helpers makes dhcp_121 importable from the tests
+from helpers import Quiet
+import dhcp_121
+
+
+class SingleFlightTest(unittest.TestCase):
+    """
+    run_pass is replaced by one that counts the passes and calls
+    self.during for each of them
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = dhcp_121.LOCK_FILE, dhcp_121.DIRTY_FILE
+        dhcp_121.LOCK_FILE = os.path.join(self.directory, 'dhcp_121.lock')
+        dhcp_121.DIRTY_FILE = os.path.join(self.directory, 'dhcp_121.dirty')
+        self.run_pass = dhcp_121.run_pass
+        dhcp_121.run_pass = self.count_pass
+        self.passes = 0
+        self.during = []
+
+    def tearDown(self):
+        dhcp_121.LOCK_FILE, dhcp_121.DIRTY_FILE = self.files
+        dhcp_121.run_pass = self.run_pass
+        shutil.rmtree(self.directory)
+
+    def count_pass(self, options):
+        self.passes += 1
+        # the dirty file is cleared before each pass
+        self.assertFalse(os.path.exists(dhcp_121.DIRTY_FILE))
+        if self.during:
+            self.during.pop(0)()
+
+    def run_single_flight(self):
+        with Quiet():
+            dhcp_121.run_single_flight(dhcp_121.parse_args([]))
+
+    def mark_dirty(self):
+        open(dhcp_121.DIRTY_FILE, 'w').close()
+
+    def test_one_pass(self):
+        # left by an invocation that gave up on a finished run
+        self.mark_dirty()
+        self.run_single_flight()
+        self.assertEqual(self.passes, 1)
+        self.assertFalse(os.path.exists(dhcp_121.DIRTY_FILE))
+        # the lock was released
+        with open(dhcp_121.LOCK_FILE, 'a') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_lock_taken(self):
+        with open(dhcp_121.LOCK_FILE, 'a') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.run_single_flight()
+        self.assertEqual(self.passes, 0)
+        self.assertTrue(os.path.exists(dhcp_121.DIRTY_FILE))
+
+    def test_dirty_during_the_pass(self):
+        self.during = [self.mark_dirty, self.mark_dirty]
+        self.run_single_flight()
+        self.assertEqual(self.passes, 3)
+        self.assertFalse(os.path.exists(dhcp_121.DIRTY_FILE))
+
+    def test_overlapping_invocations(self):
+        # three invocations started during the first pass cost one more
+        overlapping = self.run_single_flight
+        self.during = [lambda: [overlapping() for _ in range(3)]]
+        self.run_single_flight()
+        self.assertEqual(self.passes, 2)
+        self.assertFalse(os.path.exists(dhcp_121.DIRTY_FILE))
+
+    def test_failed_pass_releases_the_lock(self):
+        def fail():
+            raise RuntimeError('pass failed')
+        self.during = [fail]
+        self.assertRaises(RuntimeError, self.run_single_flight)
+        self.run_single_flight()
+        self.assertEqual(self.passes, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
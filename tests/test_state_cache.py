@@ -0,0 +1,212 @@
+"""
+Tests of the state cache: the STATE_FILE record, its state key and a run
+that finds nothing changed since the last one
+
+Run from the source directory with:
+    python -m unittest discover tests
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+# helpers makes dhcp_121 importable from the tests
+from helpers import RECONCILED, Quiet, ReplayCase, route
+import dhcp_121
+
+
+class StateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_file = dhcp_121.STATE_FILE
+        dhcp_121.STATE_FILE = os.path.join(self.directory, 'dhcp_121.state')
+
+    def tearDown(self):
+        dhcp_121.STATE_FILE = self.state_file
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        with Quiet():
+            return dhcp_121.read_state_cache()
+
+    def write_record(self, record):
+        with open(dhcp_121.STATE_FILE, 'w') as state_file:
+            state_file.write(record)
+
+    def test_round_trip(self):
+        routes = [route('10.0.0.0/8', '192.168.0.1'),
+                  route('192.168.1.0/24', '10.1.1.1')]
+        dhcp_121.write_state_cache('abc', ['en0', 'en1'], routes)
+        self.assertEqual(self.read(), {'key': 'abc', 'routes': routes})
+
+    def test_no_record(self):
+        self.assertEqual(self.read(), None)
+
+    def test_stale_record_is_evicted(self):
+        for age in (dhcp_121.STATE_MAX_AGE + 1, -60):
+            self.write_record(json.dumps({'key': 'abc', 'nics': [],
+                                          'time': time.time() - age,
+                                          'routes': []}))
+            self.assertEqual(self.read(), None)
+            self.assertFalse(os.path.exists(dhcp_121.STATE_FILE))
+
+    def test_unreadable_record_is_evicted(self):
+        now = time.time()
+        for record in ['{"key": "abc", "ti', '[]',
+                       json.dumps({'key': 'abc', 'routes': []}),
+                       json.dumps({'key': 'abc', 'time': 'now',
+                                   'routes': []}),
+                       json.dumps({'key': 'abc', 'time': now,
+                                   'routes': [['10.0.0.256', 8, '1.2.3.4']]}),
+                       json.dumps({'key': 'abc', 'time': now,
+                                   'routes': [['10.0.0.0', 8]]})]:
+            self.write_record(record)
+            self.assertEqual(self.read(), None, record)
+            self.assertFalse(os.path.exists(dhcp_121.STATE_FILE))
+
+    def test_unwritable_record(self):
+        dhcp_121.STATE_FILE = os.path.join(self.directory, 'missing',
+                                           'dhcp_121.state')
+        with Quiet():
+            dhcp_121.write_state_cache('abc', ['en0'], [])
+        self.assertEqual(self.read(), None)
+
+    def test_verify_state_routes(self):
+        table = dhcp_121.RouteTable([
+            route('10.0.0.0/8', '192.168.0.1', 'en0'),
+            route('10.0.0.0/8', '10.1.1.1', 'en1'),
+            route('192.168.1.0/24', '10.1.1.1', 'en1')])
+        self.assertTrue(dhcp_121.verify_state_routes([], table))
+        self.assertTrue(dhcp_121.verify_state_routes(
+            [route('10.0.0.0/8', '10.1.1.1'),
+             route('192.168.1.0/24', '10.1.1.1')], table))
+        self.assertFalse(dhcp_121.verify_state_routes(
+            [route('192.168.1.0/24', '192.168.0.1')], table))
+        self.assertFalse(dhcp_121.verify_state_routes(
+            [route('10.0.0.0/8', '10.1.1.1'),
+             route('172.16.0.0/12', '10.1.1.1')], table))
+
+    def test_state_key(self):
+        override_file = dhcp_121.OVERRIDE_FILE
+        dhcp_121.OVERRIDE_FILE = os.path.join(self.directory, 'override')
+        try:
+            en0 = dhcp_121.Lease('en0', [], '\x18\xc0\xa8\x01')
+            en1 = dhcp_121.Lease('en1', [], '\x10\x0a\x32')
+            interfaces = [dhcp_121.Interface(
+                'en0', 0, [('192.168.0.50', 24, '192.168.0.255')], True,
+                True, True)]
+            key = dhcp_121.get_state_key([en0, en1], interfaces)
+            self.assertEqual(dhcp_121.get_state_key([en0, en1], interfaces),
+                             key)
+            others = [dhcp_121.get_state_key([en1, en0], interfaces),
+                      dhcp_121.get_state_key(
+                          [en0, dhcp_121.Lease('en1', [], '\x10\x0a\x33')],
+                          interfaces),
+                      dhcp_121.get_state_key([en0, en1], []),
+                      dhcp_121.get_state_key([en0, en1], [dhcp_121.Interface(
+                          'en0', 0, [('192.168.0.50', 24, '192.168.0.255')],
+                          True, True, False)])]
+            with open(dhcp_121.OVERRIDE_FILE, 'w') as override:
+                override.write('nic=en1\n')
+            others.append(dhcp_121.get_state_key([en0, en1], interfaces))
+            self.assertEqual(len(set(others + [key])), len(others) + 1)
+        finally:
+            dhcp_121.OVERRIDE_FILE = override_file
+
+
+class RunStateCacheTest(ReplayCase):
+    """
+    run skips a pass whose inputs match the last one and whose routes are
+    still in place.  The ReplayRunner passes for a native one, with the
+    interfaces still read from the captured ifconfig output.
+    """
+
+    def setUp(self):
+        ReplayCase.setUp(self)
+        self.state_file = dhcp_121.STATE_FILE
+        dhcp_121.STATE_FILE = os.path.join(self.capture_dir,
+                                           'dhcp_121.state')
+        self.runner.native = True
+        self.get_interface_inventory = dhcp_121.get_interface_inventory
+        dhcp_121.get_interface_inventory = \
+            dhcp_121.get_interfaces_from_ifconfig
+        self.decode_lease = dhcp_121.decode_lease
+        dhcp_121.decode_lease = self.count_decode
+        self.decoded = []
+
+    def tearDown(self):
+        dhcp_121.STATE_FILE = self.state_file
+        dhcp_121.get_interface_inventory = self.get_interface_inventory
+        dhcp_121.decode_lease = self.decode_lease
+        ReplayCase.tearDown(self)
+
+    def count_decode(self, lease):
+        self.decoded.append(lease.nic)
+        return self.decode_lease(lease)
+
+    def run_cached(self, *argv):
+        """
+        Runs a pass on a FakeRouteBackend of the captured routing table,
+        returns the plans and the backend operations
+        """
+        del self.decoded[:]
+        dhcp_121.invalidate_route_snapshot()
+        backend = dhcp_121.FakeRouteBackend(dhcp_121.get_route_snapshot())
+        plans = self.run_pass(backend, *argv)
+        return plans, backend.operations
+
+    def test_miss_then_hit(self):
+        plans, operations = self.run_cached()
+        self.assertEqual(sorted(self.decoded), ['en0', 'en1'])
+        self.assertEqual(len(operations), 4)
+        self.assertTrue(os.path.exists(dhcp_121.STATE_FILE))
+
+        # the routes of the first pass are now in the routing table
+        self.write_fixture('netstat_-f_inet_-rn.out', RECONCILED)
+        plans, operations = self.run_cached()
+        self.assertEqual(self.decoded, [])
+        self.assertEqual(operations, [])
+        self.assertEqual([(plan.nic, len(plan)) for plan in plans],
+                         [('en1', 0), ('en0', 0)])
+
+    def test_routes_gone(self):
+        self.run_cached()
+        # the routing table still lacks the routes of the first pass
+        plans, operations = self.run_cached()
+        self.assertEqual(sorted(self.decoded), ['en0', 'en1'])
+        self.assertEqual(len(operations), 4)
+        self.assertTrue(os.path.exists(dhcp_121.STATE_FILE))
+
+    def test_changed_lease(self):
+        self.run_cached()
+        self.write_fixture('netstat_-f_inet_-rn.out', RECONCILED)
+        self.write_fixture('usr_sbin_ipconfig_getpacket_en1.out', """\
+op = BOOTREPLY
+option_121 (opaque):
+0000  18 c0 a8 01 0a 01 01 01  10 0a 33 0a 01 01 01     ...............
+
+end (none):
+""")
+        plans, operations = self.run_cached()
+        self.assertEqual(sorted(self.decoded), ['en0', 'en1'])
+        self.assertEqual(sorted('%s %s' % (routeverb, held)
+                                for routeverb, held in operations),
+                         ['add 10.51.0.0/16 via 10.1.1.1',
+                          'delete 10.50.0.0/16 via 10.1.1.1'])
+
+    def test_dry_run_leaves_no_record(self):
+        self.run_cached('--dry-run')
+        self.assertFalse(os.path.exists(dhcp_121.STATE_FILE))
+
+    def test_replayed_run_leaves_no_record(self):
+        self.runner.native = False
+        self.run_cached()
+        self.assertFalse(os.path.exists(dhcp_121.STATE_FILE))
+
+
+if __name__ == '__main__':
+    unittest.main()